@@ -0,0 +1,579 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for the Machinekit CI tools
+"""
+
+import argparse
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import platform
+import statistics
+import subprocess
+import threading
+import http.server
+import contextlib
+
+
+class StartupBenchmark(object):
+    """Measure import time and `--help` startup time of the console scripts
+
+    Each entry point runs in a fresh interpreter under `python -X importtime`.
+    A run fails if any entry point's package import time or wall-clock
+    startup exceeds its budget, or if it imports a module that should only be
+    loaded on demand.
+    """
+    # Console scripts from setup.py:  name -> (module, class)
+    entry_points = {
+        'buildpackages': ('machinekit_ci.buildpackages', 'BuildPackages'),
+        'containerimage': ('machinekit_ci.containerimage', 'BuildContainerImage'),
+        'cloudsmithupload': ('machinekit_ci.cloudsmithupload', 'CloudsmithUploader'),
+        'mkci': ('machinekit_ci.pipeline', 'Pipeline'),
+        'querybuild': ('machinekit_ci.querybuild', 'Query'),
+        'rundocker': ('machinekit_ci.rundocker', 'RunDocker'),
+    }
+
+    # Heavy modules that must not be imported just to start a CLI
+    deferred_modules = (
+        'sh', 'yaml', 'requests', 'pkg_resources', 'docker_registry_client',
+        'debian', 'asyncio')
+
+    # Default budgets, milliseconds
+    import_budget_ms = 50
+    startup_budget_ms = 250
+
+    def __init__(self: object, runs=5, import_budget_ms=None,
+                 startup_budget_ms=None):
+        self.runs = runs
+        if import_budget_ms is not None:
+            self.import_budget_ms = import_budget_ms
+        if startup_budget_ms is not None:
+            self.startup_budget_ms = startup_budget_ms
+
+    def startup_code(self: object, name: str) -> str:
+        module, cls = self.entry_points[name]
+        return (
+            "import sys; sys.argv = [{!r}, '--help']\n"
+            "from {} import {}\n"
+            "try:\n"
+            "    {}.cli()\n"
+            "except SystemExit:\n"
+            "    pass\n").format(name, module, cls, cls)
+
+    @staticmethod
+    def parse_importtime(stderr: str):
+        # Return {module: cumulative_us} from `-X importtime` output
+        result = dict()
+        for line in stderr.splitlines():
+            if not line.startswith('import time:'):
+                continue
+            fields = line[len('import time:'):].split('|')
+            if len(fields) != 3 or not fields[1].strip().isdigit():
+                continue
+            result[fields[2].strip()] = int(fields[1])
+        return result
+
+    def run_one(self: object, name: str) -> dict:
+        module, _ = self.entry_points[name]
+        cmd = [sys.executable, '-X', 'importtime', '-c', self.startup_code(name)]
+        env = dict(os.environ, PYTHONDONTWRITEBYTECODE='1')
+        start = time.perf_counter()
+        proc = subprocess.run(
+            cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+            universal_newlines=True, env=env)
+        wall_ms = (time.perf_counter() - start) * 1000
+        imports = self.parse_importtime(proc.stderr)
+        if module not in imports:
+            raise RuntimeError("Entry point {} failed to start:\n{}".format(
+                name, proc.stderr[-2000:]))
+        return dict(
+            wall_ms=wall_ms,
+            import_ms=imports[module] / 1000,
+            imported=set(imports),
+        )
+
+    def run(self: object) -> dict:
+        results = dict()
+        for name in self.entry_points:
+            samples = [self.run_one(name) for _ in range(self.runs)]
+            deferred = sorted(
+                m for m in samples[0]['imported']
+                if m.split('.')[0] in self.deferred_modules)
+            results[name] = dict(
+                wall_ms=min(s['wall_ms'] for s in samples),
+                import_ms=min(s['import_ms'] for s in samples),
+                eagerly_imported=deferred,
+            )
+        return results
+
+    def check(self: object, results: dict) -> list:
+        failures = list()
+        for name, r in results.items():
+            if r['import_ms'] > self.import_budget_ms:
+                failures.append("{}: import {:.1f} ms > budget {} ms".format(
+                    name, r['import_ms'], self.import_budget_ms))
+            if r['wall_ms'] > self.startup_budget_ms:
+                failures.append("{}: startup {:.1f} ms > budget {} ms".format(
+                    name, r['wall_ms'], self.startup_budget_ms))
+            if r['eagerly_imported']:
+                failures.append("{}: imports {} at startup".format(
+                    name, ', '.join(r['eagerly_imported'])))
+        return failures
+
+    def report(self: object, results: dict, stream=sys.stdout) -> None:
+        stream.write("{:<18} {:>10} {:>10}\n".format(
+            "entry point", "import ms", "startup ms"))
+        for name, r in results.items():
+            stream.write("{:<18} {:>10.1f} {:>10.1f}\n".format(
+                name, r['import_ms'], r['wall_ms']))
+
+    @classmethod
+    def cli(cls):
+        parser = argparse.ArgumentParser(
+            description="Benchmark Machinekit CI tool startup and hot paths")
+
+        parser.add_argument("--runs",
+                            type=int,
+                            default=5,
+                            help="Runs per entry point; best is reported (default 5)")
+        parser.add_argument("--import-budget-ms",
+                            type=float,
+                            help="Max package import time (default {} ms)".format(
+                                cls.import_budget_ms))
+        parser.add_argument("--startup-budget-ms",
+                            type=float,
+                            help="Max '--help' wall time (default {} ms)".format(
+                                cls.startup_budget_ms))
+        parser.add_argument("--json",
+                            metavar="FILE",
+                            help="Write results to JSON file")
+        parser.add_argument("--suite",
+                            choices=["startup", "hotpaths", "all", "fastio"],
+                            default="startup",
+                            help="Benchmarks to run (default: startup); "
+                            "'fastio' builds images and packages with Docker "
+                            "and isn't part of 'all'")
+        parser.add_argument("--sizes",
+                            default="small,medium",
+                            help="Comma-separated synthetic repo sizes for "
+                            "hot path benchmarks, from {} (default: "
+                            "small,medium)".format(
+                                ', '.join(SyntheticRepo.sizes)))
+        parser.add_argument("--compare",
+                            metavar="FILE",
+                            help="Compare hot path results with an earlier "
+                            "JSON results file")
+        parser.add_argument("--path",
+                            default=os.getcwd(),
+                            help="With --suite fastio, package repo to build "
+                            "(default: current directory)")
+        parser.add_argument("--version",
+                            help="With --suite fastio, distro version to build")
+        parser.add_argument("--architecture",
+                            help="With --suite fastio, architecture to build")
+        parser.add_argument("--max-regression",
+                            type=float,
+                            default=1.25,
+                            help="With --compare, fail if any hot path is "
+                            "slower by more than this factor (default 1.25)")
+
+        args = parser.parse_args()
+        output = dict(environment=HotPathBenchmark.environment())
+        failures = list()
+        try:
+            if args.suite in ("startup", "all"):
+                benchmark = cls(runs=args.runs,
+                                import_budget_ms=args.import_budget_ms,
+                                startup_budget_ms=args.startup_budget_ms)
+                results = benchmark.run()
+                benchmark.report(results)
+                output['startup'] = results
+                failures.extend(benchmark.check(results))
+            if args.suite in ("hotpaths", "all"):
+                hot_paths = HotPathBenchmark(
+                    sizes=args.sizes.split(','), runs=args.runs)
+                results = hot_paths.run()
+                hot_paths.report(results)
+                output['hotpaths'] = results
+                if args.compare:
+                    with open(args.compare, 'r') as f:
+                        previous = json.load(f).get('hotpaths', dict())
+                    failures.extend(hot_paths.compare(
+                        previous, results, args.max_regression))
+            if args.suite == "fastio":
+                if not (args.version and args.architecture):
+                    raise ValueError(
+                        "--suite fastio needs --version and --architecture")
+                fast_io = FastIOBenchmark(
+                    args.path, args.version, args.architecture)
+                results = fast_io.run()
+                fast_io.report(results)
+                output['fastio'] = results
+        except (RuntimeError, ValueError, subprocess.CalledProcessError) as e:
+            sys.stderr.write("Error:  {}\n".format(e))
+            sys.exit(1)
+        if args.json:
+            with open(args.json, 'w') as f:
+                json.dump(output, f, indent=2)
+        for failure in failures:
+            sys.stderr.write("FAIL {}\n".format(failure))
+        if failures:
+            sys.exit(1)
+
+
+class SyntheticRepo(object):
+    """Generate a git repository shaped like a package repo, for benchmarks
+
+    Sizes set the number of `debian/` files, the total size of the
+    `dockerBuildContextFiles`, the number of distros and architectures in
+    the build matrix, and the number of package files in an artifact tree
+    beside the repo.
+    """
+    sizes = dict(
+        small=dict(debian_files=100, context_mb=1, distros=3, architectures=2,
+                   packages=50),
+        medium=dict(debian_files=1000, context_mb=10, distros=8,
+                    architectures=4, packages=500),
+        large=dict(debian_files=5000, context_mb=50, distros=20,
+                   architectures=6, packages=2000),
+    )
+    all_architectures = ('amd64', 'arm64', 'armhf', 'i386', 'ppc64el', 's390x')
+    context_file_count = 10
+
+    def __init__(self: object, base_dir: str, size: str):
+        if size not in self.sizes:
+            raise ValueError("Unknown synthetic repo size '{}'".format(size))
+        self.size = size
+        self.params = self.sizes[size]
+        self.path = os.path.join(base_dir, 'repo-{}'.format(size))
+        self.artifact_dir = os.path.join(base_dir, 'artifacts-{}'.format(size))
+
+    @staticmethod
+    def write(path: str, data) -> None:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb' if isinstance(data, bytes) else 'w') as f:
+            f.write(data)
+
+    def settings(self: object) -> str:
+        p = self.params
+        lines = [
+            "package: synthetic",
+            "projectName: Synthetic",
+            "scriptPreCmd: .github/docker/script_pre.sh",
+            "dockerBuildContextFiles:",
+        ]
+        lines += ["  - assets/blob{}.bin".format(i)
+                  for i in range(self.context_file_count // 2)]
+        lines.append("  - assets/blobs")
+        lines.append("osDistros:")
+        for i in range(1, p['distros'] + 1):
+            lines += ["  - baseImage: debian:dist{}".format(i),
+                      "    codename: Dist{}".format(i),
+                      "    vendor: Debian",
+                      "    release: {}".format(i)]
+        lines.append("allowedCombinations:")
+        for i in range(1, p['distros'] + 1):
+            for arch in self.all_architectures[:p['architectures']]:
+                lines += ["  - release: {}".format(i),
+                          "    architecture: {}".format(arch)]
+        return '\n'.join(lines) + '\n'
+
+    def create(self: object) -> None:
+        p = self.params
+        self.write(os.path.join(self.path, '.github', 'debian-distro-settings.yaml'),
+                   self.settings())
+        self.write(os.path.join(self.path, '.github', 'docker', 'script_pre.sh'),
+                   "#!/bin/sh\ntrue\n")
+        self.write(os.path.join(self.path, 'debian', 'control'), (
+            "Source: synthetic\nBuild-Depends: debhelper (>= 10), libfoo-dev\n\n"
+            "Package: synthetic\nArchitecture: any\nDescription: x\n"))
+        self.write(os.path.join(self.path, 'debian', 'changelog'), (
+            "synthetic (1.0-1) unstable; urgency=medium\n\n  * Test\n\n"
+            " -- A <a@example.com>  Mon, 01 Jan 2024 00:00:00 +0000\n"))
+        for i in range(p['debian_files']):
+            self.write(os.path.join(
+                self.path, 'debian', 'patches', 'd{:02d}'.format(i % 50),
+                'patch{}.diff'.format(i)), "--- a\n+++ b\n@@ -{0} +{0} @@\n".format(i) * 20)
+        blob_size = p['context_mb'] * 2**20 // self.context_file_count
+        # Half the payload as single files, half in a directory entry
+        for i in range(self.context_file_count):
+            subdir = 'blobs' if i >= self.context_file_count // 2 else ''
+            self.write(os.path.join(self.path, 'assets', subdir, 'blob{}.bin'.format(i)),
+                       bytes([i]) * blob_size)
+        env = dict(os.environ, GIT_AUTHOR_NAME='Bench', GIT_AUTHOR_EMAIL='bench@example.com',
+                   GIT_COMMITTER_NAME='Bench', GIT_COMMITTER_EMAIL='bench@example.com')
+        for cmd in (['git', 'init', '-q'], ['git', 'add', '-A'],
+                    ['git', 'commit', '-q', '-m', 'Synthetic repo']):
+            subprocess.run(cmd, cwd=self.path, env=env, check=True,
+                           stdout=subprocess.DEVNULL)
+        # Artifact tree as downloaded from CI:  one directory per entry
+        arches = self.all_architectures[:p['architectures']]
+        per_dir = max(1, p['packages'] // (p['distros'] * len(arches)))
+        for i in range(1, p['distros'] + 1):
+            for arch in arches:
+                subdir = os.path.join(self.artifact_dir, 'synthetic-debian-{}-{}-abc-123'.format(
+                    i, arch))
+                for n in range(per_dir):
+                    self.write(os.path.join(subdir, 'pkg{}_1.0-1_{}.deb'.format(n, arch)),
+                               b'x' * 1024)
+
+
+class CloudsmithStandIn(object):
+    """Local HTTP server answering Cloudsmith package list requests with an
+    empty list, so uploads can be planned without the network"""
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = b'[]'
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.send_header('X-Pagination-PageTotal', '1')
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    def __enter__(self: object):
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), self.Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return 'http://127.0.0.1:{}'.format(self.server.server_address[1])
+
+    def __exit__(self: object, *args):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class HotPathBenchmark(object):
+    """Time the CI tools' hot paths in-process against synthetic repos
+
+    Each benchmark runs `runs` times per repo size, with the working
+    directory in the synthetic repo; `docker` is replaced by a no-op script
+    and Cloudsmith by a local HTTP stand-in.  Results are milliseconds.
+    """
+    def __init__(self: object, sizes=('small',), runs=5):
+        self.sizes = list(sizes)
+        self.runs = runs
+
+    @staticmethod
+    def environment() -> dict:
+        try:
+            commit = subprocess.run(
+                ['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(__file__),
+                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                universal_newlines=True).stdout.strip()
+        except OSError:
+            commit = ''
+        return dict(commit=commit, python=platform.python_version(),
+                    machine=platform.machine(), cpus=os.cpu_count(),
+                    time=time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()))
+
+    @staticmethod
+    @contextlib.contextmanager
+    def quiet():
+        # Send the tools' stdout and stderr, including subprocesses', to
+        # /dev/null
+        sys.stdout.flush()
+        sys.stderr.flush()
+        saved = [os.dup(1), os.dup(2)]
+        devnull = os.open(os.devnull, os.O_WRONLY)
+        try:
+            os.dup2(devnull, 1)
+            os.dup2(devnull, 2)
+            yield
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os.dup2(saved[0], 1)
+            os.dup2(saved[1], 2)
+            for fd in saved + [devnull]:
+                os.close(fd)
+
+    def time_calls(self: object, func) -> dict:
+        samples = list()
+        for _ in range(self.runs):
+            with self.quiet():
+                start = time.perf_counter()
+                func()
+                samples.append((time.perf_counter() - start) * 1000)
+        return dict(min_ms=min(samples), median_ms=statistics.median(samples),
+                    runs=len(samples))
+
+    def benchmarks(self: object, repo):
+        # Yield (name, callable) pairs for one synthetic repo
+        from machinekit_ci import script_helpers as helpers
+        from machinekit_ci.containerimage import BuildContainerImage
+        from machinekit_ci.querybuild import Query
+        from machinekit_ci.rundocker import RunDocker
+        from machinekit_ci.cloudsmithupload import CloudsmithUploader
+
+        def settings_load():
+            os.environ['MACHINEKIT_CI_CACHE_DIR'] = ''
+            helpers.DistroSettings(repo.path)
+
+        def settings_load_cached():
+            os.environ['MACHINEKIT_CI_CACHE_DIR'] = self.cache_dir
+            helpers.DistroSettings(repo.path)
+
+        settings = helpers.DistroSettings(repo.path)
+        combinations = list(settings.settings_index)
+
+        def set_os_arch_combination():
+            for c in combinations:
+                settings.set_os_arch_combination(c.os_release, c.architecture)
+
+        def image_hash(mode):
+            def run():
+                image = BuildContainerImage(repo.path, hash_mode=mode)
+                image.set_os_arch_combination(
+                    combinations[0].os_release, combinations[0].architecture)
+                image.generate_image_hash()
+            return run
+
+        def docker_context():
+            image = BuildContainerImage(repo.path)
+            for _ in image.docker_context_cm():
+                pass
+
+        def query_matrix(key):
+            def run():
+                getattr(Query(repo.path, None, None), key)
+            return run
+
+        def rundocker():
+            c = combinations[0]
+            RunDocker(repo.path, c.os_release, c.architecture, True, None,
+                      None, None).run_cmd(['true'])
+
+        uploader = CloudsmithUploader(repo.path, repo.artifact_dir, use_cli=True)
+
+        def walk_packages():
+            list(uploader.walk_package_directory())
+
+        def plan_uploads():
+            planner = CloudsmithUploader(repo.path, repo.artifact_dir)
+            planner.log = lambda message: None
+            planner.select_packages()
+
+        yield 'settings_load', settings_load
+        yield 'settings_load_cached', settings_load_cached
+        yield 'set_os_arch_combination', set_os_arch_combination
+        yield 'generate_image_hash', image_hash('context')
+        yield 'generate_image_hash_semantic', image_hash('semantic')
+        yield 'docker_context_cm', docker_context
+        yield 'query_github_main_matrix', query_matrix('github_main_matrix')
+        yield 'query_github_sharded_matrix', query_matrix('github_sharded_matrix')
+        yield 'rundocker_run_cmd', rundocker
+        yield 'walk_package_directory', walk_packages
+        yield 'cloudsmith_select_packages', plan_uploads
+
+    def stand_in_environment(self: object, base_dir: str, api_host: str) -> dict:
+        bin_dir = os.path.join(base_dir, 'bin')
+        SyntheticRepo.write(os.path.join(bin_dir, 'docker'), "#!/bin/sh\nexit 0\n")
+        os.chmod(os.path.join(bin_dir, 'docker'), 0o755)
+        return dict(
+            PATH=bin_dir + os.pathsep + os.environ.get('PATH', ''),
+            CLOUDSMITH_API_KEY='benchmark', CLOUDSMITH_API_HOST=api_host,
+            CLOUDSMITH_NAMESPACE='benchmark',
+            DOCKER_REGISTRY_URL='https://registry.invalid',
+            DOCKER_REGISTRY_USER='benchmark', DOCKER_REGISTRY_REPO='benchmark')
+
+    def run(self: object) -> dict:
+        results = dict()
+        saved_environ = dict(os.environ)
+        saved_cwd = os.getcwd()
+        base_dir = tempfile.mkdtemp(prefix='mkci-benchmark-')
+        try:
+            with CloudsmithStandIn() as api_host:
+                os.environ.update(self.stand_in_environment(base_dir, api_host))
+                self.cache_dir = os.path.join(base_dir, 'cache')
+                os.environ['MACHINEKIT_CI_CACHE_DIR'] = self.cache_dir
+                for size in self.sizes:
+                    repo = SyntheticRepo(base_dir, size)
+                    repo.create()
+                    # dockerBuildContextFiles are relative to the working dir
+                    os.chdir(repo.path)
+                    for name, func in self.benchmarks(repo):
+                        results.setdefault(name, dict())[size] = self.time_calls(func)
+                        os.environ['MACHINEKIT_CI_CACHE_DIR'] = self.cache_dir
+        finally:
+            os.chdir(saved_cwd)
+            os.environ.clear()
+            os.environ.update(saved_environ)
+            shutil.rmtree(base_dir, ignore_errors=True)
+        return results
+
+    def report(self: object, results: dict, stream=sys.stdout) -> None:
+        stream.write("{:<30} {:>8} {:>10} {:>10}\n".format(
+            "hot path", "size", "min ms", "median ms"))
+        for name, by_size in results.items():
+            for size, r in by_size.items():
+                stream.write("{:<30} {:>8} {:>10.1f} {:>10.1f}\n".format(
+                    name, size, r['min_ms'], r['median_ms']))
+
+    @staticmethod
+    def compare(previous: dict, results: dict, max_regression: float) -> list:
+        # Report min-time ratios against earlier results; return failures
+        failures = list()
+        for name, by_size in results.items():
+            for size, r in by_size.items():
+                old = previous.get(name, dict()).get(size)
+                if not old or not old['min_ms']:
+                    continue
+                ratio = r['min_ms'] / old['min_ms']
+                sys.stdout.write("{:<30} {:>8} {:>9.2f}x\n".format(name, size, ratio))
+                if ratio > max_regression:
+                    failures.append("{} ({}): {:.1f} ms vs {:.1f} ms, {:.2f}x".format(
+                        name, size, r['min_ms'], old['min_ms'], ratio))
+        return failures
+
+
+class FastIOBenchmark(object):
+    """Time image and package builds with and without fast I/O
+
+    Needs Docker and a package repo.  For each mode, the builder image is
+    built from scratch (`docker build --no-cache`), the source is
+    configured, and `buildpackages --build-packages` is timed in the new
+    image.  Both modes use the same image tag, so the last one built stays.
+    """
+    def __init__(self: object, path: str, version: str, architecture: str):
+        self.path = path
+        self.version = version
+        self.architecture = architecture
+
+    def run_mode(self: object, fast_io: bool) -> dict:
+        from machinekit_ci.containerimage import BuildContainerImage
+        from machinekit_ci.rundocker import RunDocker
+        image = BuildContainerImage(self.path, fast_io=fast_io)
+        if not image.set_os_arch_combination(self.version, self.architecture):
+            raise ValueError("No {} {} build in distro settings".format(
+                self.version, self.architecture))
+        start = time.perf_counter()
+        image.build_image(no_cache=True)
+        image_build = time.perf_counter() - start
+
+        rundocker = RunDocker(self.path, self.version, self.architecture,
+                              True, None, None, None, fast_io=fast_io)
+        rundocker.run_cmd(['buildpackages', '--configure-source'])
+        start = time.perf_counter()
+        rundocker.run_cmd(['buildpackages', '--build-packages'])
+        build_packages = time.perf_counter() - start
+        return dict(image_build_s=image_build, build_packages_s=build_packages)
+
+    def run(self: object) -> dict:
+        results = dict(off=self.run_mode(False), on=self.run_mode(True))
+        results['speedup'] = {
+            key: results['off'][key] / results['on'][key]
+            for key in results['off'] if results['on'][key]}
+        return results
+
+    def report(self: object, results: dict, stream=sys.stdout) -> None:
+        stream.write("{:<18} {:>10} {:>10} {:>8}\n".format(
+            "fast I/O", "off s", "on s", "speedup"))
+        for key in ('image_build_s', 'build_packages_s'):
+            stream.write("{:<18} {:>10.1f} {:>10.1f} {:>7.2f}x\n".format(
+                key[:-2], results['off'][key], results['on'][key],
+                results['speedup'].get(key, 0)))
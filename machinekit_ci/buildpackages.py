@@ -38,30 +38,608 @@ Script for building packages for Debian styled distributions using
 __license__ = "LGPL 2.1"
 
 import argparse
-import sh
 import os
 import sys
 import re
+import json
+import time
+import shutil
 import tempfile
+import hashlib
+import copy
+from collections import OrderedDict
 
 import machinekit_ci.script_helpers as helpers
-from debian.changelog import Changelog
-from debian.deb822 import Changes
+
+debian_changelog = helpers.LazyModule('debian.changelog')
+debian_deb822 = helpers.LazyModule('debian.deb822')
+
+
+class BuildProfiler(object):
+    """Time `dpkg-buildpackage` steps from its output as it streams past
+
+    A binary file-like sink passing output on to `target` unchanged.  Lines
+    announcing a `debian/rules` target, a `dh_*` command (or its
+    `override_dh_*` target) or a `dpkg-*` helper end the current step and
+    start the next.  `dpkg-buildpackage` announces commands on stderr and
+    debhelper on stdout, so feed it both streams merged, in order.  Only the
+    current partial line is buffered, so memory use doesn't grow with the
+    build log.
+    """
+    target_re = re.compile(rb'^ (?:fakeroot )?debian/rules (\S+)')
+    step_re = re.compile(
+        rb'^\s+(?:debian/rules )?((?:override_)?dh_[\w-]+)|'
+        rb'^ (dpkg-(?:source|checkbuilddeps|genbuildinfo|genchanges))\b')
+    max_line = 65536
+    # Phase for the summary, by step name without `override_`
+    phases = dict(
+        dh_auto_configure='configure', dh_auto_build='build',
+        dh_auto_test='test', dh_auto_install='install', dh_install='install',
+        dh_strip='strip/dbgsym', dh_dwz='strip/dbgsym',
+        dh_strip_nondeterminism='strip/dbgsym', dh_builddeb='dpkg-deb',
+    )
+
+    def __init__(self: object, target=None, clock=time.monotonic):
+        self.target = target
+        self.clock = clock
+        self.steps = list()
+        self._line = b''
+        self._rules_target = None
+        self._current = None
+        self.start = self.clock()
+        self._begin('(setup)', self.start, time.time())
+
+    def _begin(self: object, name: str, now: float, wall: float) -> None:
+        self._current = dict(
+            target=self._rules_target, step=name,
+            phase=self.phase(name), start=now, wall_start=wall)
+
+    def _end(self: object, now: float) -> None:
+        step = self._current
+        step['seconds'] = now - step.pop('start')
+        self.steps.append(step)
+
+    @classmethod
+    def phase(cls, step: str) -> str:
+        if step.startswith('override_'):
+            step = step[len('override_'):]
+        return cls.phases.get(step, 'other')
+
+    def feed_line(self: object, line: bytes) -> None:
+        match = self.target_re.match(line)
+        if match:
+            self._rules_target = match.group(1).decode(errors='replace')
+            name = 'debian/rules ' + self._rules_target
+        else:
+            match = self.step_re.match(line)
+            if not match:
+                return
+            name = (match.group(1) or match.group(2)).decode(errors='replace')
+        now = self.clock()
+        self._end(now)
+        self._begin(name, now, time.time())
+
+    def write(self: object, data: bytes):
+        if self.target is not None:
+            self.target.write(data)
+        lines = (self._line + data).split(b'\n')
+        self._line = lines.pop()[-self.max_line:]
+        for line in lines:
+            self.feed_line(line)
+
+    def flush(self: object):
+        if self.target is not None:
+            self.target.flush()
+
+    def finish(self: object) -> None:
+        if self._line:
+            self.feed_line(self._line)
+            self._line = b''
+        if self._current is not None:
+            self._end(self.clock())
+            self._current = None
+
+    @property
+    def total_seconds(self: object) -> float:
+        return sum(s['seconds'] for s in self.steps)
+
+    def phase_totals(self: object) -> dict:
+        totals = dict()
+        for step in self.steps:
+            totals[step['phase']] = totals.get(step['phase'], 0.0) + step['seconds']
+        # OrderedDict:  plain dicts don't keep order before Python 3.7
+        return OrderedDict(sorted(totals.items(), key=lambda i: -i[1]))
+
+    def as_dict(self: object) -> dict:
+        return dict(total_seconds=self.total_seconds,
+                    phases=self.phase_totals(),
+                    steps=[dict(s) for s in self.steps])
+
+    def report(self: object, stream=None, limit=15) -> None:
+        # Print phase totals and the slowest steps
+        stream = stream or sys.stderr
+        total = self.total_seconds or 1.0
+        stream.write("Build profile ({:.1f} s):\n".format(self.total_seconds))
+        for phase, seconds in self.phase_totals().items():
+            stream.write("  {:>9.1f} s {:>5.1f}%  {}\n".format(
+                seconds, 100 * seconds / total, phase))
+        stream.write("Slowest steps:\n")
+        for step in sorted(self.steps, key=lambda s: -s['seconds'])[:limit]:
+            stream.write("  {:>9.1f} s {:>5.1f}%  {} ({})\n".format(
+                step['seconds'], 100 * step['seconds'] / total, step['step'],
+                step['target'] or '-'))
+
+    def trace(self: object, tracer) -> None:
+        # Add the steps to the job trace, if tracing
+        if not tracer.enabled:
+            return
+        parent_id = tracer.current_span_id()
+        tracer.write_events([tracer.event(
+            s['step'], 'build-step', s['wall_start'],
+            s['wall_start'] + s['seconds'],
+            dict(phase=s['phase'], target=s['target'], parent_id=parent_id))
+            for s in self.steps])
+
+
+# `dpkg-deb` wrapper installed first in $PATH during builds:  sets
+# compression by package type and logs time and size of each package
+DPKG_DEB_WRAPPER = """#!/usr/bin/env python3
+import json, os, subprocess, sys, time
+REAL_DPKG_DEB = {real!r}
+FLAGS = {flags!r}
+LOG = {log!r}
+
+args = sys.argv[1:]
+build = [i for i, a in enumerate(args) if a in ('-b', '--build')]
+if not build or len(args) <= build[0] + 1:
+    os.execv(REAL_DPKG_DEB, [REAL_DPKG_DEB] + args)
+root = args[build[0] + 1]
+control = dict()
+with open(os.path.join(root, 'DEBIAN', 'control')) as f:
+    for line in f:
+        key, sep, value = line.partition(':')
+        if sep and not line[0].isspace():
+            control[key] = value.strip()
+if (control.get('Auto-Built-Package') == 'debug-symbols'
+        or control.get('Package', '').endswith('-dbgsym')):
+    package_type = 'dbgsym'
+elif control.get('Architecture') == 'all':
+    package_type = 'indep'
+else:
+    package_type = 'default'
+profile, flags = FLAGS.get(package_type, FLAGS['default'])
+if flags:
+    # Replace compression options given by debhelper
+    kept, skip = list(), False
+    for a in args:
+        if skip:
+            skip = False
+        elif a in ('-z', '-Z', '-S'):
+            skip = True
+        elif not (a[:2] in ('-z', '-Z', '-S') or a.startswith('--compress')):
+            kept.append(a)
+    args = flags + kept
+start = time.monotonic()
+status = subprocess.call([REAL_DPKG_DEB] + args)
+seconds = time.monotonic() - start
+dest = args[args.index(root) + 1] if args.index(root) + 1 < len(args) else '.'
+if os.path.isdir(dest):
+    dest = os.path.join(dest, '{{}}_{{}}_{{}}.deb'.format(
+        control.get('Package'), control.get('Version', '').split(':')[-1],
+        control.get('Architecture')))
+with open(LOG, 'a') as f:
+    f.write(json.dumps(dict(
+        package=control.get('Package'), type=package_type, profile=profile,
+        flags=flags, seconds=seconds, exit_code=status,
+        installed_bytes=int(control.get('Installed-Size', 0)) * 1024,
+        bytes=os.path.getsize(dest) if os.path.exists(dest) else None)) + '\\n')
+sys.exit(status)
+"""
+
+
+class CompressionProfiles(object):
+    """Compression for `dpkg-deb` by package type
+
+    Package types are `dbgsym` (debug symbol packages), `indep` (arch `all`)
+    and `default` (all others, and types not configured).  Profiles:
+
+    - `fast`:  zstd level 3, or gzip level 1 where the release's `dpkg-deb`
+      has no zstd
+    - `default`:  the `dpkg-deb` default, xz level 6 on current releases
+    - `max`:  xz level 9, extreme strategy
+
+    `dpkg-deb` in the build environment is wrapped to apply these and to log
+    the time and size of each package built.
+    """
+    profiles = ('fast', 'default', 'max')
+    package_types = ('default', 'dbgsym', 'indep')
+
+    def __init__(self: object, settings: dict):
+        for package_type, profile in settings.items():
+            if package_type not in self.package_types:
+                raise ValueError("Unknown package type '{}'; use one of {}".format(
+                    package_type, ', '.join(self.package_types)))
+            if profile not in self.profiles:
+                raise ValueError("Unknown compression profile '{}'; use one "
+                                 "of {}".format(profile, ', '.join(self.profiles)))
+        self.settings = dict(settings)
+        self.settings.setdefault('default', 'default')
+
+    @classmethod
+    def parse_args(cls, args: list) -> dict:
+        # `PROFILE` (for all types) or `TYPE=PROFILE` command line values,
+        # later values winning
+        settings = dict()
+        for arg in args or []:
+            package_type, sep, profile = arg.rpartition('=')
+            if sep:
+                settings[package_type] = profile
+            else:
+                settings.update((t, profile) for t in cls.package_types)
+        return settings
+
+    @property
+    def is_default(self: object) -> bool:
+        return set(self.settings.values()) == {'default'}
+
+    @staticmethod
+    def flags(profile: str, has_zstd: bool) -> list:
+        if profile == 'fast':
+            return ['-Zzstd', '-z3'] if has_zstd else ['-Zgzip', '-z1']
+        if profile == 'max':
+            return ['-Zxz', '-z9', '-Sextreme']
+        return []
+
+    def write_wrapper(self: object, directory: str, real_dpkg_deb: str,
+                      has_zstd: bool, log_path: str) -> None:
+        flags = {t: (p, self.flags(p, has_zstd)) for t, p in self.settings.items()}
+        path = os.path.join(directory, 'dpkg-deb')
+        with open(path, 'w') as f:
+            f.write(DPKG_DEB_WRAPPER.format(
+                real=real_dpkg_deb, flags=flags, log=log_path))
+        os.chmod(path, 0o755)
+
+    @staticmethod
+    def summarize(log_path: str) -> dict:
+        # Totals by package type and profile from the wrapper's log
+        totals = dict()
+        if not os.path.exists(log_path):
+            return totals
+        with open(log_path, 'r') as f:
+            for line in f:
+                r = json.loads(line)
+                key = "{} {}".format(r['type'], r['profile'])
+                t = totals.setdefault(key, dict(
+                    type=r['type'], profile=r['profile'], flags=r['flags'],
+                    packages=0, seconds=0.0, bytes=0, installed_bytes=0))
+                t['packages'] += 1
+                t['seconds'] += r['seconds']
+                t['bytes'] += r['bytes'] or 0
+                t['installed_bytes'] += r['installed_bytes']
+        return totals
+
+    @staticmethod
+    def report(totals: dict, stream=None) -> None:
+        stream = stream or sys.stderr
+        stream.write("Package compression:\n")
+        for t in totals.values():
+            stream.write(
+                "  {type:<8} {profile:<8} {packages:>4} pkgs {seconds:>8.1f} s "
+                "{mib:>9.1f} MiB  ratio {ratio:.3f}  {flags}\n".format(
+                    mib=t['bytes'] / 2**20,
+                    ratio=t['bytes'] / (t['installed_bytes'] or 1),
+                    **dict(t, flags=' '.join(t['flags']) or '(dpkg-deb default)')))
+
+
+class SourcePackageGraph(object):
+    """Build order of several source packages from their `debian/control`
+
+    A source package depends on another when one of its `Build-Depends*`
+    names one of the other's binary packages.  `waves()` groups the sources
+    so each only depends on sources in earlier waves; sources within a wave
+    may be built in parallel.
+    """
+    build_depends_fields = (
+        'Build-Depends', 'Build-Depends-Arch', 'Build-Depends-Indep')
+
+    def __init__(self: object, source_dirs: list):
+        self.source_dirs = list(source_dirs)
+        self.names = dict()
+        self.binaries = dict()
+        self.build_depends = dict()
+        for source_dir in self.source_dirs:
+            self.read_control(source_dir)
+
+    def read_control(self: object, source_dir: str) -> None:
+        path = os.path.join(source_dir, 'debian', 'control')
+        if not os.path.exists(path):
+            raise ValueError("No debian/control in source dir {}".format(
+                source_dir))
+        with open(path, 'r') as f:
+            paragraphs = list(debian_deb822.Deb822.iter_paragraphs(
+                f, use_apt_pkg=False))
+        if not paragraphs or 'Source' not in paragraphs[0]:
+            raise ValueError("No Source paragraph in {}".format(path))
+        self.names[source_dir] = paragraphs[0]['Source']
+        self.binaries[source_dir] = set(
+            p['Package'] for p in paragraphs[1:] if 'Package' in p)
+        depends = set()
+        for field in self.build_depends_fields:
+            if not paragraphs[0].get(field, '').strip():
+                continue
+            relations = debian_deb822.PkgRelation.parse_relations(
+                paragraphs[0][field])
+            depends.update(
+                alt['name'] for rel in relations for alt in rel)
+        self.build_depends[source_dir] = depends
+
+    def dependencies(self: object, source_dir: str) -> set:
+        # Other source dirs whose binaries `source_dir` build-depends on
+        return set(d for d in self.source_dirs if d != source_dir
+                   and self.binaries[d] & self.build_depends[source_dir])
+
+    def waves(self: object) -> list:
+        remaining = {d: self.dependencies(d) for d in self.source_dirs}
+        waves = list()
+        while remaining:
+            wave = [d for d in self.source_dirs
+                    if d in remaining and not remaining[d]]
+            if not wave:
+                raise ValueError("Build dependency cycle between {}".format(
+                    ', '.join(self.names[d] for d in remaining)))
+            for d in wave:
+                del remaining[d]
+            for deps in remaining.values():
+                deps.difference_update(wave)
+            waves.append(wave)
+        return waves
+
+
+class LocalAptRepo(object):
+    """Flat file-based apt repository for packages built earlier in a job
+
+    Packages are copied in with `add()`, which appends their stanzas to the
+    `Packages` index and rewrites the small `Release` file, so the index
+    grows with each build instead of being regenerated by scanning every
+    package.  `Packages` is read once to learn what's already indexed.
+    """
+    list_name = 'mk-ci-local-repo.list'
+
+    def __init__(self: object, path: str, runner=None):
+        self.path = os.path.abspath(path)
+        self.runner = runner or helpers.CommandRunner.default()
+        self.enabled = False
+        os.makedirs(self.path, exist_ok=True)
+        os.chmod(self.path, 0o755)  # Readable by apt's sandbox user
+        self.indexed = dict()
+        if os.path.exists(self.packages_path):
+            with open(self.packages_path, 'r') as f:
+                for stanza in debian_deb822.Packages.iter_paragraphs(
+                        f, use_apt_pkg=False):
+                    self.indexed[os.path.basename(stanza['Filename'])] = \
+                        stanza['SHA256']
+        else:
+            open(self.packages_path, 'w').close()
+            self.write_release()
+
+    @property
+    def packages_path(self: object):
+        return os.path.join(self.path, 'Packages')
+
+    @property
+    def release_path(self: object):
+        return os.path.join(self.path, 'Release')
+
+    @property
+    def sources_line(self: object):
+        return "deb [trusted=yes] file:{} ./\n".format(self.path)
+
+    @staticmethod
+    def file_hashes(path: str) -> dict:
+        hashes = dict(MD5sum=hashlib.md5(), SHA1=hashlib.sha1(),
+                      SHA256=hashlib.sha256())
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(2**20), b''):
+                for h in hashes.values():
+                    h.update(block)
+        return {k: h.hexdigest() for k, h in hashes.items()}
+
+    def add(self: object, paths: list) -> list:
+        # Copy in and index new or changed `.deb` files; return those added
+        added = list()
+        for path in paths:
+            if not path.endswith('.deb'):
+                continue
+            name = os.path.basename(path)
+            hashes = self.file_hashes(path)
+            if self.indexed.get(name) == hashes['SHA256']:
+                continue
+            if name in self.indexed:
+                self.remove_stanza(name)
+            shutil.copy2(path, os.path.join(self.path, name))
+            control = self.runner.output(['dpkg-deb', '-f', path]).rstrip('\n')
+            with open(self.packages_path, 'a') as f:
+                f.write("{}\nFilename: ./{}\nSize: {}\n{}\n\n".format(
+                    control, name, os.path.getsize(path),
+                    '\n'.join('{}: {}'.format(k, v) for k, v in hashes.items())))
+            self.indexed[name] = hashes['SHA256']
+            added.append(name)
+        if added:
+            self.write_release()
+        return added
+
+    def remove_stanza(self: object, name: str) -> None:
+        # A package rebuilt with the same version replaces the old one
+        with open(self.packages_path, 'r') as f:
+            stanzas = [
+                s for s in debian_deb822.Packages.iter_paragraphs(
+                    f, use_apt_pkg=False)
+                if os.path.basename(s['Filename']) != name]
+        with open(self.packages_path, 'w') as f:
+            for stanza in stanzas:
+                f.write(stanza.dump() + '\n')
+        del self.indexed[name]
+
+    def write_release(self: object) -> None:
+        size = os.path.getsize(self.packages_path)
+        hashes = self.file_hashes(self.packages_path)
+        with open(self.release_path, 'w') as f:
+            f.write("Origin: machinekit_ci\nLabel: Local build\nDate: {}\n".format(
+                time.strftime('%a, %d %b %Y %H:%M:%S UTC', time.gmtime())))
+            for field, key in (('MD5Sum', 'MD5sum'), ('SHA1', 'SHA1'),
+                               ('SHA256', 'SHA256')):
+                f.write("{}:\n {} {} Packages\n".format(field, hashes[key], size))
+
+    @property
+    def apt_list_path(self: object):
+        return os.path.join('/etc/apt/sources.list.d', self.list_name)
+
+    def enable(self: object) -> None:
+        # Add the repo to apt's sources and update only its index
+        list_path = os.path.join(self.path, self.list_name)
+        with open(list_path, 'w') as f:
+            f.write(self.sources_line)
+        self.runner.run(['sudo', 'cp', list_path, self.apt_list_path])
+        self.enabled = True
+        self.runner.run(
+            ['sudo', 'apt-get', 'update',
+             '-o', 'Dir::Etc::SourceList={}'.format(list_path),
+             '-o', 'Dir::Etc::SourceParts=-',
+             '-o', 'APT::Get::List-Cleanup=0'])
+
+    def disable(self: object) -> None:
+        # Remove the repo from apt's sources, so a removed repo doesn't
+        # break later `apt-get update` runs
+        if not self.enabled:
+            return
+        try:
+            self.runner.run(['sudo', 'rm', '-f', self.apt_list_path])
+            self.enabled = False
+        except helpers.CommandError as e:
+            sys.stderr.write("Can't remove {}:  {}\n".format(
+                self.apt_list_path, e))
+
+
+class SourceCache(object):
+    """Configured source trees shared by the builds of a matrix
+
+    Entries hold the `configureSourceOutputs` paths from the source tree and
+    the orig tarballs, relative to its parent directory, as left by
+    `configureSourceCmd`.  They are keyed by the caller, from the upstream
+    version and the source tree contents.  An entry directory is renamed
+    into place once complete, so builds running at once never see a partial
+    entry; only the newest `max_entries` are kept.
+    """
+    max_entries = 5
+
+    def __init__(self: object, cache_dir: str):
+        self.cache_dir = cache_dir
+
+    def entry_dir(self: object, key: str) -> str:
+        return os.path.join(self.cache_dir, key)
+
+    def restore(self: object, key: str, source_root: str, parent_dir: str):
+        # Copy a cached entry's files back; return its manifest or None
+        entry_dir = self.entry_dir(key)
+        manifest_path = os.path.join(entry_dir, 'manifest.json')
+        if not os.path.exists(manifest_path):
+            return None
+        with open(manifest_path, 'r') as f:
+            manifest = json.load(f)
+        for path in manifest['outputs']:
+            self.copy(os.path.join(entry_dir, 'outputs', path),
+                      os.path.join(source_root, path))
+        for path in manifest['orig']:
+            self.copy(os.path.join(entry_dir, 'orig', path),
+                      os.path.join(parent_dir, path))
+        os.utime(entry_dir)  # Keep recently used entries when pruning
+        return manifest
+
+    def store(self: object, key: str, source_root: str, outputs: list,
+              parent_dir: str, orig: list) -> None:
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmp_dir = tempfile.mkdtemp(prefix='.tmp-', dir=self.cache_dir)
+        try:
+            stored = list()
+            for path in outputs:
+                if os.path.lexists(os.path.join(source_root, path)):
+                    self.copy(os.path.join(source_root, path),
+                              os.path.join(tmp_dir, 'outputs', path))
+                    stored.append(path)
+            for path in orig:
+                self.copy(os.path.join(parent_dir, path),
+                          os.path.join(tmp_dir, 'orig', path))
+            with open(os.path.join(tmp_dir, 'manifest.json'), 'w') as f:
+                json.dump(dict(outputs=stored, orig=orig, time=time.time()),
+                          f, indent=2)
+            try:
+                os.rename(tmp_dir, self.entry_dir(key))
+            except OSError:
+                pass  # Stored by another build meanwhile
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        self.prune()
+
+    @staticmethod
+    def copy(src: str, dest: str) -> None:
+        # Copy a file, symlink or directory tree, replacing `dest`
+        os.makedirs(os.path.dirname(dest) or '.', exist_ok=True)
+        if os.path.isdir(dest) and not os.path.islink(dest):
+            shutil.rmtree(dest)
+        elif os.path.lexists(dest):
+            os.unlink(dest)
+        if os.path.isdir(src) and not os.path.islink(src):
+            shutil.copytree(src, dest, symlinks=True)
+        else:
+            shutil.copy2(src, dest, follow_symlinks=False)
+
+    def prune(self: object) -> None:
+        entries = sorted(
+            (os.path.join(self.cache_dir, name)
+             for name in os.listdir(self.cache_dir)
+             if not name.startswith('.')),
+            key=os.path.getmtime, reverse=True)
+        for entry_dir in entries[self.max_entries:]:
+            shutil.rmtree(entry_dir, ignore_errors=True)
 
 
 class BuildPackages(helpers.DistroSettings):
-    def __init__(self: object, path, architecture):
+    # Free space wanted in the build dir, as a multiple of the source tree
+    build_dir_space_factor = 4
+
+    def __init__(self: object, path, architecture, profile=False,
+                 profile_path=None, build_dir=None, compression=None,
+                 build_indep=None, local_repo=None, parallel_builds=None,
+                 source_cache=None):
         super(BuildPackages, self).__init__(path)
         self.architecture = architecture
+        self._source_dir = None
+        self._source_cache = source_cache
+        # With several `sourceDirs`:  apt repo dir for built packages (default
+        # temporary) and the most sources to build at once (default all in
+        # a wave)
+        self.local_repo = local_repo
+        self.parallel_builds = parallel_builds
+        self._build_indep = build_indep
+        self.build_env = None
+        # Compression by package type:  `packageCompression` config key,
+        # overridden by constructor
+        self.compression = CompressionProfiles(dict(
+            self.distro_settings.get('packageCompression', None) or dict(),
+            **(compression or dict())))
+        self.profile = profile or profile_path is not None
+        self._profile_path = profile_path
+        self.build_dir = build_dir
         self.architecture_can_be_build()
-        sys.stderr.write("Package directory:  {}\n".format(self.source_dir))
+        sys.stderr.write("Package directory:  {}\n".format(
+            ', '.join(self.source_dirs)))
         sys.stderr.write("Host architecture:  {}\n".format(self.architecture))
 
     def architecture_can_be_build(self: object) -> None:
-        build_architectures = sh.dpkg(
-            "--print-foreign-architectures", _tty_out=False).strip().split()
-        build_architectures.append(sh.dpkg("--print-architecture",
-                                           _tty_out=False).strip())
+        build_architectures = self.runner.output(
+            ["dpkg", "--print-foreign-architectures"]).strip().split()
+        build_architectures.append(self.runner.output(
+            ["dpkg", "--print-architecture"]).strip())
         if self.architecture not in build_architectures:
             raise ValueError(
                 "Host architecture {} cannot be built.".format(
@@ -72,42 +650,463 @@ class BuildPackages(helpers.DistroSettings):
             sys.stderr.write("No configureSourceCmd specified; doing nothing\n")
             return
         self.assert_parent_dir_writable() # May write orig.tar.gz file
+        cache = self.source_cache
+        if cache is not None:
+            key = self.source_cache_key()
+            manifest = cache.restore(key, self.normalized_path, self.parent_dir)
+            if manifest is not None:
+                sys.stderr.write(
+                    "Restored configured source from cache {}:  {}\n".format(
+                        cache.entry_dir(key),
+                        ', '.join(manifest['outputs'] + manifest['orig'])))
+                return
         sys.stderr.write("Running configureSourceCmd '{}':\n".format(self.configure_src_cmd))
         try:
-            sh.bash('-c', self.configure_src_cmd,
-                    _out=sys.stdout.buffer,
-                    _err=sys.stderr.buffer,
-                    _cwd=self.normalized_path)
-        except sh.ErrorReturnCode as e:
+            self.runner.run(['bash', '-c', self.configure_src_cmd],
+                            cwd=self.normalized_path)
+        except helpers.CommandError as e:
             message = "Configure source command '{}' failed:\n{}".format(
                 self.configure_src_cmd, e)
             raise ValueError(message)
+        if cache is not None:
+            cache.store(key, self.normalized_path, self.configure_src_outputs,
+                        self.parent_dir, self.orig_tarballs())
+            sys.stderr.write("Configured source stored in cache {}\n".format(
+                cache.entry_dir(key)))
+
+    @property
+    def configure_src_outputs(self: object) -> list:
+        # Paths `configureSourceCmd` writes in the source tree, relative to
+        # its root
+        return [os.path.normpath(p) for p in
+                self.distro_settings.get('configureSourceOutputs', None) or []]
+
+    @property
+    def source_cache(self: object):
+        # Cache of configured sources, if `configureSourceOutputs` is set:
+        # constructor argument, else `$MACHINEKIT_CI_SOURCE_CACHE`, else in
+        # the parent directory, mounted in builder containers; empty to
+        # disable
+        if not self.configure_src_outputs:
+            return None
+        cache_dir = self._source_cache
+        if cache_dir is None:
+            cache_dir = os.environ.get('MACHINEKIT_CI_SOURCE_CACHE', None)
+        if cache_dir is None:
+            cache_dir = os.path.join(self.parent_dir, '.mk-ci-source-cache')
+        return SourceCache(cache_dir) if cache_dir else None
+
+    def source_cache_key(self: object) -> str:
+        # Hash of the upstream versions and of the tracked files, as staged
+        # plus unstaged changes; `configureSourceOutputs` only count as
+        # staged, since `configureSourceCmd` changes them in the work tree
+        key = hashlib.sha1("{}\n{}\n".format(
+            self.configure_src_cmd, self.configure_src_outputs).encode())
+        for build in self.source_builds():
+            key.update("{}\n".format(
+                build.staged_changelog[0].version.upstream_version).encode())
+        key.update(self.runner.output(
+            ['git', 'ls-files', '--stage', '-z'], cwd=self.normalized_path
+        ).encode())
+        modified = self.runner.output(
+            ['git', 'ls-files', '--modified', '-z'], cwd=self.normalized_path)
+        for path in sorted(set(p for p in modified.split('\0') if p)):
+            if any(path == o or path.startswith(o + '/')
+                   for o in self.configure_src_outputs):
+                continue
+            full_path = os.path.join(self.normalized_path, path)
+            key.update(path.encode() + b'\0')
+            if os.path.isfile(full_path):
+                with open(full_path, 'rb') as f:
+                    key.update(hashlib.sha1(f.read()).digest())
+        return key.hexdigest()
+
+    def orig_tarballs(self: object) -> list:
+        # Orig tarballs of all source packages, relative to the parent
+        # directory
+        paths = list()
+        for build in self.source_builds():
+            orig_prefix = "{}_{}.orig".format(
+                build.package_name, build.package_version.upstream_version)
+            paths.extend(
+                os.path.relpath(os.path.join(build.source_parent_dir, name),
+                                self.parent_dir)
+                for name in sorted(os.listdir(build.source_parent_dir))
+                if name.startswith(orig_prefix))
+        return paths
+
+    @property
+    def source_dir(self: object):
+        # The source dir of one of several `sourceDirs`, else as configured
+        if self._source_dir is not None:
+            return self._source_dir
+        return super(BuildPackages, self).source_dir
+
+    def for_source(self: object, source_dir: str):
+        # Copy of this object building the source package in `source_dir`
+        build = copy.copy(self)
+        build._source_dir = source_dir
+        return build
+
+    def source_builds(self: object) -> list:
+        # One object per source package
+        if self._source_dir is not None or len(self.source_dirs) == 1:
+            return [self]
+        return [self.for_source(d) for d in self.source_dirs]
+
+    @property
+    def build_indep(self: object) -> bool:
+        # Also build `Architecture: all` packages; from constructor, else
+        # whether this is the release's indep architecture
+        if self._build_indep is not None:
+            return self._build_indep
+        os_release = self.read_os_release()
+        release = os_release.get("VERSION_ID", os_release.get("VERSION_CODENAME"))
+        return self.indep_architecture(release) == self.architecture
 
     def build_packages(self: object):
         self.assert_parent_dir_writable()
+        wrapper_dir = None
+        if not self.compression.is_default:
+            wrapper_dir = tempfile.mkdtemp(prefix='mk-ci-dpkg-deb-')
+            self.setup_compression(wrapper_dir)
+        try:
+            if len(self.source_builds()) > 1:
+                self.build_source_packages()
+            else:
+                self.build_packages_timed()
+        finally:
+            if wrapper_dir is not None:
+                self.report_compression()
+                shutil.rmtree(wrapper_dir, ignore_errors=True)
+
+    def setup_compression(self: object, wrapper_dir: str) -> None:
+        # Put the `dpkg-deb` wrapper first in the build's $PATH
+        real_dpkg_deb = shutil.which('dpkg-deb')
+        if real_dpkg_deb is None:
+            raise ValueError("dpkg-deb not found")
+        has_zstd = 'zstd' in self.runner.output([real_dpkg_deb, '--help'])
+        self.compression_log = os.path.join(wrapper_dir, 'compression.jsonl')
+        self.compression.write_wrapper(
+            wrapper_dir, real_dpkg_deb, has_zstd, self.compression_log)
+        self.build_env = dict(os.environ, PATH=os.pathsep.join(
+            [wrapper_dir, os.environ.get('PATH', os.defpath)]))
+        sys.stderr.write("Package compression:  {}{}\n".format(
+            ', '.join('{} {}'.format(t, p)
+                      for t, p in sorted(self.compression.settings.items())),
+            '' if has_zstd else ' (no zstd in this release; fast uses gzip)'))
+
+    @property
+    def compression_report_path(self: object):
+        return self.changes_file_path[:-len(".changes")] + ".compression.json"
+
+    def report_compression(self: object) -> None:
+        totals = CompressionProfiles.summarize(self.compression_log)
+        if not totals:
+            return
+        CompressionProfiles.report(totals)
+        with open(self.compression_report_path, "w") as f:
+            json.dump(list(totals.values()), f, indent=2)
+
+    def build_packages_timed(self: object):
+        start = time.monotonic()
+        build_root = self.make_build_root()
+        mode = 'disk'
+        if build_root is not None:
+            try:
+                self.build_in_build_root(build_root)
+                mode = 'tmpfs'
+            except (ValueError, OSError):
+                if not self.build_root_full(build_root):
+                    raise
+                sys.stderr.write(
+                    "Build failed with {} full; building on disk\n".format(
+                        self.build_dir))
+                shutil.rmtree(build_root, ignore_errors=True)
+                build_root = None
+                start = time.monotonic()
+            finally:
+                if build_root is not None:
+                    shutil.rmtree(build_root, ignore_errors=True)
+        if mode == 'disk':
+            self.run_dpkg_buildpackage(self.source_dir)
+        self.record_build_time(mode, time.monotonic() - start)
+        self.write_build_target()
+
+    def build_source_packages(self: object) -> None:
+        # Build several source packages in waves by build dependencies,
+        # publishing each wave's packages to a local apt repo for the next
+        graph = SourcePackageGraph(self.source_dirs)
+        waves = graph.waves()
+        for n, wave in enumerate(waves):
+            sys.stderr.write("Build wave {}:  {}\n".format(
+                n + 1, ', '.join(graph.names[d] for d in wave)))
+        repo_dir = self.local_repo or tempfile.mkdtemp(prefix='mk-ci-apt-repo-')
+        repo = LocalAptRepo(repo_dir, self.runner)
+        try:
+            for n, wave in enumerate(waves):
+                with self.tracer.span('build wave {}'.format(n + 1),
+                                      category='build'):
+                    builds = [self.for_source(d) for d in wave]
+                    if n > 0:
+                        repo.enable()
+                    for build in builds:
+                        build.install_build_deps()
+                    self.build_concurrently(builds)
+                    for build in builds:
+                        added = repo.add(build.get_package_list())
+                        sys.stderr.write("Added {} packages from {} to {}\n".format(
+                            len(added), graph.names[build.source_dir], repo.path))
+        finally:
+            repo.disable()
+            if self.local_repo is None:
+                shutil.rmtree(repo_dir, ignore_errors=True)
+
+    def build_concurrently(self: object, builds: list) -> None:
+        # Run builds in parallel; raise the first error after all finish
+        if len(builds) == 1:
+            builds[0].build_packages_timed()
+            return
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(
+                max_workers=self.parallel_builds or len(builds)) as executor:
+            futures = [executor.submit(b.build_packages_timed) for b in builds]
+        errors = [f.exception() for f in futures if f.exception() is not None]
+        if errors:
+            raise errors[0]
+
+    def install_build_deps(self: object) -> None:
+        # Install build deps missing from the image, e.g. from the local
+        # repo, with `mk-build-deps` as in the Dockerfile
+        check = ['dpkg-checkbuilddeps', '-a', self.architecture]
+        if not self.build_indep:
+            check.append('-B')
+        try:
+            self.runner.output(check, cwd=self.source_dir)
+            return
+        except helpers.CommandError:
+            sys.stderr.write("Installing build deps for {}\n".format(
+                self.package_name))
+        build_arch = self.runner.output(
+            ['dpkg-architecture', '-qDEB_BUILD_ARCH']).strip()
+        work_dir = tempfile.mkdtemp(prefix='mk-ci-build-deps-')
+        try:
+            self.runner.run(
+                ['sudo', 'mk-build-deps', '--build-arch={}'.format(build_arch),
+                 '--host-arch={}'.format(self.architecture), '-ir', '-t',
+                 'apt-get -o Debug::pkgProblemResolver=yes '
+                 '--no-install-recommends -y',
+                 os.path.join(self.source_dir, 'debian', 'control')],
+                cwd=work_dir)
+        except helpers.CommandError as e:
+            raise ValueError("Build deps for {} cannot be installed:\n{}".format(
+                self.package_name, e))
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    @staticmethod
+    def tree_size(path: str) -> int:
+        total = 0
+        for root, dirs, files in os.walk(path):
+            for name in files:
+                try:
+                    total += os.lstat(os.path.join(root, name)).st_size
+                except OSError:
+                    pass
+        return total
+
+    def make_build_root(self: object):
+        # New directory in the build dir, or None to build on disk
+        if not self.build_dir:
+            return None
+        if not os.path.isdir(self.build_dir):
+            sys.stderr.write("Build dir {} missing; building on disk\n".format(
+                self.build_dir))
+            return None
+        stat = os.statvfs(self.build_dir)
+        free = stat.f_bavail * stat.f_frsize
+        needed = self.tree_size(self.source_dir) * self.build_dir_space_factor
+        if free < needed:
+            sys.stderr.write(
+                "Build dir {} has {} MiB free, want {} MiB; building on "
+                "disk\n".format(self.build_dir, free // 2**20, needed // 2**20))
+            return None
+        return tempfile.mkdtemp(prefix='mk-ci-build-', dir=self.build_dir)
+
+    @staticmethod
+    def build_root_full(build_root: str) -> bool:
+        # Whether a failed build likely ran out of space
+        stat = os.statvfs(build_root)
+        free = stat.f_bavail * stat.f_frsize
+        return free < max(stat.f_blocks * stat.f_frsize // 20, 64 * 2**20)
+
+    def build_in_build_root(self: object, build_root: str) -> None:
+        # Copy the source tree in, build, and copy back only the files
+        # listed in the .changes file
+        start = time.monotonic()
+        build_source_dir = os.path.join(
+            build_root, os.path.basename(self.source_dir))
+        shutil.copytree(self.source_dir, build_source_dir, symlinks=True)
+        orig_prefix = "{}_{}.orig".format(
+            self.package_name, self.package_version.upstream_version)
+        for name in os.listdir(self.source_parent_dir):
+            if name.startswith(orig_prefix):
+                os.symlink(os.path.join(self.source_parent_dir, name),
+                           os.path.join(build_root, name))
+        copy_in = time.monotonic() - start
+
+        self.run_dpkg_buildpackage(build_source_dir)
+
+        start = time.monotonic()
+        changes_path = os.path.join(
+            build_root, os.path.basename(self.changes_file_path))
+        with open(changes_path, "r") as f:
+            changes = debian_deb822.Changes(f)
+        for name in [entry["name"] for entry in changes["Files"]] + [
+                os.path.basename(changes_path)]:
+            shutil.copy2(os.path.join(build_root, name), self.source_parent_dir)
+        sys.stderr.write(
+            "Built in {}:  copy in {:.1f} s, copy out {:.1f} s\n".format(
+                build_root, copy_in, time.monotonic() - start))
+
+    @property
+    def build_times_path(self: object):
+        return os.path.join(self.source_parent_dir, ".mk-ci-build-times.jsonl")
+
+    def record_build_time(self: object, mode: str, seconds: float) -> None:
+        # Append this build's time and compare with the last build in the
+        # other mode
+        record = dict(package=self.package_name,
+                      version=str(self.package_version),
+                      architecture=self.architecture, mode=mode,
+                      seconds=round(seconds, 3), time=time.time())
+        previous = None
+        if os.path.exists(self.build_times_path):
+            with open(self.build_times_path, "r") as f:
+                for line in f:
+                    try:
+                        r = json.loads(line)
+                    except ValueError:
+                        continue
+                    if (r.get("package"), r.get("architecture")) == (
+                            record["package"], record["architecture"]) \
+                            and r.get("mode") != mode:
+                        previous = r
+        with open(self.build_times_path, "a") as f:
+            f.write(json.dumps(record) + "\n")
+        message = "Build took {:.1f} s on {}".format(seconds, mode)
+        if previous and previous["seconds"] and seconds:
+            ratio = previous["seconds"] / seconds
+            message += "; last {} build took {:.1f} s:  {:.2f}x {}".format(
+                previous["mode"], previous["seconds"],
+                ratio if ratio >= 1 else 1 / ratio,
+                "faster" if ratio >= 1 else "slower")
+        sys.stderr.write(message + "\n")
+
+    def run_dpkg_buildpackage(self: object, source_dir: str):
+        profiler = None
         try:
             dpkg_buildpackage_string_arguments = ["-uc",
                                                   "-us",
                                                   "-a",
                                                   self.architecture,
                                                   "-B"]
-            if sh.lsb_release("-cs", _tty_out=False).strip().lower() in ["stretch", "bionic"]:
+            if self.build_indep:
+                # Arch-dependent and arch-indep binary packages
+                sys.stderr.write("Also building Architecture: all packages\n")
+                dpkg_buildpackage_string_arguments[-1] = "-b"
+            if self.runner.output(["lsb_release", "-cs"]).strip().lower() in ["stretch", "bionic"]:
                 dpkg_buildpackage_string_arguments.append("-d")
-            sh.dpkg_buildpackage(*dpkg_buildpackage_string_arguments,
-                                 _out=sys.stdout.buffer,
-                                 _err=sys.stderr.buffer,
-                                 _cwd=self.source_dir)
-        except sh.ErrorReturnCode as e:
+            if self.profile:
+                profiler = BuildProfiler(sys.stdout.buffer)
+                self.runner.run(
+                    ["dpkg-buildpackage"] + dpkg_buildpackage_string_arguments,
+                    out=profiler, err_to_out=True, cwd=source_dir,
+                    env=self.build_env)
+            else:
+                self.runner.run(["dpkg-buildpackage"] + dpkg_buildpackage_string_arguments,
+                                cwd=source_dir, env=self.build_env)
+        except helpers.CommandError as e:
             message = "Packages cannot be built because of an error\n{0}".format(
                 e)
             raise ValueError(message)
+        finally:
+            if profiler is not None:
+                self.write_profile(profiler)
+
+    @property
+    def profile_path(self: object):
+        if self._profile_path is not None:
+            if self._source_dir is None or len(self.source_dirs) == 1:
+                return self._profile_path
+            # Builds of several sources, maybe in parallel:  one file each
+            base, ext = os.path.splitext(self._profile_path)
+            return "{}.{}{}".format(base, self.package_name, ext)
+        return self.changes_file_path[:-len(".changes")] + ".profile.json"
+
+    def write_profile(self: object, profiler) -> None:
+        # Report and save step timings, even from a failed build
+        profiler.finish()
+        profiler.report()
+        profiler.trace(self.tracer)
+        with open(self.profile_path, "w") as f:
+            json.dump(profiler.as_dict(), f, indent=2)
+        sys.stderr.write("Build profile written to {}\n".format(self.profile_path))
+
+    @staticmethod
+    def read_os_release(path="/etc/os-release"):
+        # Parse KEY=value lines of os-release(5)
+        result = dict()
+        with open(path, "r") as f:
+            for line in f:
+                key, sep, value = line.strip().partition("=")
+                if sep and not key.startswith("#"):
+                    result[key] = value.strip('"\'')
+        return result
+
+    @property
+    def build_target_path(self: object):
+        return self.changes_file_path[:-len(".changes")] + ".target.json"
+
+    def write_build_target(self: object):
+        # Record the distro and release next to the .changes file so uploads
+        # can index artifacts without parsing directory names
+        os_release = self.read_os_release()
+        target = dict(
+            distro=os_release["ID"],
+            release=os_release.get("VERSION_ID",
+                                   os_release.get("VERSION_CODENAME")),
+            architecture=self.architecture,
+            indep=self.build_indep)
+        with open(self.build_target_path, "w") as f:
+            json.dump(target, f)
+
+    @property
+    def changelog_path(self: object):
+        debian_dir = self.debian_dir
+        if self._source_dir is not None:
+            debian_dir = os.path.join(self._source_dir, 'debian')
+        return os.path.join(debian_dir, "changelog")
 
     @property
     def changelog(self: object):
-        with open(os.path.join(self.debian_dir, "changelog"), "r") as f:
-            changelog = Changelog(f, max_blocks=1)
+        with open(self.changelog_path, "r") as f:
+            changelog = debian_changelog.Changelog(f, max_blocks=1)
         return changelog
 
+    @property
+    def staged_changelog(self: object):
+        # The changelog as staged in git, before `configureSourceCmd` may
+        # have changed it; the work tree file if untracked
+        path = os.path.abspath(self.changelog_path)
+        try:
+            text = self.runner.output(
+                ['git', 'show', ':./{}'.format(os.path.basename(path))],
+                cwd=os.path.dirname(path))
+        except helpers.CommandError:
+            return self.changelog
+        return debian_changelog.Changelog(text, max_blocks=1)
+
     @property
     def package_name(self: object):
         return self.changelog[0].package
@@ -131,7 +1130,7 @@ class BuildPackages(helpers.DistroSettings):
 
     gpg_home_regex = re.compile(r"^Home:\s*(.*)$", flags=re.MULTILINE)
     def get_gpg_home(self: object):
-        gpg_help = str(sh.gpg("--help", _tty_out=False))
+        gpg_help = self.runner.output(["gpg", "--help"])
         match = self.gpg_home_regex.search(gpg_help)
         return match.group(1)
 
@@ -139,22 +1138,20 @@ class BuildPackages(helpers.DistroSettings):
         gpg_home = helpers.NormalizeSubdir(self.get_gpg_home())()
         sys.stderr.write("GPG home:  {}\n".format(gpg_home))
         secret = self.env(env_var)
-        sh.gpg("-v", "--batch", "--import", "-",
-               _in=secret,
-               _out=sys.stdout.buffer,
-               _err=sys.stderr.buffer,
-               _cwd=self.normalized_path)
+        self.runner.run(["gpg", "-v", "--batch", "--import", "-"],
+                        in_=secret,
+                        cwd=self.normalized_path)
 
     def extract_gpg_keyid_from_secret_env_var(self: object, env_var: str):
         gpg_home = helpers.NormalizeSubdir(self.get_gpg_home())()
         sys.stderr.write("GPG home:  {}\n".format(gpg_home))
         secret = self.env(env_var)
-        output = sh.gpg(
-            "-v", "--batch", "--import", "--import-options=show-only",
-            "--dry-run", "--with-colons", "-",
-            _in=secret,
-            _cwd=self.normalized_path)
-        for line in output:
+        output = self.runner.output(
+            ["gpg", "-v", "--batch", "--import", "--import-options=show-only",
+             "--dry-run", "--with-colons", "-"],
+            in_=secret,
+            cwd=self.normalized_path)
+        for line in output.splitlines():
             if line.startswith('sec'):
                 fields = line.split(':')
                 return fields[4]
@@ -164,26 +1161,41 @@ class BuildPackages(helpers.DistroSettings):
 
     def sign_packages(self: object):
         signing_key_id = self.env('PACKAGE_SIGNING_KEY_ID', False)
-        sh.Command("dpkg-sig")(
-            "--sign", "builder", "-v", "-k",
-            signing_key_id,
-            self.changes_file_path,
-            _out=sys.stdout.buffer,
-            _err=sys.stderr.buffer,
-            _cwd=self.source_parent_dir)
+        for build in self.source_builds():
+            self.runner.run(
+                ["dpkg-sig", "--sign", "builder", "-v", "-k",
+                 signing_key_id,
+                 build.changes_file_path],
+                cwd=build.source_parent_dir)
 
     def get_package_list(self: object):
         with open(self.changes_file_path, 'r') as f:
-            changes = Changes(f)
+            changes = debian_deb822.Changes(f)
         return [os.path.join(self.source_parent_dir, f['name'])
                 for f in changes['Files']]
 
-    def list_packages(self: object, with_buildinfo=False, with_changes=False):
-        for f in self.get_package_list():
-            if f.endswith('.buildinfo') and not with_buildinfo:
-                continue
-            print(f)
-        print(self.changes_file_path)
+    @staticmethod
+    def is_indep_package(path: str) -> bool:
+        # `Architecture: all` packages are shared by a release's builds
+        return path.endswith(('_all.deb', '_all.ddeb'))
+
+    package_sets = ('all', 'arch', 'indep')
+
+    def list_packages(self: object, with_buildinfo=False, with_changes=False,
+                      package_set='all'):
+        # `package_set` 'arch' or 'indep' lists only arch-dependent or only
+        # shared arch-indep packages
+        for build in self.source_builds():
+            for f in build.get_package_list():
+                if f.endswith('.buildinfo') and not with_buildinfo:
+                    continue
+                if package_set != 'all' and f.endswith(('.deb', '.ddeb')) and (
+                        self.is_indep_package(f) != (package_set == 'indep')):
+                    continue
+                print(f)
+            print(build.changes_file_path)
+            if os.path.exists(build.build_target_path):
+                print(build.build_target_path)
 
 
     @classmethod
@@ -192,13 +1204,6 @@ class BuildPackages(helpers.DistroSettings):
         parser = argparse.ArgumentParser(
             description="Build packages for Debian like distributions")
 
-        # Default architecture
-        default_architecture = os.environ.get(
-            "ARCHITECTURE",
-            sh.dpkg_architecture(
-                "-qDEB_HOST_ARCH",
-                _tty_out=False).strip())
-
         # Optional arguments
         parser.add_argument("-p",
                             "--path",
@@ -210,15 +1215,59 @@ class BuildPackages(helpers.DistroSettings):
                             "--architecture",
                             dest="architecture",
                             action=helpers.HostArchitectureValidAction,
-                            default=default_architecture,
                             metavar="ARCHITECTURE",
-                            help="Build packages for specific architecture")
+                            help="Build packages for specific architecture "
+                            "(default: $ARCHITECTURE or host architecture)")
         parser.add_argument("--configure-source",
                             action='store_true',
                             help="Run configureSourceCmd to prepare source tree")
+        parser.add_argument("--source-cache",
+                            metavar="DIR",
+                            help="With --configure-source and "
+                            "configureSourceOutputs set, reuse configured "
+                            "sources cached in DIR; empty to disable "
+                            "(default: $MACHINEKIT_CI_SOURCE_CACHE, else "
+                            ".mk-ci-source-cache in the parent directory)")
         parser.add_argument("--build-packages",
                             action='store_true',
                             help="Build packages")
+        parser.add_argument("--build-dir",
+                            default=os.environ.get('MACHINEKIT_CI_BUILD_DIR', None),
+                            help="With --build-packages, build in a copy of "
+                            "the source tree in BUILD_DIR, e.g. a tmpfs, and "
+                            "copy back the packages; falls back to building "
+                            "in place when short of space "
+                            "(default: $MACHINEKIT_CI_BUILD_DIR)")
+        parser.add_argument("--compression",
+                            action="append",
+                            metavar="[TYPE=]PROFILE",
+                            help="With --build-packages, dpkg-deb compression "
+                            "profile (fast, default, max), for all package "
+                            "types or for package TYPE (default, dbgsym, "
+                            "indep), overriding packageCompression; may be "
+                            "repeated, later values winning (default: "
+                            "packageCompression config key)")
+        parser.add_argument("--local-repo",
+                            metavar="DIR",
+                            help="With --build-packages and several "
+                            "sourceDirs, keep the apt repo of built packages "
+                            "in DIR (default: a temporary directory)")
+        parser.add_argument("--parallel-builds",
+                            type=int,
+                            metavar="N",
+                            help="With --build-packages and several "
+                            "sourceDirs, build at most N source packages at "
+                            "once (default: all ready to build)")
+        parser.add_argument("--profile",
+                            action='store_true',
+                            help="With --build-packages, time each build "
+                            "step and print a summary")
+        parser.add_argument("--profile-output",
+                            metavar="FILE",
+                            help="Write --profile step timings as JSON to FILE, "
+                            "or with several sourceDirs to FILE with each "
+                            "source package name before the extension "
+                            "(default: next to the .changes file)")
         parser.add_argument("--import-gpg-from-secret-env-var",
                             help="Import a GPG secret key from the given environment variable")
         parser.add_argument("--print-gpg-keyid-from-secret-env-var",
@@ -235,12 +1284,39 @@ class BuildPackages(helpers.DistroSettings):
         parser.add_argument("--with-changes",
                             action='store_true',
                             help="With --list-packages, print .changes file")
+        parser.add_argument("--package-set",
+                            choices=cls.package_sets,
+                            default='all',
+                            help="With --list-packages, list all packages, "
+                            "only arch-dependent, or only shared "
+                            "Architecture: all packages (default: all)")
+        parser.add_argument("--build-indep",
+                            action='store_const',
+                            const=True,
+                            help="With --build-packages, also build "
+                            "Architecture: all packages (default: if this is "
+                            "the release's indepArchitecture)")
+        parser.add_argument("--no-build-indep",
+                            action='store_const',
+                            const=False,
+                            dest='build_indep',
+                            help="With --build-packages, only build "
+                            "arch-dependent packages")
 
         args = parser.parse_args()
 
         try:
-            buildpackages = cls(
-                args.path, args.architecture)
+            architecture = (
+                args.architecture or helpers.default_host_architecture())
+            buildpackages = cls(args.path, architecture, profile=args.profile,
+                                profile_path=args.profile_output,
+                                build_dir=args.build_dir,
+                                compression=CompressionProfiles.parse_args(
+                                    args.compression),
+                                build_indep=args.build_indep,
+                                local_repo=args.local_repo,
+                                parallel_builds=args.parallel_builds,
+                                source_cache=args.source_cache)
             if args.configure_source:
                 buildpackages.configure_source()
             if args.build_packages:
@@ -254,7 +1330,8 @@ class BuildPackages(helpers.DistroSettings):
             if args.sign_packages:
                 buildpackages.sign_packages()
             if args.list_packages:
-                buildpackages.list_packages(args.with_buildinfo, args.with_changes)
-        except ValueError as e:
+                buildpackages.list_packages(args.with_buildinfo, args.with_changes,
+                                            args.package_set)
+        except (ValueError, helpers.CommandError) as e:
             sys.stderr.write("Error:  Command exited non-zero:  {}\n".format(str(e)))
             sys.exit(1)
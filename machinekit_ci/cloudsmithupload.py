@@ -6,20 +6,445 @@ Upload packages to Cloudsmith
 """
 
 import argparse
-import sh
 import os
 import sys
 import re
 import json
+import time
+import hashlib
+import threading
+import io
+import tempfile
+import uuid
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 
 import machinekit_ci.script_helpers as helpers
 
+debian_deb822 = helpers.LazyModule('debian.deb822')
+requests = helpers.LazyModule('requests')
+
 unset = object()
 
+UploadResult = namedtuple('UploadResult', [
+    'path', 'size', 'attempts', 'duration', 'error'])
+
+
+class ArtifactFile(namedtuple('ArtifactFile', [
+        'dirname', 'name', 'distro', 'release', 'architecture', 'version',
+        'size', 'sha256'])):
+    """One package file to upload; `size` and `sha256` are None when not
+    known from a `.changes` file"""
+    __slots__ = ()
+
+    @property
+    def path(self: object):
+        return os.path.join(self.dirname, self.name)
+
+
+class ArtifactIndex(object):
+    """Package files indexed by (distro, release, architecture)
+
+    Built by parsing each `.changes` file under a directory once; sizes and
+    checksums come from the `.changes` file, so package files are neither
+    stat'ed nor matched against patterns.  The distro and release come from
+    the `*.target.json` file `buildpackages` writes next to the `.changes`
+    file, or else from the `fallback_target(dirname)` callable.
+
+    `Architecture: all` packages are shared by all of a release's builds, so
+    a file of the same name from another build's directory is added once.
+    """
+    package_suffixes = ('.deb', '.ddeb')
+
+    def __init__(self: object):
+        self._targets = dict()
+        self._shared = dict()
+
+    def add(self: object, artifact) -> None:
+        key = (artifact.distro, artifact.release, artifact.architecture)
+        if artifact.architecture == 'all':
+            shared_key = (artifact.distro, artifact.release, artifact.name)
+            first = self._shared.setdefault(shared_key, artifact)
+            if first is not artifact:
+                if None not in (first.sha256, artifact.sha256) and \
+                        first.sha256 != artifact.sha256:
+                    raise ValueError(
+                        "Shared package {} differs in {} and {}".format(
+                            artifact.name, first.dirname, artifact.dirname))
+                return
+        self._targets.setdefault(key, list()).append(artifact)
+
+    def targets(self: object):
+        return sorted(self._targets)
+
+    def files(self: object, distro, release, architecture):
+        return list(self._targets.get((distro, release, architecture), []))
+
+    def __iter__(self: object):
+        for key in self.targets():
+            for artifact in self._targets[key]:
+                yield artifact
+
+    def __len__(self: object):
+        return sum(len(v) for v in self._targets.values())
+
+    @staticmethod
+    def read_target(changes_path: str):
+        # (distro, release) from the `buildpackages` target file, or None
+        target_path = changes_path[:-len('.changes')] + '.target.json'
+        if not os.path.exists(target_path):
+            return None
+        with open(target_path, 'r') as f:
+            target = json.load(f)
+        return (target['distro'], target['release'])
+
+    @classmethod
+    def from_directory(cls, package_directory: str, fallback_target):
+        index = cls()
+        for dirname, _, fnames in os.walk(package_directory):
+            for changes_name in fnames:
+                if not changes_name.endswith('.changes'):
+                    continue
+                changes_path = os.path.join(dirname, changes_name)
+                distro, release = (
+                    cls.read_target(changes_path) or fallback_target(dirname))
+                with open(changes_path, 'r') as f:
+                    changes = debian_deb822.Changes(f)
+                version = changes['Version']
+                for entry in changes.get('Checksums-Sha256', []):
+                    name = entry['name']
+                    if not name.endswith(cls.package_suffixes):
+                        continue
+                    index.add(ArtifactFile(
+                        dirname=dirname, name=name, distro=distro,
+                        release=release,
+                        architecture=name.rsplit('_', 1)[-1].split('.', 1)[0],
+                        version=version, size=int(entry['size']),
+                        sha256=entry['sha256']))
+        return index
+
+    def report(self: object, stream=None) -> None:
+        stream = stream or sys.stdout
+        for distro, release, architecture in self.targets():
+            artifacts = self._targets[(distro, release, architecture)]
+            stream.write("{}/{} {}{}:  {} files, {:.1f} MiB\n".format(
+                distro, release, architecture,
+                " (shared)" if architecture == 'all' else "", len(artifacts),
+                sum(a.size for a in artifacts) / 2**20))
+            for a in artifacts:
+                stream.write("    {} {} {}\n".format(a.name, a.size, a.sha256))
+
+
+class CloudsmithAPIError(RuntimeError):
+    """Cloudsmith API request failed; `status` is the HTTP status, or None
+    for connection errors"""
+    def __init__(self: object, message: str, status=None):
+        super(CloudsmithAPIError, self).__init__(message)
+        self.status = status
+
+
+class FileSlice(object):
+    """Read-only file-like view of `length` bytes of a file from `offset`
+
+    Lets `requests` stream a file, or one part of it, straight from disk.
+    """
+    def __init__(self: object, path: str, offset=0, length=None):
+        self._file = open(path, 'rb')
+        self._file.seek(offset)
+        if length is None:
+            length = os.path.getsize(path) - offset
+        self._remaining = self.length = length
+
+    def read(self: object, size=-1) -> bytes:
+        if size is None or size < 0 or size > self._remaining:
+            size = self._remaining
+        data = self._file.read(size)
+        self._remaining -= len(data)
+        return data
+
+    def __len__(self: object):
+        return self.length
+
+    def close(self: object):
+        self._file.close()
+
+
+class MultipartFileBody(object):
+    """Streaming `multipart/form-data` body of form fields and one file
+
+    `requests` would otherwise build the whole body, file included, in
+    memory.
+    """
+    def __init__(self: object, fields: dict, file_field: str, path: str):
+        boundary = uuid.uuid4().hex
+        self.content_type = 'multipart/form-data; boundary={}'.format(boundary)
+        preamble = io.BytesIO()
+        for name, value in fields.items():
+            preamble.write(
+                '--{}\r\nContent-Disposition: form-data; name="{}"\r\n\r\n'
+                '{}\r\n'.format(boundary, name, value).encode())
+        preamble.write(
+            '--{}\r\nContent-Disposition: form-data; name="{}"; filename="{}"\r\n'
+            'Content-Type: application/octet-stream\r\n\r\n'.format(
+                boundary, file_field, os.path.basename(path)).encode())
+        epilogue = '\r\n--{}--\r\n'.format(boundary).encode()
+        self._parts = [io.BytesIO(preamble.getvalue()), FileSlice(path),
+                       io.BytesIO(epilogue)]
+        self.length = len(preamble.getvalue()) + len(self._parts[1]) + len(epilogue)
+
+    def read(self: object, size=-1) -> bytes:
+        chunks = list()
+        while self._parts and (size is None or size < 0 or size > 0):
+            data = self._parts[0].read(size)
+            if not data:
+                self._parts.pop(0).close()
+                continue
+            chunks.append(data)
+            if size is not None and size > 0:
+                size -= len(data)
+        return b''.join(chunks)
+
+    def __len__(self: object):
+        return self.length
+
+    def close(self: object):
+        for part in self._parts:
+            part.close()
+
+
+class CloudsmithClient(object):
+    """Minimal native client for the Cloudsmith v1 API
+
+    One pooled `requests` session with the API key set once replaces a
+    `cloudsmith` CLI process per request.  Files are streamed from disk;
+    files over `multipart_threshold` bytes are sent in `part_size` parts,
+    following the same protocol as the CLI:  part PUTs carry the API key,
+    only the single-file POST to the pre-signed URL goes without it.
+    """
+    default_api_host = 'https://api.cloudsmith.io'
+    multipart_threshold = 100 * 2**20
+    part_size = 100 * 2**20
+    timeout = 300
+
+    def __init__(self: object, api_key: str, api_host=None, pool_size=10):
+        self.api_host = (api_host or self.default_api_host).rstrip('/')
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.headers.update({
+            'X-Api-Key': api_key,
+            'User-Agent': 'machinekit_ci',
+        })
+
+    @classmethod
+    def from_environment(cls, pool_size=10):
+        # Return a client if `$CLOUDSMITH_API_KEY` is set, else None
+        api_key = os.environ.get('CLOUDSMITH_API_KEY', None)
+        if not api_key:
+            return None
+        return cls(api_key, api_host=os.environ.get('CLOUDSMITH_API_HOST', None),
+                   pool_size=pool_size)
+
+    def url(self: object, path: str) -> str:
+        return '{}/v1/{}'.format(self.api_host, path.lstrip('/'))
+
+    def request(self: object, method: str, url: str, **kwargs):
+        if not url.startswith(('http://', 'https://')):
+            url = self.url(url)
+        kwargs.setdefault('timeout', self.timeout)
+        try:
+            response = self.session.request(method, url, **kwargs)
+        except requests.exceptions.RequestException as e:
+            raise CloudsmithAPIError(
+                "{} {} failed:  connection error:  {}".format(method, url, e))
+        if response.status_code >= 400:
+            raise CloudsmithAPIError(
+                "{} {} failed:  HTTP {}:  {}".format(
+                    method, url, response.status_code, response.text[-1000:]),
+                status=response.status_code)
+        return response
+
+    def get_paginated(self: object, path: str, params=None, page_size=100):
+        # Yield all results of a paginated list endpoint
+        page = 1
+        while True:
+            response = self.request('GET', path, params=dict(
+                params or {}, page=page, page_size=page_size))
+            for item in response.json():
+                yield item
+            page_total = int(response.headers.get('X-Pagination-PageTotal', page))
+            if page >= page_total:
+                break
+            page += 1
+
+    def list_repos(self: object, owner: str):
+        return self.get_paginated('repos/{}/'.format(owner))
+
+    def get_repo(self: object, owner: str, slug: str):
+        # Return one repo record, or None if it doesn't exist
+        try:
+            return self.request('GET', 'repos/{}/{}/'.format(owner, slug)).json()
+        except CloudsmithAPIError as e:
+            if e.status == 404:
+                return None
+            raise
+
+    def list_packages(self: object, owner: str, repo: str, query=None,
+                      page_size=100):
+        params = dict(query=query) if query else None
+        return self.get_paginated(
+            'packages/{}/{}/'.format(owner, repo), params=params,
+            page_size=page_size)
+
+    @staticmethod
+    def file_md5(path: str) -> str:
+        md5 = hashlib.md5()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                md5.update(chunk)
+        return md5.hexdigest()
+
+    def upload_file(self: object, owner: str, repo: str, path: str) -> str:
+        # Upload a file to the repo's file store; return its identifier
+        multipart = os.path.getsize(path) > self.multipart_threshold
+        data = self.request('POST', 'files/{}/{}/'.format(owner, repo), json=dict(
+            filename=os.path.basename(path),
+            md5_checksum=self.file_md5(path),
+            method='put_parts' if multipart else 'post',
+        )).json()
+        identifier = data['identifier']
+        if multipart:
+            self.upload_parts(owner, repo, identifier, data['upload_url'], path)
+        else:
+            body = MultipartFileBody(data.get('upload_fields') or {}, 'file', path)
+            try:
+                self.storage_request(
+                    'POST', data['upload_url'], path, data=body,
+                    headers={'Content-Type': body.content_type})
+            finally:
+                body.close()
+        return identifier
+
+    def storage_request(self: object, method: str, url: str, path: str,
+                        **kwargs):
+        # Pre-signed storage URL:  don't send the API key there, so use a
+        # plain request instead of the session
+        kwargs.setdefault('timeout', self.timeout)
+        try:
+            response = requests.request(method, url, **kwargs)
+            response.raise_for_status()
+        except requests.exceptions.RequestException as e:
+            raise CloudsmithAPIError("Upload of {} failed:  {}".format(path, e),
+                                     status=getattr(e.response, 'status_code', None))
+        return response
+
+    def upload_parts(self: object, owner, repo, identifier, upload_url, path):
+        size = os.path.getsize(path)
+        part_number = 0
+        for offset in range(0, size, self.part_size):
+            part_number += 1
+            part = FileSlice(path, offset, min(self.part_size, size - offset))
+            try:
+                self.request('PUT', upload_url, data=part,
+                             params=dict(upload_id=identifier,
+                                         part_number=part_number))
+            finally:
+                part.close()
+        self.request('POST', 'files/{}/{}/{}/complete/'.format(
+            owner, repo, identifier), json=dict(upload_id=identifier, complete=True))
+
+    def create_deb_package(self: object, owner, repo, identifier, distribution,
+                           republish=True):
+        return self.request(
+            'POST', 'packages/{}/{}/upload/deb/'.format(owner, repo), json=dict(
+                package_file=identifier, distribution=distribution,
+                republish=republish)).json()
+
+class RepoCache(object):
+    """On-disk cache of resolved Cloudsmith repo records
+
+    Entries are keyed by `namespace/slug` in one JSON file in the same
+    directory as the settings cache, and expire after `ttl` seconds.  Set
+    `MACHINEKIT_CI_CACHE_DIR` to an empty string to disable it.
+    """
+    default_ttl = 24 * 3600
+
+    def __init__(self: object, ttl=None):
+        self.ttl = self.default_ttl if ttl is None else ttl
+        cache_dir = helpers.SettingsCache.default_cache_dir()
+        self.cache_file = (
+            None if cache_dir is None
+            else os.path.join(cache_dir, 'cloudsmith-repos.json'))
+
+    def read(self: object) -> dict:
+        if self.cache_file is None:
+            return dict()
+        try:
+            with open(self.cache_file, 'r') as f:
+                entries = json.load(f)
+        except (OSError, ValueError):
+            return dict()
+        return entries if isinstance(entries, dict) else dict()
+
+    def write(self: object, entries: dict) -> None:
+        if self.cache_file is None:
+            return
+        cache_dir = os.path.dirname(self.cache_file)
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            # Write atomically; parallel jobs may share the file
+            fd, tmp_path = tempfile.mkstemp(
+                prefix='.cloudsmith-repos-', dir=cache_dir)
+            with os.fdopen(fd, 'w') as f:
+                json.dump(entries, f)
+            os.replace(tmp_path, self.cache_file)
+        except OSError as e:
+            sys.stderr.write("Not caching Cloudsmith repo:  {}\n".format(e))
+
+    def get(self: object, namespace: str, slug: str):
+        # Return the cached repo record, or None if missing or expired
+        entry = self.read().get(f'{namespace}/{slug}', None)
+        if entry is None or time.time() - entry.get('time', 0) > self.ttl:
+            return None
+        return entry.get('repo', None)
+
+    def set(self: object, namespace: str, slug: str, repo: dict) -> None:
+        entries = self.read()
+        entries[f'{namespace}/{slug}'] = dict(time=time.time(), repo=repo)
+        self.write(entries)
+
+    def invalidate(self: object, namespace=None, slug=None) -> None:
+        # Drop one entry, or all entries if no namespace is given
+        entries = self.read()
+        if namespace is None:
+            entries = dict()
+        else:
+            entries.pop(f'{namespace}/{slug}', None)
+        self.write(entries)
+
+
 class CloudsmithUploader(helpers.DistroSettings):
-    def __init__(self: object, path, package_directory):
+    def __init__(self: object, path, package_directory, jobs=1, retries=3,
+                 retry_delay=2.0, force=False, use_cli=False, from_changes=False,
+                 repo_cache_ttl=None):
         super(CloudsmithUploader, self).__init__(path)
         self.package_directory = helpers.NormalizeSubdir(package_directory)()
+        self.jobs = max(1, jobs)
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.force = force
+        self.from_changes = from_changes
+        self._artifact_index = None
+        self.repo_cache = RepoCache(ttl=repo_cache_ttl)
+        self._output_lock = threading.Lock()
+        self._remote_packages = dict()
+        self._local_checksums = dict()
+        # Native API client; fall back to the `cloudsmith` CLI without an
+        # API key in the environment
+        self.client = None if use_cli else CloudsmithClient.from_environment(
+            pool_size=self.jobs)
 
     _cache_dict = {}
     def _cache_get(self: object, key, default=unset):
@@ -56,25 +481,43 @@ class CloudsmithUploader(helpers.DistroSettings):
         else:
             return self._cache_get('namespace')
 
+    def lookup_repo(self: object):
+        # Fetch the repo record directly, or None if it doesn't exist
+        if self.client is not None:
+            return self.client.get_repo(self.namespace, self.repo_slug)
+        try:
+            repos_json = self.runner.output(
+                ['cloudsmith', 'list', 'repos',
+                 f'{self.namespace}/{self.repo_slug}', '--output-format=json'])
+        except helpers.CommandError:
+            return None
+        repos = json.loads(repos_json)['data']
+        for repo in (repos if isinstance(repos, list) else [repos]):
+            if (repo['namespace'] == self.namespace
+                and repo['slug'] == self.repo_slug):
+                return repo
+        return None
+
     @property
     def repo(self: object):
         if self._cache_get('repo', None) is None:
-            repos_json = sh.cloudsmith.list.repos(
-                '--output-format=json', _tty_out=False)
-            repos = json.loads(str(repos_json))
-            for repo in repos['data']:
-                if (repo['namespace'] == self.namespace
-                    and repo['slug'] == self.repo_slug):
-                    break
-            else:
+            repo = self.repo_cache.get(self.namespace, self.repo_slug)
+            if repo is not None:
+                sys.stderr.write(
+                    f"Cloudsmith repo {self.namespace}/{self.repo_slug} "
+                    f"from cache\n")
+                return self._cache_set('repo', repo)
+            repo = self.lookup_repo()
+            if repo is None:
                 raise ValueError(
                     f"No Cloudsmith repo found in {self.namespace} "
                     f"namespace with {self.repo_slug} slug")
             sys.stderr.write(
                 f"Found Cloudsmith repo, namespace {self.namespace}, "
                 f"slug {self.repo_slug}\n")
+            self.repo_cache.set(self.namespace, self.repo_slug, repo)
             return self._cache_set('repo', repo)
-        return self._cache.get('repo')
+        return self._cache_get('repo')
 
     package_regex = re.compile(r'^[^_]+_(.*)_([^.]*)\.d?deb$')
     def walk_package_directory(self: object):
@@ -86,26 +529,253 @@ class CloudsmithUploader(helpers.DistroSettings):
                     yield((subdir, fname))
 
     ordr_regex = re.compile(r'^.+-([^-]+)-([^-]+)-([^-]+)-[^-]+-[^-]+$')
-    def ordr(self: object, subdir):
+    def distro_release(self: object, subdir):
+        # (distro, release) parsed from an artifact directory name
         topdir = subdir.split('/')[-1]
         match = self.ordr_regex.match(topdir)
-        distro = match.group(1)
-        release = match.group(2)
+        if match is None:
+            raise ValueError(
+                f"Can't parse distro and release from directory {subdir}")
+        return (match.group(1), match.group(2))
+
+    def ordr(self: object, subdir):
+        distro, release = self.distro_release(subdir)
+        return self.target_ordr(distro, release)
+
+    def target_ordr(self: object, distro, release):
         return f'{self.namespace}/{self.repo_slug}/{distro}/{release}'
 
-    def upload_packages(self: object, dry_run=False):
-        for dirname, fname in self.walk_package_directory():
-            ordr = self.ordr(dirname)
-            sys.stderr.write("Uploading package {} {}\n".format(ordr, fname))
+    def scan_package_directory(self: object):
+        # ArtifactFiles found by file and directory name patterns
+        for subdir, fname in self.walk_package_directory():
+            distro, release = self.distro_release(subdir)
+            version, architecture = self.package_regex.match(fname).groups()
+            yield ArtifactFile(
+                dirname=subdir, name=fname, distro=distro, release=release,
+                architecture=architecture, version=version, size=None,
+                sha256=None)
+
+    @property
+    def artifact_index(self: object):
+        if self._artifact_index is None:
+            self._artifact_index = ArtifactIndex.from_directory(
+                self.package_directory, self.distro_release)
+        return self._artifact_index
+
+    def artifacts(self: object):
+        if self.from_changes:
+            return list(self.artifact_index)
+        index = ArtifactIndex()
+        for artifact in self.scan_package_directory():
+            index.add(artifact)
+        return list(index)
+
+    remote_page_size = 100
+    def list_remote_packages_cli(self: object, query):
+        # Yield package records from all pages of `cloudsmith list packages`
+        page = 1
+        while True:
+            output = self.runner.output(
+                ['cloudsmith', 'list', 'packages',
+                 f'{self.namespace}/{self.repo_slug}',
+                 '--query', query,
+                 '--output-format=json',
+                 '--page', str(page), '--page-size', str(self.remote_page_size)])
+            listing = json.loads(output)
+            for package in listing.get('data', []):
+                yield package
+            pagination = listing.get('meta', {}).get('pagination', {})
+            if page >= pagination.get('page_max', page):
+                break
+            page += 1
+
+    def fetch_remote_packages(self: object, distro, release):
+        # Return {filename: package record} for one distro release, reading
+        # all pages of the package list once
+        query = f'distribution:{distro}/{release}'
+        if self.client is not None:
+            listing = self.client.list_packages(
+                self.namespace, self.repo_slug, query=query,
+                page_size=self.remote_page_size)
+        else:
+            listing = self.list_remote_packages_cli(query)
+        packages = {package.get('filename'): package for package in listing}
+        self.log(f"Found {len(packages)} published packages in "
+                 f"{self.namespace}/{self.repo_slug} {distro}/{release}")
+        return packages
+
+    def remote_packages(self: object, distro, release):
+        key = (distro, release)
+        if key not in self._remote_packages:
+            try:
+                self._remote_packages[key] = self.fetch_remote_packages(*key)
+            except (helpers.CommandError, CloudsmithAPIError, ValueError) as e:
+                self.log(f"Can't list published packages for {distro}/{release}; "
+                         f"uploading all:  {e}")
+                self._remote_packages[key] = dict()
+        return self._remote_packages[key]
+
+    def local_checksums(self: object, subdir):
+        # {filename: sha256} from the `.changes` files in a directory
+        if subdir not in self._local_checksums:
+            checksums = dict()
+            for fname in os.listdir(subdir):
+                if not fname.endswith('.changes'):
+                    continue
+                with open(os.path.join(subdir, fname), 'r') as f:
+                    changes = debian_deb822.Changes(f)
+                for entry in changes.get('Checksums-Sha256', []):
+                    checksums[entry['name']] = entry['sha256']
+            self._local_checksums[subdir] = checksums
+        return self._local_checksums[subdir]
+
+    def file_checksum(self: object, artifact):
+        if artifact.sha256 is not None:
+            return artifact.sha256
+        checksum = self.local_checksums(artifact.dirname).get(artifact.name, None)
+        if checksum is None:
+            sha256 = hashlib.sha256()
+            with open(artifact.path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 20), b''):
+                    sha256.update(chunk)
+            checksum = sha256.hexdigest()
+        return checksum
+
+    def upload_reason(self: object, artifact):
+        # Return why a file must be uploaded, or None if already published
+        if self.force:
+            return "forced"
+        remote = self.remote_packages(artifact.distro, artifact.release).get(
+            artifact.name, None)
+        if remote is None:
+            return "not published"
+        version = artifact.version.split(':', 1)[-1]
+        remote_version = str(remote.get('version', version)).split(':', 1)[-1]
+        if remote_version != version:
+            return f"published version {remote_version} differs"
+        if remote.get('checksum_sha256') != self.file_checksum(artifact):
+            return "published checksum differs"
+        return None
+
+    def log(self: object, message: str):
+        # Keep messages from concurrent uploads on separate lines
+        with self._output_lock:
+            sys.stderr.write(message + "\n")
             sys.stderr.flush()
-            args = ['--republish', ordr, fname]
-            if dry_run:
-                sys.stderr.write("cloudsmith push deb {} {} {}\n".format(*args))
+
+    # Errors worth retrying:  network trouble and server-side HTTP statuses
+    transient_error_regex = re.compile(
+        r'timed? ?out|connection (?:error|reset|refused|aborted)'
+        r'|temporar(?:y|ily)|too many requests|rate limit|throttl'
+        r'|\b(?:408|429|500|502|503|504)\b',
+        flags=re.IGNORECASE)
+    def is_transient_error(self: object, error: str) -> bool:
+        return bool(self.transient_error_regex.search(error))
+
+    # Errors showing the repo is missing or changed since it was cached
+    repo_error_regex = re.compile(
+        r'\b404\b|\brepo(?:sitory)?\b.*\b(?:not found|does not exist)',
+        flags=re.IGNORECASE)
+    def is_repo_error(self: object, error: str) -> bool:
+        return bool(self.repo_error_regex.search(error))
+
+    def push_package(self: object, artifact, dry_run=False):
+        ordr = self.target_ordr(artifact.distro, artifact.release)
+        if self.client is None:
+            self.runner.run(
+                ['cloudsmith', 'push', 'deb', '--republish', ordr, artifact.name],
+                cwd=artifact.dirname, dry_run=dry_run)
+            return
+        if dry_run:
+            self.log(f"Would upload {artifact.name} to {ordr} via API")
+            return
+        identifier = self.client.upload_file(
+            self.namespace, self.repo_slug, artifact.path)
+        self.client.create_deb_package(
+            self.namespace, self.repo_slug, identifier,
+            f'{artifact.distro}/{artifact.release}')
+
+    def upload_package(self: object, artifact, dry_run=False):
+        # Upload one file, retrying transient errors with exponential backoff
+        path = artifact.path
+        fname = artifact.name
+        ordr = self.target_ordr(artifact.distro, artifact.release)
+        size = artifact.size if artifact.size is not None else os.path.getsize(path)
+        start = time.perf_counter()
+        attempt = 0
+        while True:
+            attempt += 1
+            self.log("Uploading package {} {}{}".format(
+                ordr, fname, " (try {})".format(attempt) if attempt > 1 else ""))
+            try:
+                self.push_package(artifact, dry_run=dry_run)
+                error = None
+            except helpers.CommandError as e:
+                error = "{}\n{}".format(e, e.stderr).strip()
+            except CloudsmithAPIError as e:
+                error = str(e)
+            if error is None:
+                break
+            if attempt > self.retries or not self.is_transient_error(error):
+                break
+            delay = self.retry_delay * 2 ** (attempt - 1)
+            self.log("Upload of {} failed; retrying in {:.1f}s:  {}".format(
+                fname, delay, error.splitlines()[-1]))
+            time.sleep(delay)
+        return UploadResult(path=path, size=size, attempts=attempt,
+                            duration=time.perf_counter() - start, error=error)
+
+    def upload_summary(self: object, results, elapsed, dry_run=False):
+        uploaded = [r for r in results if r.error is None]
+        failed = [r for r in results if r.error is not None]
+        nbytes = sum(r.size for r in uploaded)
+        rate = nbytes / elapsed / 2**20 if elapsed > 0 else 0.0
+        lines = ["{} {} of {} files, {:.1f} MiB in {:.1f}s ({:.2f} MiB/s, "
+                 "{} jobs, {} retries)".format(
+                     "Would upload" if dry_run else "Uploaded",
+                     len(uploaded), len(results), nbytes / 2**20, elapsed, rate,
+                     self.jobs, sum(r.attempts - 1 for r in results))]
+        for r in failed:
+            lines.append("FAILED after {} tries:  {}\n    {}".format(
+                r.attempts, r.path, r.error.replace('\n', '\n    ')))
+        return "\n".join(lines)
+
+    def select_packages(self: object, dry_run=False):
+        # Split packages into those to upload and those already published
+        to_upload = list()
+        skipped = list()
+        for artifact in self.artifacts():
+            reason = self.upload_reason(artifact)
+            if reason is None:
+                skipped.append(artifact)
             else:
-                sh.cloudsmith.push.deb(*args,
-                                       _out=sys.stdout.buffer,
-                                       _err=sys.stderr.buffer,
-                                       _cwd=dirname)
+                to_upload.append(artifact)
+            if dry_run:
+                self.log("{}:  {} {}".format(
+                    "Skip" if reason is None else "Upload ({})".format(reason),
+                    self.target_ordr(artifact.distro, artifact.release),
+                    artifact.name))
+        self.log(f"{len(to_upload)} packages to upload, "
+                 f"{len(skipped)} already published")
+        return to_upload
+
+    def upload_packages(self: object, dry_run=False):
+        if not dry_run:
+            self.repo # Fail early if the repo doesn't exist
+        packages = self.select_packages(dry_run=dry_run)
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            results = list(executor.map(
+                lambda a: self.upload_package(a, dry_run=dry_run), packages))
+        self.log(self.upload_summary(
+            results, time.perf_counter() - start, dry_run=dry_run))
+        failed = [r for r in results if r.error is not None]
+        if failed:
+            if any(self.is_repo_error(r.error) for r in failed):
+                # The repo may have been renamed or removed; look it up again
+                self.repo_cache.invalidate(self.namespace, self.repo_slug)
+            raise ValueError("{} of {} package uploads failed".format(
+                len(failed), len(results)))
 
     @classmethod
     def cli(cls):
@@ -125,13 +795,58 @@ class CloudsmithUploader(helpers.DistroSettings):
         parser.add_argument("--dry-run",
                             action="store_true",
                             help="Show what would be done, but do nothing")
+        parser.add_argument("--from-changes",
+                            action="store_true",
+                            help="Find packages from .changes files instead of "
+                            "matching file and directory names")
+        parser.add_argument("--list-index",
+                            action="store_true",
+                            help="With --from-changes, print the artifact index "
+                            "and exit")
+        parser.add_argument("--use-cli",
+                            action="store_true",
+                            help="Use the 'cloudsmith' CLI instead of the API client")
+        parser.add_argument("--force",
+                            action="store_true",
+                            help="Upload all packages, even if already published")
+        parser.add_argument("--repo-cache-ttl",
+                            type=float,
+                            default=RepoCache.default_ttl,
+                            help="Seconds to cache the Cloudsmith repo lookup "
+                            "(default {})".format(RepoCache.default_ttl))
+        parser.add_argument("--refresh-repo-cache",
+                            action="store_true",
+                            help="Drop cached Cloudsmith repo lookups first")
+        parser.add_argument("-j",
+                            "--jobs",
+                            type=int,
+                            default=1,
+                            help="Number of concurrent uploads (default 1)")
+        parser.add_argument("--retries",
+                            type=int,
+                            default=3,
+                            help="Retries per file on transient errors (default 3)")
+        parser.add_argument("--retry-delay",
+                            type=float,
+                            default=2.0,
+                            help="Initial retry delay in seconds, doubled after "
+                            "each try (default 2)")
 
         args = parser.parse_args()
 
         try:
             cloudsmith_uploader = cls(
-                args.path, args.package_directory)
-            cloudsmith_uploader.upload_packages(dry_run=args.dry_run)
-        except ValueError as e:
+                args.path, args.package_directory, jobs=args.jobs,
+                retries=args.retries, retry_delay=args.retry_delay,
+                force=args.force, use_cli=args.use_cli,
+                from_changes=args.from_changes,
+                repo_cache_ttl=args.repo_cache_ttl)
+            if args.refresh_repo_cache:
+                cloudsmith_uploader.repo_cache.invalidate()
+            if args.list_index:
+                cloudsmith_uploader.artifact_index.report()
+            else:
+                cloudsmith_uploader.upload_packages(dry_run=args.dry_run)
+        except (ValueError, helpers.CommandError) as e:
             sys.stderr.write(str(e) + '\n')
             sys.exit(1)
@@ -40,35 +40,103 @@ __license__ = "LGPL 2.1"
 
 import os
 import argparse
-import sh
 import sys
 import datetime
 import machinekit_ci.script_helpers as helpers
-from docker_registry_client import BaseClient
-import requests
 import shutil
 import tempfile
-import pkg_resources
+import hashlib
+import stat
+import json
+
+requests = helpers.LazyModule('requests')
+docker_registry_client = helpers.LazyModule('docker_registry_client')
 
 
 class BuildContainerImage(helpers.DistroSettings):
-    def __init__(self: object, path, dockerfile=None, entrypoint=None):
+    def __init__(self: object, path, dockerfile=None, entrypoint=None,
+                 hash_mode=None, hash_tags=None, fast_io=None):
         super(BuildContainerImage, self).__init__(path)
         self._dockerfile_path = dockerfile
         self._entrypoint_path = entrypoint
+        self._hash_mode = hash_mode
+        self._hash_tags = hash_tags
+        self._fast_io = fast_io
+        self._image_hash = None
         self.get_git_data()
 
+    @property
+    def hash_tags(self: object):
+        # Also tag images `<tag>-<hash>`; from constructor, else
+        # `imageHashTags` config key
+        if self._hash_tags is not None:
+            return self._hash_tags
+        return bool(self.distro_settings.get('imageHashTags', False))
+
+    @property
+    def fast_io(self: object):
+        # Build the image with dpkg fsync() off and `eatmydata`; from
+        # constructor, else `fastIO` config key
+        if self._fast_io is not None:
+            return self._fast_io
+        return bool(self.distro_settings.get('fastIO', False))
+
+    def image_hash_tag(self: object, image_hash: str) -> str:
+        # Immutable, content-addressed tag
+        return "{}-{}".format(self.image_tag, image_hash)
+
+    def image_registry_name_hash_tag(self: object, image_hash: str) -> str:
+        name = self.image_registry_name_tag.rsplit(':', 1)[0]
+        return "{}:{}".format(name, self.image_hash_tag(image_hash))
+
+    hash_modes = ('context', 'semantic')
+
+    @property
+    def hash_mode(self: object):
+        # Image hash mode from constructor, else `imageHashMode` config key
+        hash_mode = self._hash_mode or self.distro_settings.get(
+            'imageHashMode', 'context')
+        if hash_mode not in self.hash_modes:
+            raise ValueError("Unknown image hash mode '{}'; use one of {}".format(
+                hash_mode, ', '.join(self.hash_modes)))
+        return hash_mode
+
     @property
     def docker_registry_repo(self: object):
         return "{}/{}".format(self.docker_registry_namespace, self.image_name)
 
     def _docker_registry_client(self: object):
-        return BaseClient(
+        return docker_registry_client.BaseClient(
             self.env('DOCKER_REGISTRY_URL'),
             username=self.env('DOCKER_REGISTRY_USER'),
             password=self.env('DOCKER_REGISTRY_PASSWORD'),
         )
 
+    # Manifest types a hash tag may point to, for the `Accept` header
+    manifest_media_types = (
+        'application/vnd.docker.distribution.manifest.v2+json',
+        'application/vnd.docker.distribution.manifest.list.v2+json',
+        'application/vnd.oci.image.manifest.v1+json',
+        'application/vnd.oci.image.index.v1+json',
+        'application/vnd.docker.distribution.manifest.v1+prettyjws',
+    )
+
+    def registry_has_hash_tag(self: object, image_hash: str) -> bool:
+        # One HEAD request on the content-addressed tag's manifest:  200 if
+        # it exists, 404 if not; the client still handles the auth token
+        client = self._docker_registry_client()
+        repo = self.docker_registry_repo
+        client.auth.desired_scope = 'repository:{}:*'.format(repo)
+        try:
+            client._http_response(
+                client.MANIFEST, requests.head, name=repo,
+                reference=self.image_hash_tag(image_hash),
+                schema=', '.join(self.manifest_media_types))
+            return True
+        except requests.exceptions.HTTPError as e:
+            sys.stderr.write("No image with hash tag: {}\n".format(e))
+            return False
+
     def get_cached_image_labels(self: object):
         client = self._docker_registry_client()
         try:
@@ -82,47 +150,31 @@ class BuildContainerImage(helpers.DistroSettings):
             sys.stderr.write("No cached image: {}\n".format(e))
             return None
 
+    @property
+    def git_repo(self: object):
+        return helpers.GitRepository.for_path(self.normalized_path)
+
     def get_git_data(self: object) -> None:
-        self.git_sha = sh.git("rev-parse",
-                              "HEAD",
-                              _tty_out=False,
-                              _cwd=self.normalized_path).strip()
-        self.author_name = sh.git("show",
-                                  "-s",
-                                  "--pretty=%an",
-                                  "HEAD",
-                                  _tty_out=False,
-                                  _cwd=self.normalized_path).strip()
-        self.author_email = sh.git("show",
-                                   "-s",
-                                   "--format=%ae",
-                                   "HEAD",
-                                   _tty_out=False,
-                                   _cwd=self.normalized_path).strip()
-        self.git_remote_url = sh.git("ls-remote",
-                                     "--get-url",
-                                     _tty_out=False,
-                                     _cwd=self.normalized_path).strip()
+        head = self.git_repo.head
+        self.git_sha = head.sha
+        self.author_name = head.author_name
+        self.author_email = head.author_email
+        self.git_remote_url = self.git_repo.remote_url
 
     @property
     def dockerfile_path(self: object):
         if self._dockerfile_path is not None:
             return self._dockerfile_path
-        return pkg_resources.resource_filename(__name__, 'Dockerfile')
+        return os.path.join(os.path.dirname(__file__), 'Dockerfile')
 
     @property
     def entrypoint_path(self: object):
         if self._entrypoint_path is not None:
             return self._entrypoint_path
-        return pkg_resources.resource_filename(__name__, 'entrypoint')
+        return os.path.join(os.path.dirname(__file__), 'entrypoint')
 
     def check_path_in_git(self: object, path: str):
-        try:
-            sh.git("cat-file", "-e", "HEAD:{}".format(path),
-                   _cwd = self.normalized_path)
-            return True
-        except:
-            return False
+        return bool(self.git_repo.paths_in_head([path]))
 
     def docker_context_cm(self: object):
         """Create a pristine Docker context from git archive of the .github/docker and
@@ -130,17 +182,19 @@ class BuildContainerImage(helpers.DistroSettings):
         directory, and yield this as a context manager
         """
         want_paths = [self.debian_dir, ".github/docker"]
-        git_paths = [p for p in want_paths if self.check_path_in_git(p)]
+        git_paths = self.git_repo.paths_in_head(want_paths)
         with tempfile.TemporaryDirectory(prefix='mk-ci-tmp-context-') as context_dir:
             # Copy .github/docker and debian dir from git
-            sh.tar(
-                sh.git.archive(
-                    "--format=tar", "HEAD", "--", *git_paths,
-                    _err=sys.stderr.buffer,
-                    _cwd=self.normalized_path),
-                "xvf", "-",
-                _err=sys.stderr.buffer,
-                _cwd=context_dir)
+            if git_paths:
+                with tempfile.NamedTemporaryFile(
+                        prefix='mk-ci-tmp-context-', suffix='.tar') as tarball:
+                    self.runner.run(
+                        ["git", "archive", "--format=tar",
+                         "--output={}".format(tarball.name),
+                         "HEAD", "--"] + git_paths,
+                        cwd=self.normalized_path)
+                    self.runner.run(["tar", "xvf", tarball.name],
+                                    out=sys.stderr.buffer, cwd=context_dir)
             # Be sure debian dir exists in context or docker build will fail
             for path in want_paths:
                 context_dir_path = os.path.join(context_dir, path)
@@ -156,15 +210,49 @@ class BuildContainerImage(helpers.DistroSettings):
             context_files_dir = os.path.join(context_dir, "files")
             os.makedirs(context_files_dir)
             for path in self.docker_build_context_files:
+                # Keep the relative path; normalize away any trailing slash
+                path = os.path.normpath(path)
+                dest = os.path.join(context_files_dir, path)
                 dirname = os.path.dirname(path)
                 if dirname:
                     os.makedirs(os.path.join(context_files_dir, dirname), exist_ok=True)
                 if os.path.isfile(path):
-                    shutil.copyfile(path, os.path.join(context_files_dir, path))
+                    shutil.copyfile(path, dest)
                 else:
-                    shutil.copytree(path, context_files_dir)
+                    shutil.copytree(path, dest)
             yield context_dir
 
+    @staticmethod
+    def hash_directory(path: str) -> str:
+        """Hash a directory tree in-process
+
+        Gives the same result as the shell pipeline
+        `find . -type f -print0 | LC_ALL=C.UTF-8 sort -z | xargs -0 sha1sum |
+        sha1sum`
+        """
+        files = list()
+        for dirpath, _, fnames in os.walk(path):
+            for fname in fnames:
+                fpath = os.path.join(dirpath, fname)
+                if stat.S_ISREG(os.lstat(fpath).st_mode):
+                    files.append('.' + fpath[len(path):])
+        # Byte order, as `sort` in the C locale
+        files.sort(key=os.fsencode)
+        listing = hashlib.sha1()
+        for fname in files:
+            file_hash = hashlib.sha1()
+            with open(os.path.join(path, fname), 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 16), b''):
+                    file_hash.update(chunk)
+            line = "{}  {}\n".format(file_hash.hexdigest(), fname)
+            if '\\' in fname or '\n' in fname:
+                # `sha1sum` escapes these file names
+                line = "\\{}  {}\n".format(
+                    file_hash.hexdigest(),
+                    fname.replace('\\', '\\\\').replace('\n', '\\n'))
+            listing.update(os.fsencode(line))
+        return listing.hexdigest()
+
     def generate_image_hash(self):
         """Generate hash of Docker context
 
@@ -172,25 +260,51 @@ class BuildContainerImage(helpers.DistroSettings):
         - Get sha1sum of each file in list
         - Sort list (ensures consistency from run to run)
         - Get final sha1sum of list
+
+        In `semantic` hash mode, only hash the inputs that affect the image
         """
-        for context_dir in self.docker_context_cm():
-            sha1sum = sh.sha1sum(
-                sh.xargs(
-                    sh.sort(
-                        sh.find(
-                            '.', '-type', 'f', '-print0',
-                            _err=sys.stderr.buffer,
-                            _cwd=context_dir),
-                        '-z',
-                        # Locale differences can affect sort order
-                        _env = {**os.environ, 'LC_ALL': 'C.UTF-8'},
-                        _err=sys.stderr.buffer),
-
-                    '-0', 'sha1sum',
-                    _err=sys.stderr.buffer,
-                    _cwd=context_dir),
-                _err=sys.stderr.buffer).split()[0]
-        return sha1sum
+        if self._image_hash is None:
+            with self.tracer.span('image hash', mode=self.hash_mode):
+                for context_dir in self.docker_context_cm():
+                    if self.hash_mode == 'semantic':
+                        self._image_hash = self.semantic_hash(context_dir)
+                    else:
+                        self._image_hash = self.hash_directory(context_dir)
+            if self.fast_io:
+                # A different image from the same context
+                self._image_hash = hashlib.sha1("{}  fast-io\n".format(
+                    self._image_hash).encode()).hexdigest()
+        return self._image_hash
+
+    def semantic_hash(self: object, context_dir: str) -> str:
+        """Hash only what the image build uses from a Docker context
+
+        The image only uses `debian/control` build dependencies, so changelog
+        entries and other packaging edits don't change the hash.  Hashed:
+        - Normalized `Build-Depends*` and `Build-Conflicts*` fields
+        - `.github/docker` and `files` (`dockerBuildContextFiles`) trees
+        - Dockerfile and entrypoint
+        - `scriptPreCmd` and `scriptPostCmd` commands
+        """
+        control_path = os.path.join(context_dir, self.debian_dir, 'control')
+        control = ''
+        if os.path.exists(control_path):
+            with open(control_path, 'r') as f:
+                control = f.read()
+        inputs = dict(
+            build_dependencies=self.normalized_build_dependencies(control),
+            script_pre_cmd=self.script_pre_cmd,
+            script_post_cmd=self.script_post_cmd,
+        )
+        for path in ('.github/docker', 'files', 'Dockerfile', 'entrypoint'):
+            full_path = os.path.join(context_dir, path)
+            if os.path.isdir(full_path):
+                inputs[path] = self.hash_directory(full_path)
+            else:
+                with open(full_path, 'rb') as f:
+                    inputs[path] = hashlib.sha1(f.read()).hexdigest()
+        return hashlib.sha1(
+            json.dumps(inputs, sort_keys=True).encode()).hexdigest()
 
     def build_opt(self: object, args: list, name: str, value: str):
         args.append("--{}={}".format(name, value))
@@ -203,11 +317,11 @@ class BuildContainerImage(helpers.DistroSettings):
             self.label_prefix, name, value))
 
     def list_directory(self: object, path: str, ls_opts=['-l'], to_stderr=False):
-        sh.find('.', _cwd = path,
-                _out = sys.stderr.buffer if to_stderr else sys.stderr.buffer,
-                _err = sys.stderr.buffer)
+        self.runner.run(['find', '.'], cwd=path,
+                        out=sys.stderr.buffer if to_stderr else sys.stdout.buffer)
 
-    def build_image(self: object, target=None, dry_run=False) -> None:
+    def build_image(self: object, target=None, dry_run=False,
+                    no_cache=False) -> None:
         if any(tested is None for tested in [self.base_image,
                                              self.architecture,
                                              self.os_release,
@@ -220,8 +334,6 @@ class BuildContainerImage(helpers.DistroSettings):
         image_hash = self.generate_image_hash()
 
         # `docker build` command and arguments
-        docker_build = sh.docker.bake("build")
-
         args = list()
         # --build-arg
         self.build_arg(args, 'DEBIAN_DISTRO_BASE', self.base_image)
@@ -233,6 +345,8 @@ class BuildContainerImage(helpers.DistroSettings):
             self.build_arg(args, 'SCRIPT_PRE_CMD', self.script_pre_cmd)
         if self.script_post_cmd:
             self.build_arg(args, 'SCRIPT_POST_CMD', self.script_post_cmd)
+        if self.fast_io:
+            self.build_arg(args, 'FAST_IO', '1')
         # --label
         self.build_label(args, 'maintainer_name', self.author_name)
         self.build_label(args, 'maintainer_email', self.author_email)
@@ -249,28 +363,25 @@ class BuildContainerImage(helpers.DistroSettings):
         # - Other args
         self.build_opt(args, 'file', 'Dockerfile')
         self.build_opt(args, 'tag', image_name)
+        if self.hash_tags and target is None:
+            self.build_opt(
+                args, 'tag', self.image_registry_name_hash_tag(image_hash))
         self.build_opt(args, 'progress', 'plain')
         if target is not None:
             self.build_opt(args, 'target', target)
+        if no_cache:
+            args.append('--no-cache')
 
         # Set up Docker context
         for context_dir in self.docker_context_cm():
             # Build directory
             args.append(context_dir)
 
-            # sh.docker.build args
-            if sys.stdout.isatty():
-                sh_kwargs = dict(_fg = True)
-            else:
-                sh_kwargs = dict(_out = sys.stdout.buffer, _err = sys.stderr.buffer)
-            sh_kwargs.update(dict(_cwd=context_dir))
-
             # Show `docker build` command and list build context files
             sys.stderr.write("Building image, {} {} {}, hash {}; command:\n".format(
                 self.os_vendor, self.os_codename, self.architecture, image_hash))
             sys.stderr.write("    docker build \\\n   '{}'\n".format(
                 "' \\\n   '".join(args)))
-            sys.stderr.write("sh_kwargs: {}\n".format(sh_kwargs))
             sys.stderr.write('Docker context, {}\n'.format(context_dir))
             self.list_directory(context_dir, to_stderr=True)
             sys.stderr.flush
@@ -278,15 +389,18 @@ class BuildContainerImage(helpers.DistroSettings):
 
             # Run `docker build` (or show what would run)
             if not dry_run:
-                docker_build(*args, **sh_kwargs)
+                self.runner.run(['docker', 'build'] + args,
+                                fg=sys.stdout.isatty(), cwd=context_dir)
 
     def push_image(self: object, dry_run=False):
-        print("Command:  docker push {}".format(self.image_registry_name_tag))
-        if not dry_run:
-            sh.docker.push(self.image_registry_name_tag,
-                           _out=sys.stdout.buffer,
-                           _err=sys.stderr.buffer,
-            )
+        names = [self.image_registry_name_tag]
+        if self.hash_tags:
+            names.append(self.image_registry_name_hash_tag(
+                self.generate_image_hash()))
+        for name in names:
+            print("Command:  docker push {}".format(name))
+            if not dry_run:
+                self.runner.run(['docker', 'push', name])
 
     def get_registry_image_hash(self: object):
         labels = self.get_cached_image_labels()
@@ -311,7 +425,25 @@ class BuildContainerImage(helpers.DistroSettings):
         for label, value in labels.items():
             print("{} {}".format(label, value))
 
+    def pull_hash_tag(self: object, dry_run=False) -> bool:
+        # Pull the immutable `<tag>-<hash>` image and tag it with the mutable
+        # tag; False if the registry doesn't have it
+        image_hash = self.generate_image_hash()
+        if not self.registry_has_hash_tag(image_hash):
+            return False
+        hash_name = self.image_registry_name_hash_tag(image_hash)
+        sys.stderr.write("Pulling image, {} {} {}, hash {}; command:\n".format(
+            self.os_vendor, self.os_codename, self.architecture, image_hash))
+        sys.stderr.write("    docker pull {}\n".format(hash_name))
+        if not dry_run:
+            self.runner.run(['docker', 'pull', hash_name])
+            self.runner.run(
+                ['docker', 'tag', hash_name, self.image_registry_name_tag])
+        return True
+
     def pull_image(self: object, dry_run=False) -> bool:
+        if self.hash_tags and self.pull_hash_tag(dry_run=dry_run):
+            return True
         image_hash, result_message = self.get_registry_image_hash()
         if image_hash is None:
             sys.stderr.write(result_message + "\n")
@@ -327,10 +459,7 @@ class BuildContainerImage(helpers.DistroSettings):
             self.os_vendor, self.os_codename, self.architecture, image_hash))
         sys.stderr.write("    docker pull {}\n".format(self.image_registry_name_tag))
         if not dry_run:
-            sh.docker.pull(self.image_registry_name_tag,
-                           _out=sys.stdout.buffer,
-                           _err=sys.stderr.buffer,
-            )
+            self.runner.run(['docker', 'pull', self.image_registry_name_tag])
         return True
 
     def show_hash(self:object):
@@ -372,6 +501,23 @@ class BuildContainerImage(helpers.DistroSettings):
         parser.add_argument("--pull",
                             action="store_true",
                             help="Pull Docker image (only if matching local repo)")
+        parser.add_argument("--hash-mode",
+                            choices=cls.hash_modes,
+                            help="Hash whole Docker context, or only semantic "
+                            "image inputs (default: imageHashMode config key, "
+                            "else 'context')")
+        parser.add_argument("--hash-tag",
+                            action="store_const",
+                            const=True,
+                            dest="hash_tags",
+                            help="Also tag and push images as TAG-HASH, and pull "
+                            "by that tag (default: imageHashTags config key)")
+        parser.add_argument("--fast-io",
+                            action="store_const",
+                            const=True,
+                            dest="fast_io",
+                            help="Build the image with dpkg fsync() off and "
+                            "eatmydata installed (default: fastIO config key)")
         parser.add_argument("--show-hash",
                             action="store_true",
                             help="Show local source tree image hash (for debugging)")
@@ -391,6 +537,8 @@ class BuildContainerImage(helpers.DistroSettings):
         try:
             buildcontainerimage = BuildContainerImage(
                 args.path, dockerfile=args.dockerfile, entrypoint=args.entrypoint,
+                hash_mode=args.hash_mode, hash_tags=args.hash_tags,
+                fast_io=args.fast_io,
             )
 
             if not buildcontainerimage.set_os_arch_combination(
@@ -417,6 +565,6 @@ class BuildContainerImage(helpers.DistroSettings):
                     sys.exit(1)
             if args.show_hash:
                 buildcontainerimage.show_hash()
-        except ValueError as e:
+        except (ValueError, helpers.CommandError) as e:
             print(e)
             sys.exit(1)
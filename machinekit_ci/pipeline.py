@@ -0,0 +1,494 @@
+#!/usr/bin/env python3
+"""
+Run the whole CI pipeline locally for all build matrix entries
+"""
+
+import argparse
+import os
+import sys
+import json
+import time
+import shutil
+import hashlib
+import tempfile
+import fnmatch
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import machinekit_ci.script_helpers as helpers
+
+
+class PipelineNode(object):
+    """One stage of one matrix entry in the pipeline graph
+
+    `action(node, log)` does the work, writing command output to the binary
+    stream `log`.  Nodes with the same `lock` and different entries never
+    overlap; an entry holds its lock from its first to its last locked node.
+    """
+    def __init__(self: object, entry: str, stage: str, action, deps=(),
+                 cpus=1, memory_mb=256, lock=None, fingerprint='',
+                 combination=None):
+        self.entry = entry
+        self.stage = stage
+        self.combination = combination
+        self.action = action
+        self.deps = list(deps)
+        self.cpus = cpus
+        self.memory_mb = memory_mb
+        self.lock = lock
+        self.fingerprint = fingerprint
+        self.input_hash = None
+        self.chain_end = None  # Last node of this entry holding `lock`
+        self.status = 'pending'  # pending, running, skipped, done, failed, blocked
+        self.duration = None
+
+    @property
+    def name(self: object) -> str:
+        return "{}:{}".format(self.entry, self.stage)
+
+    @property
+    def finished(self: object) -> bool:
+        return self.status in ('skipped', 'done', 'failed', 'blocked')
+
+    def compute_input_hash(self: object) -> str:
+        # Hash of this node's inputs and all its dependencies' input hashes
+        inputs = dict(name=self.name, fingerprint=self.fingerprint,
+                      deps=[d.input_hash for d in self.deps])
+        self.input_hash = hashlib.sha1(
+            json.dumps(inputs, sort_keys=True).encode()).hexdigest()
+        return self.input_hash
+
+
+class Pipeline(helpers.DistroSettings):
+    """Build graph of image, configure, build, sign, collect and upload steps
+    for every `allowedCombinations` entry
+
+    Independent nodes run in parallel within CPU and memory limits.  Entries
+    share one source tree, so each entry's configure through collect steps
+    hold the `source` lock.  Completed nodes are recorded with their input
+    hashes in `state.json` in the output directory; re-running skips nodes
+    whose inputs haven't changed, so a failed run resumes where it stopped.
+    """
+    stages = ('image', 'configure', 'build', 'sign', 'collect', 'upload')
+
+    # Default (cpus, memory MiB) reserved for each stage
+    stage_resources = dict(
+        image=(1, 2048), configure=(1, 512), build=(2, 2048), sign=(1, 256),
+        collect=(1, 128), upload=(1, 256))
+
+    # Stages that use the shared source tree and its parent directory
+    source_stages = ('configure', 'build', 'sign', 'collect')
+
+    state_format_version = 1
+
+    def __init__(self: object, path, output_dir=None, entries=None,
+                 until='upload', sign=False, upload=False, push_images=False,
+                 jobs=None, memory_mb=None, force=False):
+        super(Pipeline, self).__init__(path)
+        self.output_dir = os.path.abspath(
+            output_dir or os.path.join(self.parent_dir, 'mkci'))
+        self.entry_patterns = entries or ['*']
+        self.until = until
+        self.sign = sign
+        self.upload = upload
+        self.push_images = push_images
+        self.jobs = jobs or os.cpu_count() or 1
+        self.memory_mb = memory_mb or self.available_memory_mb()
+        self.force = force
+        self.state = self.load_state()
+
+    @staticmethod
+    def available_memory_mb() -> int:
+        # MemAvailable from /proc/meminfo, or unlimited if unknown
+        try:
+            with open('/proc/meminfo', 'r') as f:
+                for line in f:
+                    if line.startswith('MemAvailable:'):
+                        return int(line.split()[1]) // 1024
+        except OSError:
+            pass
+        return sys.maxsize
+
+    @property
+    def state_path(self: object) -> str:
+        return os.path.join(self.output_dir, 'state.json')
+
+    def load_state(self: object) -> dict:
+        try:
+            with open(self.state_path, 'r') as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            state = dict()
+        if state.get('format_version') != self.state_format_version:
+            state = dict(format_version=self.state_format_version)
+        state.setdefault('nodes', dict())
+        state.setdefault('locks', dict())
+        return state
+
+    def save_state(self: object) -> None:
+        os.makedirs(self.output_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(prefix='.state-', dir=self.output_dir)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(self.state, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.state_path)
+
+    #
+    # Input fingerprints
+    #
+    @property
+    def git_repo(self: object):
+        return helpers.GitRepository.for_path(self.normalized_path)
+
+    def image_fingerprint(self: object) -> str:
+        # Images are built from `.github` and `debian/` in the HEAD commit
+        debian_dir = os.path.relpath(
+            os.path.join(self.source_dir, self.debian_dir), self.git_repo.root)
+        return self.runner.output(
+            ['git', 'ls-tree', 'HEAD', '--', '.github', debian_dir],
+            cwd=self.git_repo.root)
+
+    def worktree_fingerprint(self: object) -> str:
+        # Packages are built from the work tree:  HEAD plus modified files
+        fingerprint = hashlib.sha1(self.git_repo.head.sha.encode())
+        changed = self.runner.output(
+            ['git', 'diff', 'HEAD', '--name-only', '-z'], cwd=self.git_repo.root)
+        for path in sorted(p for p in changed.split('\0') if p):
+            fingerprint.update(path.encode() + b'\0')
+            full_path = os.path.join(self.git_repo.root, path)
+            if os.path.isfile(full_path):
+                with open(full_path, 'rb') as f:
+                    fingerprint.update(hashlib.sha1(f.read()).digest())
+        return fingerprint.hexdigest()
+
+    #
+    # Graph
+    #
+    def entry_name(self: object, combination) -> str:
+        return "{}-{}-{}-{}".format(
+            self.package, combination.os_vendor, combination.os_release,
+            combination.architecture)
+
+    def artifact_dir(self: object, entry: str) -> str:
+        # Named like CI artifacts, so `cloudsmithupload` can parse it
+        return os.path.join(self.output_dir, 'artifacts', '{}-{}-local'.format(
+            entry, self.git_repo.head.sha[:7]))
+
+    def combinations(self: object):
+        for combination in self.settings_index:
+            name = self.entry_name(combination)
+            if any(fnmatch.fnmatch(name, p) for p in self.entry_patterns):
+                yield name, combination
+
+    def build_graph(self: object) -> list:
+        stages = self.stages[:self.stages.index(self.until) + 1]
+        if not self.sign:
+            stages = tuple(s for s in stages if s != 'sign')
+        if not self.upload:
+            stages = tuple(s for s in stages if s != 'upload')
+        fingerprints = dict(image=self.image_fingerprint())
+        worktree = self.worktree_fingerprint()
+        options = dict(sign=self.sign, push_images=self.push_images)
+        nodes = list()
+        for entry, combination in self.combinations():
+            previous = None
+            for stage in stages:
+                cpus, memory_mb = self.stage_resources[stage]
+                node = PipelineNode(
+                    entry, stage,
+                    action=getattr(self, 'run_{}'.format(stage)),
+                    deps=[previous] if previous else [],
+                    cpus=cpus, memory_mb=memory_mb,
+                    lock='source' if stage in self.source_stages else None,
+                    fingerprint=json.dumps(dict(
+                        inputs=fingerprints.get(stage, worktree),
+                        options=options), sort_keys=True),
+                    combination=combination)
+                node.compute_input_hash()
+                nodes.append(node)
+                previous = node
+            locked = [n for n in nodes if n.entry == entry and n.lock]
+            for node in locked:
+                node.chain_end = locked[-1]
+        return nodes
+
+    #
+    # Stage actions
+    #
+    def tool_argv(self: object, node, tool: str, *args) -> list:
+        c = node.combination
+        return [tool, '--path', self.normalized_path] + list(args) + [
+            c.os_release, c.architecture]
+
+    def rundocker_argv(self: object, node, cmd: list, docker_opts=()) -> list:
+        c = node.combination
+        return (['rundocker', '--path', self.normalized_path, '--notty']
+                + list(docker_opts) + [c.os_release, c.architecture] + cmd)
+
+    def run_image(self: object, node, log) -> None:
+        # Pull a matching image, else build it
+        try:
+            self.runner.run(self.tool_argv(node, 'containerimage', '--pull'),
+                            out=log, err=log)
+        except helpers.CommandError:
+            self.runner.run(self.tool_argv(node, 'containerimage', '--build'),
+                            out=log, err=log)
+            if self.push_images:
+                self.runner.run(self.tool_argv(node, 'containerimage', '--push'),
+                                out=log, err=log)
+
+    def run_configure(self: object, node, log) -> None:
+        self.runner.run(self.rundocker_argv(
+            node, ['buildpackages', '--configure-source']), out=log, err=log)
+
+    def run_build(self: object, node, log) -> None:
+        self.runner.run(self.rundocker_argv(
+            node, ['buildpackages', '--build-packages']), out=log, err=log)
+
+    def run_sign(self: object, node, log) -> None:
+        # Import the key from $PACKAGE_SIGNING_KEY into a private GNUPGHOME
+        gnupg_home = tempfile.mkdtemp(prefix='mkci-gnupg-')
+        env = dict(os.environ, GNUPGHOME=gnupg_home)
+        docker_opts = ['--env', 'GNUPGHOME', '--env', 'PACKAGE_SIGNING_KEY',
+                       '--env', 'PACKAGE_SIGNING_KEY_ID', '--volume', gnupg_home]
+        try:
+            self.runner.run(self.rundocker_argv(
+                node, ['buildpackages', '--import-gpg-from-secret-env-var',
+                       'PACKAGE_SIGNING_KEY'], docker_opts),
+                            out=log, err=log, env=env)
+            self.runner.run(self.rundocker_argv(
+                node, ['buildpackages', '--sign-packages'], docker_opts),
+                            out=log, err=log, env=env)
+        finally:
+            shutil.rmtree(gnupg_home, ignore_errors=True)
+
+    def run_collect(self: object, node, log) -> None:
+        # Copy package files out of the shared parent directory
+        listing = self.runner.output(self.rundocker_argv(
+            node, ['buildpackages', '--list-packages', '--with-buildinfo',
+                   '--with-changes']))
+        dest = self.artifact_dir(node.entry)
+        shutil.rmtree(dest, ignore_errors=True)
+        os.makedirs(dest)
+        for path in listing.split():
+            shutil.copy2(path, dest)
+            log.write("Collected {}\n".format(path).encode())
+
+    def run_upload(self: object, node, log) -> None:
+        self.runner.run(
+            ['cloudsmithupload', '--path', self.normalized_path,
+             '--package-directory', self.artifact_dir(node.entry),
+             '--from-changes'], out=log, err=log)
+
+    #
+    # Scheduler
+    #
+    def is_recorded_done(self: object, node) -> bool:
+        recorded = self.state['nodes'].get(node.name, dict())
+        return (recorded.get('status') == 'done'
+                and recorded.get('hash') == node.input_hash)
+
+    def can_skip(self: object, node) -> bool:
+        if self.force or any(d.status != 'skipped' for d in node.deps):
+            return False
+        if not self.is_recorded_done(node):
+            return False
+        if node.stage == 'collect' and not os.path.isdir(
+                self.artifact_dir(node.entry)):
+            return False
+        if node.lock is None or self.state['locks'].get(node.lock) == node.entry:
+            return True
+        # Another entry has used the source tree since; the entry's steps
+        # may only be skipped if its packages were already collected
+        end = node.chain_end
+        return (end.stage == 'collect' and self.is_recorded_done(end)
+                and os.path.isdir(self.artifact_dir(end.entry)))
+
+    @staticmethod
+    def downstream(nodes: list, node) -> list:
+        # Nodes depending directly or indirectly on `node`; `nodes` are in
+        # dependency order
+        found = set([node])
+        for n in nodes:
+            if any(d in found for d in n.deps):
+                found.add(n)
+        found.discard(node)
+        return [n for n in nodes if n in found]
+
+    def log_path(self: object, node) -> str:
+        return os.path.join(self.output_dir, 'logs', node.name.replace(':', '.') + '.log')
+
+    def execute(self: object, node) -> None:
+        start = time.perf_counter()
+        os.makedirs(os.path.dirname(self.log_path(node)), exist_ok=True)
+        with open(self.log_path(node), 'wb') as log:
+            node.action(node, log)
+        node.duration = time.perf_counter() - start
+
+    def report(self: object, message: str) -> None:
+        sys.stderr.write("[mkci] {}\n".format(message))
+        sys.stderr.flush()
+
+    def run(self: object, dry_run=False) -> list:
+        # Run the graph; return failed nodes
+        nodes = self.build_graph()
+        if dry_run:
+            # Nodes are in dependency order
+            for node in nodes:
+                skip = self.can_skip(node)
+                node.status = 'skipped' if skip else 'pending'
+                self.report("{:<8} {}".format(
+                    'skip' if skip else 'run', node.name))
+            return []
+        os.makedirs(self.output_dir, exist_ok=True)
+        lock_holders = dict()
+        running = dict()  # future -> node
+        used_cpus = used_memory = 0
+        failed = list()
+        with ThreadPoolExecutor(max_workers=max(1, len(nodes))) as executor:
+            while True:
+                for node in nodes:
+                    if node.status == 'pending' and any(
+                            d.status in ('failed', 'blocked') for d in node.deps):
+                        node.status = 'blocked'
+                        self.report("blocked  {}".format(node.name))
+                # Release locks held by entries with no unfinished locked nodes
+                for lock, entry in list(lock_holders.items()):
+                    if all(n.finished for n in nodes
+                           if n.lock == lock and n.entry == entry):
+                        del lock_holders[lock]
+                # Start ready nodes, continuing entries' later stages first
+                ready = [n for n in nodes if n.status == 'pending'
+                         and all(d.status in ('skipped', 'done') for d in n.deps)]
+                ready.sort(key=lambda n: -self.stages.index(n.stage))
+                started = False
+                for node in ready:
+                    if node.lock and lock_holders.get(node.lock, node.entry) != node.entry:
+                        continue
+                    if node.lock:
+                        lock_holders[node.lock] = node.entry
+                    if self.can_skip(node):
+                        node.status = 'skipped'
+                        self.report("skip     {}".format(node.name))
+                        started = True
+                        continue
+                    if running and (used_cpus + node.cpus > self.jobs
+                                    or used_memory + node.memory_mb > self.memory_mb):
+                        continue
+                    if node.lock:
+                        self.state['locks'][node.lock] = node.entry
+                    # Results of later steps are stale once this one reruns
+                    for later in self.downstream(nodes, node):
+                        self.state['nodes'].pop(later.name, None)
+                    node.status = 'running'
+                    used_cpus += node.cpus
+                    used_memory += node.memory_mb
+                    self.report("start    {}".format(node.name))
+                    running[executor.submit(self.execute, node)] = node
+                    started = True
+                if started:
+                    continue
+                if not running:
+                    break
+                done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+                for future in done:
+                    node = running.pop(future)
+                    used_cpus -= node.cpus
+                    used_memory -= node.memory_mb
+                    error = future.exception()
+                    if error is None:
+                        node.status = 'done'
+                        self.state['nodes'][node.name] = dict(
+                            status='done', hash=node.input_hash,
+                            duration=node.duration)
+                        self.report("done     {} ({:.1f}s)".format(
+                            node.name, node.duration))
+                    else:
+                        node.status = 'failed'
+                        failed.append(node)
+                        self.state['nodes'][node.name] = dict(
+                            status='failed', hash=node.input_hash)
+                        self.report("FAILED   {}:  {}; log:  {}".format(
+                            node.name, error, self.log_path(node)))
+                    self.save_state()
+        self.save_state()
+        return failed
+
+    def print_status(self: object) -> None:
+        for name, record in sorted(self.state['nodes'].items()):
+            duration = record.get('duration')
+            print("{:<8} {:>8} {}".format(
+                record['status'],
+                '-' if duration is None else '{:.1f}s'.format(duration), name))
+
+    @classmethod
+    def cli(cls):
+        parser = argparse.ArgumentParser(
+            description="Run the CI pipeline locally for all build matrix entries")
+        parser.add_argument("-p",
+                            "--path",
+                            action=helpers.PathExistsAction,
+                            default=os.getcwd(),
+                            help="Path to root of git repository")
+        parser.add_argument("--output-dir",
+                            help="Directory for state, logs and collected "
+                            "packages (default: ../mkci)")
+        subparsers = parser.add_subparsers(dest="command")
+        subparsers.required = True
+
+        run_parser = subparsers.add_parser(
+            "run", help="Run pipeline, skipping steps whose inputs are unchanged")
+        run_parser.add_argument("--entries",
+                                action="append",
+                                metavar="PATTERN",
+                                help="Only matrix entries matching glob, e.g. "
+                                "'*-debian-10-*' (may be repeated)")
+        run_parser.add_argument("--until",
+                                choices=cls.stages,
+                                default="upload",
+                                help="Last stage to run (default: upload)")
+        run_parser.add_argument("--sign",
+                                action="store_true",
+                                default=bool(os.environ.get('PACKAGE_SIGNING_KEY')),
+                                help="Sign packages (default: if "
+                                "$PACKAGE_SIGNING_KEY is set)")
+        run_parser.add_argument("--upload",
+                                action="store_true",
+                                help="Upload packages to Cloudsmith")
+        run_parser.add_argument("--push-images",
+                                action="store_true",
+                                help="Push newly built images to the registry")
+        run_parser.add_argument("-j",
+                                "--jobs",
+                                type=int,
+                                help="CPUs to use (default: all)")
+        run_parser.add_argument("--memory",
+                                type=int,
+                                metavar="MIB",
+                                help="Memory to use (default: available memory)")
+        run_parser.add_argument("--force",
+                                action="store_true",
+                                help="Run all steps, even if inputs are unchanged")
+        run_parser.add_argument("--dry-run",
+                                action="store_true",
+                                help="Show which steps would run")
+
+        subparsers.add_parser("status", help="Show steps recorded in state file")
+
+        args = parser.parse_args()
+
+        try:
+            if args.command == "status":
+                cls(args.path, output_dir=args.output_dir).print_status()
+                return
+            pipeline = cls(
+                args.path, output_dir=args.output_dir, entries=args.entries,
+                until=args.until, sign=args.sign, upload=args.upload,
+                push_images=args.push_images, jobs=args.jobs,
+                memory_mb=args.memory, force=args.force)
+            failed = pipeline.run(dry_run=args.dry_run)
+        except (ValueError, helpers.CommandError) as e:
+            sys.stderr.write("Error:  {}\n".format(e))
+            sys.exit(1)
+        if failed:
+            sys.stderr.write("Error:  {} failed:  {}\n".format(
+                len(failed), ', '.join(n.name for n in failed)))
+            sys.exit(1)
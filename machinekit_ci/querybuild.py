@@ -4,22 +4,34 @@ Script to query the Machinekit CI YAML configuration
 """
 
 import argparse
-import sh
 import os
 import sys
+import io
 import json
-import yaml
+import fnmatch
 import machinekit_ci.script_helpers as helpers
 
+yaml = helpers.LazyModule('yaml')
+
 class Query(helpers.DistroSettings):
     _query_keys = set()
-    def __init__(self: object, path, version, architecture):
+    def __init__(self: object, path, version, architecture,
+                 duration_history=None, max_jobs=None, base_commit=None,
+                 prune=False):
         super(Query, self).__init__(path, version, architecture)
         self._hash_os_distros()
+        self.duration_history = duration_history
+        self.max_jobs = max_jobs
+        self.base_commit = base_commit
+        # Shard only the entries affected by changes since the base commit
+        self.prune = prune
+        self._github_context = dict()
 
         if 'GITHUB_CONTEXT' in os.environ:
             with io.StringIO(os.environ['GITHUB_CONTEXT']) as f:
                 self._github_context = json.load(f)
+        if self.base_commit is None:
+            self.base_commit = self.default_base_commit
 
     def _hash_os_distros(self):
         # Create dicts of the `osDistros` config with release and codename as keys
@@ -32,11 +44,14 @@ class Query(helpers.DistroSettings):
             for c in self.distro_settings['allowedCombinations']
         }
         for k, v in self._matrix_dict.items():
-            # Add architecture, lower-case vendor, artifact name
+            # Add architecture, lower-case vendor, artifact name, and whether
+            # the entry builds the release's arch-indep packages
             v['architecture'] = k[0]
             v['vendorLower'] = v['vendor'].lower()
             v['artifactNameBase'] = "{}-{}-{}-{}".format(
                 self.package, v['vendor'].lower(), v['release'], v['architecture'],)
+            v['buildIndep'] = (
+                self.indep_architecture(v['release']) == k[0].lower())
 
     class _query_property:
         query_keys = dict()
@@ -54,6 +69,60 @@ class Query(helpers.DistroSettings):
         '''Main matrix used in GitHub Actions'''
         return dict(include=list(self._matrix_dict.values()))
 
+    @_query_property
+    def github_sharded_matrix(self):
+        '''Main matrix balanced by build duration history'''
+        jobs = list()
+        for shard, entries in enumerate(self.shard_entries(), start=1):
+            # Job fields come from its longest entry, so a single-entry job
+            # looks like a `github_main_matrix` entry
+            job = entries[0].copy()
+            job.update(
+                shard=shard,
+                entries=entries,
+                estimatedDuration=round(sum(
+                    self.entry_durations[e['artifactNameBase']]
+                    for e in entries)),
+            )
+            jobs.append(job)
+        return dict(include=jobs)
+
+    @_query_property
+    def github_pruned_matrix(self):
+        '''Main matrix reduced to entries affected by changes since base commit'''
+        return dict(include=self.pruned_entries())
+
+    @_query_property
+    def has_builds(self):
+        ''''true' if the sharded matrix has jobs, else 'false' (GitHub rejects empty matrixes)'''
+        return 'true' if self.github_sharded_matrix['include'] else 'false'
+
+    def pruned_entries(self):
+        report = self.matrix_change_report
+        include = list()
+        for entry in self._matrix_dict.values():
+            reason = report['entries'][entry['artifactNameBase']]
+            if reason is None:
+                continue
+            entry = entry.copy()
+            entry.update(rebuildImage=reason['rebuildImage'],
+                         changeReason=reason['reason'])
+            include.append(entry)
+        return include
+
+    def matrix_entries(self):
+        # Entries to shard:  all, or with `prune` only those affected
+        if self.prune:
+            return self.pruned_entries()
+        return list(self._matrix_dict.values())
+
+    @_query_property
+    def matrix_change_report(self):
+        '''Why each main matrix entry is or isn't affected by changes since base commit'''
+        if getattr(self, '_matrix_change_report', None) is None:
+            self._matrix_change_report = self.analyze_changes()
+        return self._matrix_change_report
+
     @_query_property
     def github_os_matrix(self):
         '''OS matrix used in GitHub Actions'''
@@ -70,11 +139,226 @@ class Query(helpers.DistroSettings):
         '''List of Docker images'''
         images = list()
         for architecture, release in self._matrix_dict.keys():
-            self.set_os_arch_combination(release, architecture)
-            images.append(self.image_name)
+            combination = self.resolve_os_arch_combination(release, architecture)
+            images.append(self.image_name_for(combination))
         return images
 
 
+    # Number of most recent history records averaged per matrix entry
+    duration_history_window = 5
+
+    def read_duration_history(self):
+        # Return {artifactNameBase: [duration, ...]} from JSON or JSON lines
+        # files; records have `duration` seconds and either `artifactNameBase`
+        # or `architecture` and `release` (or codename)
+        path = self.duration_history
+        history = dict()
+        if not path:
+            return history
+        if os.path.isdir(path):
+            paths = sorted(
+                os.path.join(path, f) for f in os.listdir(path)
+                if f.endswith(('.json', '.jsonl')))
+        else:
+            paths = [path]
+        names = {
+            (arch, str(os_data[key]).lower()): os_data['artifactNameBase']
+            for (arch, _), os_data in self._matrix_dict.items()
+            for key in ('release', 'codename')}
+        for fpath in paths:
+            with open(fpath, 'r') as f:
+                text = f.read()
+            try:
+                records = json.loads(text)
+            except ValueError:
+                records = [json.loads(l) for l in text.splitlines() if l.strip()]
+            if isinstance(records, dict):
+                records = [records]
+            for record in records:
+                name = record.get('artifactNameBase', None) or names.get(
+                    (record.get('architecture'),
+                     str(record.get('release', record.get('codename'))).lower()))
+                if name is not None and 'duration' in record:
+                    history.setdefault(name, list()).append(
+                        float(record['duration']))
+        return history
+
+    @property
+    def entry_durations(self):
+        # {artifactNameBase: estimated seconds}; entries without history get
+        # the mean of the others, or 1 if there is no history at all
+        if getattr(self, '_entry_durations', None) is None:
+            history = self.read_duration_history()
+            durations = {
+                name: sum(d[-self.duration_history_window:])
+                / len(d[-self.duration_history_window:])
+                for name, d in history.items()}
+            default = (sum(durations.values()) / len(durations)
+                       if durations else 1.0)
+            self._entry_durations = {
+                v['artifactNameBase']: durations.get(v['artifactNameBase'], default)
+                for v in self._matrix_dict.values()}
+        return self._entry_durations
+
+    def shard_entries(self):
+        # Pack matrix entries into jobs, longest first:  first-fit decreasing
+        # with the longest entry as capacity, so short entries share a job
+        # without lengthening the critical path; if that needs more than
+        # `max_jobs` jobs, greedily fill the least-loaded of `max_jobs` jobs
+        durations = self.entry_durations
+        entries = sorted(self.matrix_entries(),
+                         key=lambda e: -durations[e['artifactNameBase']])
+        if not entries:
+            return []
+        capacity = durations[entries[0]['artifactNameBase']]
+        shards = list()
+        for entry in entries:
+            duration = durations[entry['artifactNameBase']]
+            for shard in shards:
+                if shard[0] + duration <= capacity:
+                    shard[0] += duration
+                    shard[1].append(entry)
+                    break
+            else:
+                shards.append([duration, [entry]])
+        if self.max_jobs and len(shards) > self.max_jobs:
+            shards = [[0.0, list()] for _ in range(self.max_jobs)]
+            for entry in entries:
+                shard = min(shards, key=lambda s: s[0])
+                shard[0] += durations[entry['artifactNameBase']]
+                shard[1].append(entry)
+        shards.sort(key=lambda s: -s[0])
+        return [s[1] for s in shards if s[1]]
+
+    # Changed paths that never require a rebuild; extended by the
+    # `ignoredPaths` config key
+    ignored_paths = (
+        '*.md', '*.rst', 'doc/*', 'docs/*', 'README*', 'LICENSE*', 'COPYING*',
+        'AUTHORS*', '.github/workflows/*', '.github/local-env-sample.yaml')
+
+    # Null SHA GitHub sends as `before` for newly pushed branches
+    null_commit = '0' * 40
+
+    @property
+    def default_base_commit(self):
+        # Pull request base, else commit before a push, from $GITHUB_CONTEXT
+        event = self._github_context.get('event', dict())
+        return (event.get('pull_request', dict()).get('base', dict()).get('sha')
+                or event.get('before'))
+
+    def is_ignored_path(self, path):
+        patterns = self.ignored_paths + tuple(
+            self.distro_settings.get('ignoredPaths', []))
+        return any(fnmatch.fnmatch(path, p) for p in patterns)
+
+    def image_input_paths(self):
+        # Repo-relative paths whose changes need new builder images
+        paths = ['.github/docker']
+        for cmd in (self.script_pre_cmd, self.script_post_cmd):
+            if cmd:
+                paths.append(os.path.normpath(cmd.split()[0]))
+        paths.extend(os.path.normpath(p) for p in self.docker_build_context_files)
+        return paths
+
+    def changed_settings_entries(self, git_repo, base, settings_path):
+        # Matrix entries whose settings differ from `base`; all entries if
+        # settings outside `osDistros` and `allowedCombinations` changed
+        base_text = git_repo.file_at(base, settings_path)
+        base_settings = yaml.safe_load(base_text) if base_text else None
+        if not isinstance(base_settings, dict):
+            return set(self._matrix_dict)
+        ignore = ('osDistros', 'allowedCombinations', 'ignoredPaths')
+        if ({k: v for k, v in base_settings.items() if k not in ignore}
+                != {k: v for k, v in self.distro_settings.items() if k not in ignore}):
+            return set(self._matrix_dict)
+        base_distros = {
+            str(d.get('release')): d for d in base_settings.get('osDistros', [])}
+        base_combinations = set(
+            (c.get('architecture'), str(c.get('release')))
+            for c in base_settings.get('allowedCombinations', []))
+        changed = set()
+        for key, os_data in self._matrix_dict.items():
+            release = str(os_data['release'])
+            if ((key[0], release) not in base_combinations
+                    or self._os_distro_dict[key[1]] != base_distros.get(release)):
+                changed.add(key)
+        return changed
+
+    def analyze_changes(self):
+        # Classify paths changed since the base commit and decide, for each
+        # matrix entry, whether it must be rebuilt and whether its image
+        # inputs changed
+        names = {k: v['artifactNameBase'] for k, v in self._matrix_dict.items()}
+        report = dict(base=self.base_commit, changedPaths=dict(), entries=dict())
+
+        def mark(keys, reason, rebuild_image):
+            for key in keys:
+                current = report['entries'].get(names[key])
+                if current is None or (rebuild_image and not current['rebuildImage']):
+                    report['entries'][names[key]] = dict(
+                        reason=reason, rebuildImage=rebuild_image)
+
+        git_repo = helpers.GitRepository.for_path(self.normalized_path)
+        base = self.base_commit
+        if base and base != self.null_commit:
+            base = git_repo.resolve_commit(base)
+        else:
+            base = None
+        if base is None:
+            mark(self._matrix_dict, "base commit {} unavailable".format(
+                self.base_commit), True)
+            sys.stderr.write("Base commit {} unavailable; building all\n".format(
+                self.base_commit))
+            return report
+        report['base'] = base
+
+        settings_path = os.path.relpath(self.yaml_path, git_repo.root)
+        # The first source's `debian_dir`, and `debian/` of every source
+        control_paths = set(
+            os.path.normpath(os.path.join(
+                os.path.relpath(d, git_repo.root), 'debian', 'control'))
+            for d in self.source_dirs)
+        control_paths.add(os.path.normpath(os.path.join(
+            os.path.relpath(self.source_dir, git_repo.root),
+            self.debian_dir, 'control')))
+        image_paths = self.image_input_paths()
+        for path in git_repo.changed_paths(base):
+            if path == settings_path:
+                category = 'settings'
+                mark(self.changed_settings_entries(git_repo, base, settings_path),
+                     "{} changed".format(path), True)
+            elif any(path == p or path.startswith(p + '/') for p in image_paths):
+                category = 'image'
+                mark(self._matrix_dict, "image input {} changed".format(path), True)
+            elif path in control_paths:
+                base_control = git_repo.file_at(base, path) or ''
+                control_file = os.path.join(git_repo.root, path)
+                control = ''
+                if os.path.exists(control_file):
+                    with open(control_file, 'r') as f:
+                        control = f.read()
+                if (self.normalized_build_dependencies(base_control)
+                        != self.normalized_build_dependencies(control)):
+                    category = 'image'
+                    mark(self._matrix_dict,
+                         "build dependencies in {} changed".format(path), True)
+                else:
+                    category = 'source'
+                    mark(self._matrix_dict, "{} changed".format(path), False)
+            elif self.is_ignored_path(path):
+                category = 'ignored'
+            else:
+                category = 'source'
+                mark(self._matrix_dict, "{} changed".format(path), False)
+            report['changedPaths'][path] = category
+
+        for name in names.values():
+            report['entries'].setdefault(name, None)
+        for name, reason in sorted(report['entries'].items()):
+            sys.stderr.write("{}:  {}\n".format(
+                name, reason['reason'] if reason else "unaffected; skipping"))
+        return report
+
     def list_keys(self):
         for k, doc in self._query_property.query_keys.items():
             print("{}:  {}".format(k, doc))
@@ -109,6 +393,25 @@ class Query(helpers.DistroSettings):
                             help="OS version number or codename")
         parser.add_argument("--architecture",
                             help="Debian architecture")
+        parser.add_argument("--duration-history",
+                            default=os.environ.get(
+                                'MACHINEKIT_CI_DURATION_HISTORY', None),
+                            help="JSON file or directory of build duration "
+                            "records for github_sharded_matrix "
+                            "(default: $MACHINEKIT_CI_DURATION_HISTORY)")
+        parser.add_argument("--max-jobs",
+                            type=int,
+                            help="Maximum jobs in github_sharded_matrix")
+        parser.add_argument("--base-commit",
+                            default=os.environ.get('MACHINEKIT_CI_BASE_COMMIT', None),
+                            help="Commit to compare HEAD against for "
+                            "github_pruned_matrix (default: "
+                            "$MACHINEKIT_CI_BASE_COMMIT, else the pull request "
+                            "base or previous push from $GITHUB_CONTEXT)")
+        parser.add_argument("--prune",
+                            action="store_true",
+                            help="Only put entries affected by changes since "
+                            "--base-commit in github_sharded_matrix")
         parser.add_argument("--list-keys",
                             action="store_true",
                             help="List all keys")
@@ -127,7 +430,10 @@ class Query(helpers.DistroSettings):
                             help="Key to query")
 
         args = parser.parse_args()
-        query_obj = cls(path=args.path, version=args.version, architecture=args.architecture)
+        query_obj = cls(path=args.path, version=args.version, architecture=args.architecture,
+                        duration_history=args.duration_history,
+                        max_jobs=args.max_jobs, base_commit=args.base_commit,
+                        prune=args.prune)
         if args.list_keys:
             query_obj.list_keys()
         elif args.query_keys:
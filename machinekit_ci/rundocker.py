@@ -4,16 +4,246 @@ Script for running Machinekit CI commands in Docker
 """
 
 import argparse
-import sh
 import os
 import sys
+import re
+import json
+import time
+import shutil
+import tempfile
+import threading
 import machinekit_ci.script_helpers as helpers
 
 
+class ResourceSampler(object):
+    """Sample a container's CPU, memory and block I/O while it runs
+
+    The container ID is read from the `docker run --cidfile` file.  Counters
+    come from the container's cgroup (v2, or v1 controllers) under the
+    `cgroupfs` or `systemd` Docker cgroup drivers; when no cgroup is found,
+    e.g. with a remote daemon, `docker stats` is polled instead.  Samples are
+    kept in `samples` as rows of `columns`.
+    """
+    cgroup_root = '/sys/fs/cgroup'
+    columns = ('t', 'cpu_percent', 'mem_bytes', 'io_read_bytes',
+               'io_write_bytes', 'nr_throttled')
+    units = dict(b=1, kb=10**3, mb=10**6, gb=10**9, tb=10**12,
+                 kib=2**10, mib=2**20, gib=2**30, tib=2**40)
+
+    def __init__(self: object, cidfile: str, interval=1.0, runner=None):
+        self.cidfile = cidfile
+        self.interval = interval
+        self.runner = runner or helpers.CommandRunner.default()
+        self.samples = list()
+        self.source = None
+        self.mem_peak = 0
+        self.throttled_usec = 0
+        self.cpu_usec = None
+        self._cgroup = None
+        self._last = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self: object) -> None:
+        self.start_time = time.monotonic()
+        self._thread.start()
+
+    def stop(self: object) -> None:
+        self._stop.set()
+        self._thread.join()
+        self.duration = time.monotonic() - self.start_time
+
+    def container_id(self: object):
+        try:
+            with open(self.cidfile, 'r') as f:
+                return f.read().strip() or None
+        except FileNotFoundError:
+            return None
+
+    def find_cgroup(self: object, cid: str):
+        # Return {controller: directory} for the container's cgroup
+        for scope in ('system.slice/docker-{}.scope'.format(cid),
+                      'docker/{}'.format(cid)):
+            path = os.path.join(self.cgroup_root, scope)
+            if os.path.exists(os.path.join(path, 'cgroup.controllers')):
+                return dict(cpu=path, memory=path, io=path, version=2)
+            v1 = {c: os.path.join(self.cgroup_root, d, scope)
+                  for c, d in (('cpu', 'cpuacct'), ('memory', 'memory'),
+                               ('io', 'blkio'))}
+            if os.path.isdir(v1['cpu']):
+                v1['throttle'] = os.path.join(self.cgroup_root, 'cpu', scope)
+                v1['version'] = 1
+                return v1
+        return None
+
+    @staticmethod
+    def read_keyed(path: str) -> dict:
+        # 'key value' lines, as in cpu.stat
+        result = dict()
+        with open(path, 'r') as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) == 2 and fields[1].isdigit():
+                    result[fields[0]] = int(fields[1])
+        return result
+
+    @staticmethod
+    def read_int(path: str, default=0) -> int:
+        try:
+            with open(path, 'r') as f:
+                return int(f.read().strip())
+        except (FileNotFoundError, ValueError):
+            return default
+
+    def read_cgroup(self: object) -> dict:
+        # Cumulative counters from the cgroup
+        cg = self._cgroup
+        if cg['version'] == 2:
+            cpu = self.read_keyed(os.path.join(cg['cpu'], 'cpu.stat'))
+            io_read = io_write = 0
+            with open(os.path.join(cg['io'], 'io.stat'), 'r') as f:
+                for line in f:
+                    for field in line.split()[1:]:
+                        key, _, value = field.partition('=')
+                        if key == 'rbytes':
+                            io_read += int(value)
+                        elif key == 'wbytes':
+                            io_write += int(value)
+            mem = self.read_int(os.path.join(cg['memory'], 'memory.current'))
+            return dict(
+                cpu_usec=cpu.get('usage_usec', 0), mem_bytes=mem,
+                mem_peak=self.read_int(
+                    os.path.join(cg['memory'], 'memory.peak'), mem),
+                io_read_bytes=io_read, io_write_bytes=io_write,
+                nr_throttled=cpu.get('nr_throttled', 0),
+                throttled_usec=cpu.get('throttled_usec', 0))
+        io_read = io_write = 0
+        with open(os.path.join(
+                cg['io'], 'blkio.throttle.io_service_bytes'), 'r') as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) == 3 and fields[1] == 'Read':
+                    io_read += int(fields[2])
+                elif len(fields) == 3 and fields[1] == 'Write':
+                    io_write += int(fields[2])
+        throttle = self.read_keyed(os.path.join(cg['throttle'], 'cpu.stat'))
+        mem = self.read_int(os.path.join(cg['memory'], 'memory.usage_in_bytes'))
+        return dict(
+            cpu_usec=self.read_int(
+                os.path.join(cg['cpu'], 'cpuacct.usage')) // 1000,
+            mem_bytes=mem,
+            mem_peak=self.read_int(
+                os.path.join(cg['memory'], 'memory.max_usage_in_bytes'), mem),
+            io_read_bytes=io_read, io_write_bytes=io_write,
+            nr_throttled=throttle.get('nr_throttled', 0),
+            throttled_usec=throttle.get('throttled_time', 0) // 1000)
+
+    @classmethod
+    def parse_size(cls, text: str) -> int:
+        match = re.match(r'([\d.]+)\s*([a-zA-Z]*)', text.strip())
+        if not match:
+            return 0
+        return int(float(match.group(1)) * cls.units.get(
+            match.group(2).lower() or 'b', 1))
+
+    def read_docker_stats(self: object, cid: str) -> dict:
+        # One `docker stats` reading; CPU is already a percentage
+        stats = json.loads(self.runner.output(
+            ['docker', 'stats', '--no-stream', '--format', '{{json .}}', cid]))
+        io_read, _, io_write = stats['BlockIO'].partition('/')
+        mem = self.parse_size(stats['MemUsage'].partition('/')[0])
+        return dict(
+            cpu_percent=float(stats['CPUPerc'].rstrip('%') or 0),
+            mem_bytes=mem, mem_peak=mem,
+            io_read_bytes=self.parse_size(io_read),
+            io_write_bytes=self.parse_size(io_write),
+            nr_throttled=0, throttled_usec=0)
+
+    def sample(self: object, cid: str) -> None:
+        now = time.monotonic()
+        if self.source == 'cgroup':
+            counters = self.read_cgroup()
+            last_time, last = self._last or (self.start_time, None)
+            cpu_usec = counters['cpu_usec'] - (last['cpu_usec'] if last else 0)
+            counters['cpu_percent'] = (
+                100 * cpu_usec / 1e6 / max(now - last_time, 1e-6))
+            self._last = (now, counters)
+            self.cpu_usec = counters['cpu_usec']
+        else:
+            counters = self.read_docker_stats(cid)
+        self.mem_peak = max(self.mem_peak, counters['mem_peak'])
+        self.throttled_usec = counters['throttled_usec']
+        counters['t'] = round(now - self.start_time, 3)
+        counters['cpu_percent'] = round(counters['cpu_percent'], 1)
+        self.samples.append([counters[c] for c in self.columns])
+
+    def run(self: object) -> None:
+        cid = None
+        while not self._stop.wait(self.interval if cid else 0.1):
+            if cid is None:
+                cid = self.container_id()
+                if cid is None:
+                    continue
+                self._cgroup = self.find_cgroup(cid)
+                self.source = 'cgroup' if self._cgroup else 'docker-stats'
+            try:
+                self.sample(cid)
+            except (OSError, ValueError, KeyError, helpers.CommandError):
+                # Container exited between samples
+                if self.samples:
+                    break
+
+    def summary(self: object) -> dict:
+        column = {c: [row[i] for row in self.samples]
+                  for i, c in enumerate(self.columns)}
+        cpu = column['cpu_percent']
+        last = dict(zip(self.columns, self.samples[-1])) if self.samples else {}
+        return dict(
+            source=self.source, interval=self.interval,
+            duration=round(self.duration, 3), samples=len(self.samples),
+            host_cpus=os.cpu_count(),
+            cpu_seconds=(None if self.cpu_usec is None
+                         else round(self.cpu_usec / 1e6, 3)),
+            cpu_percent_mean=round(sum(cpu) / len(cpu), 1) if cpu else None,
+            cpu_percent_max=max(cpu) if cpu else None,
+            mem_peak_bytes=self.mem_peak,
+            io_read_bytes=last.get('io_read_bytes'),
+            io_write_bytes=last.get('io_write_bytes'),
+            nr_throttled=last.get('nr_throttled'),
+            throttled_seconds=round(self.throttled_usec / 1e6, 3))
+
+    def as_dict(self: object) -> dict:
+        return dict(summary=self.summary(), columns=list(self.columns),
+                    samples=self.samples)
+
+    @staticmethod
+    def format_summary(summary: dict) -> str:
+        if not summary['samples']:
+            return "Resources:  no samples"
+        return ("Resources:  {duration:.0f} s, CPU mean {cpu_percent_mean}% "
+                "max {cpu_percent_max}% of {host_cpus} CPUs, "
+                "memory peak {mem_mib:.0f} MiB, I/O read {read_mib:.0f} MiB "
+                "write {write_mib:.0f} MiB, throttled {throttled_seconds} s "
+                "({source})").format(
+                    mem_mib=summary['mem_peak_bytes'] / 2**20,
+                    read_mib=(summary['io_read_bytes'] or 0) / 2**20,
+                    write_mib=(summary['io_write_bytes'] or 0) / 2**20,
+                    **summary)
+
+
 class RunDocker(helpers.DistroSettings):
+    # Container path of the `--tmpfs-build` mount
+    tmpfs_build_dir = '/mk-ci-build'
+    size_re = re.compile(r'^(\d+)([kmgt]?)i?b?$', re.IGNORECASE)
+
     def __init__(self: object, path, version, architecture, notty, env,
-                 volume, docker_args):
+                 volume, docker_args, sample_interval=None,
+                 sample_output=None, tmpfs_build_size=None, fast_io=None):
         super(RunDocker, self).__init__(path, version, architecture)
+        self._fast_io = fast_io
+        self.sample_interval = sample_interval
+        self._sample_output = sample_output
+        self._tmpfs_build_size = tmpfs_build_size
         # Use current process std{in,out,err} unless no tty or --notty flag
         self.env_vars = env
         self.volumes = volume
@@ -41,22 +271,116 @@ class RunDocker(helpers.DistroSettings):
             docker_args.extend(['--env={}'.format(e) for e in self.env_vars])
         if self.volumes:
             docker_args.extend(['--volume={}:{}'.format(v,v) for v in self.volumes])
-        docker_args.append(self.image_registry_name_tag)
-        docker_args.extend(cmd)
-        kwargs = dict(
-            _cwd=self.normalized_path,
-        )
-        if self.tty:
-            kwargs.update(dict(_fg=True))
-        else:
-            kwargs.update(dict(_out=sys.stdout.buffer, _err=sys.stderr.buffer))
-        sys.stderr.write("sh.docker.run args: {}\n".format(kwargs))
-        sys.stderr.write("Running: 'docker' 'run' '{}'\n".format("' '".join(docker_args)))
+        with self.tracer.span('container', image=self.image_registry_name_tag,
+                              cmd=' '.join(cmd)):
+            docker_args.extend(self.trace_docker_args())
+            docker_args.extend(self.tmpfs_build_docker_args())
+            if self.fast_io:
+                # The entrypoint runs the command under `eatmydata`
+                docker_args.append('--env=MACHINEKIT_CI_FAST_IO=1')
+            sampler = None
+            if self.sample_interval:
+                cid_dir = tempfile.mkdtemp(prefix='mk-ci-cid-')
+                cidfile = os.path.join(cid_dir, 'cid')
+                docker_args.append('--cidfile={}'.format(cidfile))
+                sampler = ResourceSampler(cidfile, self.sample_interval,
+                                          self.runner)
+            docker_args.append(self.image_registry_name_tag)
+            docker_args.extend(cmd)
+            sys.stderr.write("Running: 'docker' 'run' '{}'\n".format("' '".join(docker_args)))
+            if sampler is not None:
+                sampler.start()
+            try:
+                self.runner.run(['docker', 'run'] + docker_args,
+                                fg=self.tty, cwd=self.normalized_path)
+            except helpers.CommandError as e:
+                raise ValueError(
+                    "'docker run {}' failed:\n{}".format(' '.join(cmd), e))
+            finally:
+                if sampler is not None:
+                    sampler.stop()
+                    shutil.rmtree(cid_dir, ignore_errors=True)
+                    self.write_resource_samples(sampler, cmd)
+
+    @property
+    def fast_io(self: object):
+        # From constructor, else `fastIO` config key
+        if self._fast_io is not None:
+            return self._fast_io
+        return bool(self.distro_settings.get('fastIO', False))
+
+    @property
+    def tmpfs_build_size(self: object):
+        # From constructor, else `buildTmpfsSize` config key
+        return self._tmpfs_build_size or self.distro_settings.get(
+            'buildTmpfsSize', None)
+
+    @classmethod
+    def parse_size(cls, size) -> int:
+        # Bytes in a docker-style size, e.g. `8g`, `512m`
+        match = cls.size_re.match(str(size).strip())
+        if not match:
+            raise ValueError("Invalid size '{}'".format(size))
+        return int(match.group(1)) * 1024 ** ' kmgt'.index(
+            match.group(2).lower() or ' ')
+
+    @staticmethod
+    def memory_available():
+        # Host MemAvailable in bytes, or None if unknown
         try:
-            sh.docker.run(*docker_args, **kwargs)
-        except sh.ErrorReturnCode as e:
-            raise ValueError(
-                "'docker run {}' failed:\n".format(' '.join(cmd), e))
+            with open('/proc/meminfo', 'r') as f:
+                for line in f:
+                    if line.startswith('MemAvailable:'):
+                        return int(line.split()[1]) * 1024
+        except OSError:
+            pass
+        return None
+
+    def tmpfs_build_docker_args(self: object) -> list:
+        # Mount a tmpfs for `buildpackages` to build in, memory permitting
+        if not self.tmpfs_build_size:
+            return []
+        size = self.parse_size(self.tmpfs_build_size)
+        available = self.memory_available()
+        if available is not None and size > available:
+            sys.stderr.write(
+                "Only {} MiB memory available for a {} build tmpfs; building "
+                "on disk\n".format(available // 2**20, self.tmpfs_build_size))
+            return []
+        return ['--tmpfs={}:rw,exec,size={},mode=1777'.format(
+                    self.tmpfs_build_dir, size),
+                '--env=MACHINEKIT_CI_BUILD_DIR={}'.format(self.tmpfs_build_dir)]
+
+    @property
+    def sample_output(self: object):
+        if self._sample_output is not None:
+            return self._sample_output
+        return os.path.join(self.parent_dir, '{}_{}_{}.resources.jsonl'.format(
+            self.package, self.os_codename, self.architecture))
+
+    def write_resource_samples(self: object, sampler, cmd: list) -> None:
+        # Append one JSON line per command:  summary plus time series
+        record = dict(cmd=cmd, time=time.time(), **sampler.as_dict())
+        with open(self.sample_output, 'a') as f:
+            f.write(json.dumps(record, separators=(',', ':')) + '\n')
+        sys.stderr.write("{}\n    written to {}\n".format(
+            ResourceSampler.format_summary(record['summary']),
+            self.sample_output))
+
+    def trace_docker_args(self: object) -> list:
+        # Continue the trace in the container, writing to the same directory
+        trace_env = self.tracer.environment()
+        if not trace_env:
+            return []
+        trace_dir = os.path.abspath(trace_env[self.tracer.env_dir])
+        trace_env[self.tracer.env_dir] = trace_dir
+        os.makedirs(trace_dir, exist_ok=True)
+        args = ['--env={}={}'.format(k, v) for k, v in trace_env.items()]
+        mounted = [self.parent_dir] + list(self.volumes or [])
+        if not any(trace_dir == os.path.abspath(m) or trace_dir.startswith(
+                os.path.join(os.path.abspath(m), '')) for m in mounted):
+            args.append('--volume={0}:{0}'.format(trace_dir))
+        return args
 
     @classmethod
     def cli(cls):
@@ -86,6 +410,33 @@ class RunDocker(helpers.DistroSettings):
                             action="append",
                             help="Bind-mount directory in container; see docker-run(1)",
         )
+        parser.add_argument("--tmpfs-build",
+                            metavar="SIZE",
+                            help="Mount a SIZE (e.g. 8g) tmpfs for "
+                            "'buildpackages --build-packages' to build in "
+                            "(default: buildTmpfsSize config key)")
+        parser.add_argument("--fast-io",
+                            action="store_const",
+                            const=True,
+                            dest="fast_io",
+                            help="Run the command under eatmydata, skipping "
+                            "fsync() (default: fastIO config key)")
+        parser.add_argument("--sample-resources",
+                            action="store_true",
+                            help="Sample the container's CPU, memory and I/O "
+                            "use while the command runs")
+        parser.add_argument("--sample-interval",
+                            type=float,
+                            default=1.0,
+                            metavar="SECONDS",
+                            help="With --sample-resources, seconds between "
+                            "samples (default 1.0)")
+        parser.add_argument("--sample-output",
+                            metavar="FILE",
+                            help="With --sample-resources, JSON lines file to "
+                            "append to (default: "
+                            "PACKAGE_CODENAME_ARCH.resources.jsonl next to "
+                            "the built packages)")
 
         # Positional arguments
         parser.add_argument("version",
@@ -93,9 +444,6 @@ class RunDocker(helpers.DistroSettings):
                             help="OS version number or codename")
         parser.add_argument("architecture",
                             action=helpers.HostArchitectureValidAction,
-                            default=sh.dpkg_architecture(
-                                "-qDEB_HOST_ARCH",
-                                _tty_out=False).strip(),
                             metavar="ARCHITECTURE",
                             help="Debian architecture")
         parser.add_argument("command",
@@ -112,10 +460,21 @@ class RunDocker(helpers.DistroSettings):
         version = args_dict.pop('version')
         architecture = args_dict.pop('architecture')
         cmd = args_dict.pop('command')
+        sample_interval = args_dict.pop('sample_interval')
+        if not args_dict.pop('sample_resources'):
+            sample_interval = None
+        sample_output = args_dict.pop('sample_output')
+        tmpfs_build_size = args_dict.pop('tmpfs_build')
+        fast_io = args_dict.pop('fast_io')
         rd = cls(path=path, version=version,
                        architecture=architecture, notty=notty, env=env,
-                       volume=volume, docker_args=docker_args)
+                       volume=volume, docker_args=docker_args,
+                       sample_interval=sample_interval,
+                       sample_output=sample_output,
+                       tmpfs_build_size=tmpfs_build_size,
+                       fast_io=fast_io)
         try:
             rd.run_cmd(cmd)
         except ValueError as e:
             sys.stderr.write("Error:  Command exited non-zero:  {}\n".format(str(e)))
+            sys.exit(1)
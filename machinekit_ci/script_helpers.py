@@ -27,9 +27,21 @@
 
 import argparse
 import os
-import sh
-import yaml
+import sys
 import math
+import hashlib
+import pickle
+import tempfile
+import re
+import json
+import time
+import threading
+import atexit
+import contextlib
+import socket
+import zlib
+from collections import namedtuple
+import importlib
 from urllib.parse import urlparse
 
 # Debian 9 Stretch, Ubuntu 18.04 Bionic and (probably) other older distributions
@@ -37,6 +49,404 @@ from urllib.parse import urlparse
 # to properly function
 
 
+class LazyModule(object):
+    """Module proxy that imports the module on first attribute access
+
+    Keeps CLI startup fast:  e.g. `sh` pulls in `asyncio`, and many
+    invocations never run a subprocess at all.
+    """
+    def __init__(self: object, name: str):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self: object, attr: str):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+
+sh = LazyModule('sh')
+yaml = LazyModule('yaml')
+debian_deb822 = LazyModule('debian.deb822')
+
+# Default for stream arguments, distinguished from None (discard)
+unset_stream = object()
+
+# Start of the process's trace span; importing this module is among the
+# first things every tool does
+_process_start = time.time()
+
+
+CommandRecord = namedtuple('CommandRecord', [
+    'argv', 'cwd', 'exit_code', 'duration', 'stdout_bytes', 'stderr_bytes',
+    'dry_run'])
+
+
+class CommandError(RuntimeError):
+    """External command failed; `record` holds its CommandRecord and `stderr`
+    the last few KiB of its error output"""
+    def __init__(self: object, record, message: str, stderr=''):
+        super(CommandError, self).__init__(message)
+        self.record = record
+        self.stderr = stderr
+
+    @property
+    def exit_code(self: object):
+        return self.record.exit_code
+
+
+class OutputCounter(object):
+    """File-like byte sink that counts output and passes it on
+
+    Streamed output is never accumulated, so memory use is bounded no matter
+    how much a command prints; only the last `tail_size` bytes are kept, for
+    error messages.  `target` may be a binary stream or None to discard.
+    """
+    tail_size = 4096
+
+    def __init__(self: object, target=None):
+        self.target = target
+        self.nbytes = 0
+        self.tail = b''
+
+    def write(self: object, data: bytes):
+        self.nbytes += len(data)
+        self.tail = (self.tail + data)[-self.tail_size:]
+        if self.target is not None:
+            self.target.write(data)
+
+    def flush(self: object):
+        if self.target is not None:
+            self.target.flush()
+
+
+class CommandRunner(object):
+    """Run external commands, recording duration, exit code and output size
+
+    - `run()` streams output to the given binary streams (default this
+      process's stdout and stderr) or runs in the foreground on a tty
+    - `output()` captures and returns stdout, for short query commands
+    - `run_concurrently()` runs independent commands in a thread pool
+    - In dry-run mode, `run()` only prints the command line
+
+    Every command's CommandRecord is kept in `records`.  If
+    `$MACHINEKIT_CI_COMMAND_LOG` is set, records are also appended to that
+    file as JSON lines, so timings from several processes (including those
+    inside builder containers) can be collected; if
+    `$MACHINEKIT_CI_COMMAND_REPORT` is set, a summary is printed at exit.
+    """
+    _default = None
+
+    def __init__(self: object, dry_run=False, log_path=None):
+        self.dry_run = dry_run
+        self.log_path = log_path
+        self.records = list()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def default(cls):
+        # Process-wide runner shared by all tools
+        if cls._default is None:
+            cls._default = cls(
+                log_path=os.environ.get('MACHINEKIT_CI_COMMAND_LOG', None) or None)
+            if os.environ.get('MACHINEKIT_CI_COMMAND_REPORT', None):
+                atexit.register(cls._default.report)
+        return cls._default
+
+    @staticmethod
+    def format_argv(argv: list) -> str:
+        return "'{}'".format("' '".join(str(a) for a in argv))
+
+    def _record(self: object, record) -> None:
+        with self._lock:
+            self.records.append(record)
+            if self.log_path:
+                entry = dict(record._asdict(), pid=os.getpid(), time=time.time())
+                with open(self.log_path, 'a') as f:
+                    f.write(json.dumps(entry) + '\n')
+
+    def _execute(self: object, argv, cwd, sh_kwargs, stdout_counter,
+                 stderr_counter):
+        start = time.perf_counter()
+        exit_code = 0
+        error = None
+        result = None
+        stderr = ''
+        tracer = Tracer.default()
+        with tracer.span(os.path.basename(str(argv[0])), category='command',
+                         argv=self.format_argv(argv)) as span_args:
+            if tracer.enabled:
+                # Let the command add its own spans under this one
+                sh_kwargs = dict(sh_kwargs, _env=dict(
+                    sh_kwargs.get('_env', os.environ), **tracer.environment()))
+            try:
+                result = sh.Command(argv[0])(*argv[1:], **sh_kwargs)
+            except sh.CommandNotFound as e:
+                exit_code = 127
+                error = "command not found: {}".format(e)
+            except sh.ErrorReturnCode as e:
+                exit_code = e.exit_code
+                if stderr_counter is not None:
+                    # Already streamed; keep the tail for the exception only
+                    stderr = stderr_counter.tail.decode(errors='replace').strip()
+                    error = "exit code {}".format(exit_code)
+                else:
+                    stderr = e.stderr.decode(errors='replace').strip() if e.stderr else ''
+                    stderr = stderr[-OutputCounter.tail_size:]
+                    error = "exit code {}{}".format(
+                        exit_code, ':\n' + stderr if stderr else '')
+            span_args['exit_code'] = exit_code
+        duration = time.perf_counter() - start
+        stdout_bytes = stdout_counter.nbytes if stdout_counter else None
+        stderr_bytes = stderr_counter.nbytes if stderr_counter else None
+        if stderr_counter is not None and stderr_counter is stdout_counter:
+            stderr_bytes = None
+        if result is not None and stdout_counter is None and not sh_kwargs.get('_fg'):
+            stdout_bytes = len(str(result).encode())
+        record = CommandRecord(
+            argv=[str(a) for a in argv], cwd=cwd, exit_code=exit_code,
+            duration=duration, stdout_bytes=stdout_bytes,
+            stderr_bytes=stderr_bytes, dry_run=False)
+        self._record(record)
+        if error is not None:
+            raise CommandError(record, "Command {} failed, {}".format(
+                self.format_argv(argv), error), stderr=stderr)
+        return record, result
+
+    def run(self: object, argv: list, out=unset_stream, err=unset_stream,
+            fg=False, in_=None, cwd=None, env=None, dry_run=None,
+            err_to_out=False):
+        # Run a command, streaming its output; return its CommandRecord.
+        # With `err_to_out`, stderr is merged into `out`, keeping the order
+        # of lines from both
+        if dry_run is None:
+            dry_run = self.dry_run
+        if dry_run:
+            sys.stderr.write("Would run:  {}\n".format(self.format_argv(argv)))
+            record = CommandRecord(
+                argv=[str(a) for a in argv], cwd=cwd, exit_code=None,
+                duration=0.0, stdout_bytes=None, stderr_bytes=None,
+                dry_run=True)
+            self._record(record)
+            return record
+        sh_kwargs = dict(_cwd=cwd)
+        if env is not None:
+            sh_kwargs['_env'] = env
+        if in_ is not None:
+            sh_kwargs['_in'] = in_
+        stdout_counter = stderr_counter = None
+        if fg:
+            sh_kwargs['_fg'] = True
+        else:
+            stdout_counter = OutputCounter(
+                sys.stdout.buffer if out is unset_stream else out)
+            if err_to_out:
+                # Error messages get the tail of the merged output
+                stderr_counter = stdout_counter
+                sh_kwargs.update(_out=stdout_counter, _err_to_out=True)
+            else:
+                stderr_counter = OutputCounter(
+                    sys.stderr.buffer if err is unset_stream else err)
+                sh_kwargs.update(_out=stdout_counter, _err=stderr_counter)
+        record, _ = self._execute(
+            argv, cwd, sh_kwargs, stdout_counter, stderr_counter)
+        return record
+
+    def output(self: object, argv: list, in_=None, cwd=None, env=None) -> str:
+        # Run a query command and return its stdout; runs even in dry-run mode
+        sh_kwargs = dict(_cwd=cwd, _tty_out=False)
+        if env is not None:
+            sh_kwargs['_env'] = env
+        if in_ is not None:
+            sh_kwargs['_in'] = in_
+        _, result = self._execute(argv, cwd, sh_kwargs, None, None)
+        return str(result)
+
+    def run_concurrently(self: object, argvs: list, max_workers=None, **kwargs):
+        # Run independent commands in parallel; return CommandRecords in
+        # order, raising the first CommandError after all have finished
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(self.run, argv, **kwargs)
+                       for argv in argvs]
+        errors = [f.exception() for f in futures if f.exception() is not None]
+        if errors:
+            raise errors[0]
+        return [f.result() for f in futures]
+
+    def report(self: object, stream=None) -> None:
+        # Print a summary of recorded commands, slowest first
+        stream = stream or sys.stderr
+        stream.write("{:>9} {:>5} {:>10} {:>10}  {}\n".format(
+            "seconds", "exit", "stdout", "stderr", "command"))
+        for r in sorted(self.records, key=lambda r: -r.duration):
+            stream.write("{:>9.3f} {:>5} {:>10} {:>10}  {}\n".format(
+                r.duration, 'dry' if r.dry_run else r.exit_code,
+                '-' if r.stdout_bytes is None else r.stdout_bytes,
+                '-' if r.stderr_bytes is None else r.stderr_bytes,
+                ' '.join(r.argv)))
+
+
+class Tracer(object):
+    """Record timed spans from all the tools in a CI job into one trace
+
+    Tracing is on when `$MACHINEKIT_CI_TRACE_DIR` is set.  Spans are
+    appended as Chrome trace events to `trace-<id>.json` in that directory.
+    The file is an unterminated JSON array, which chrome://tracing and
+    https://ui.perfetto.dev load as is.  The trace ID comes from
+    `$MACHINEKIT_CI_TRACE_ID`, or a new one is generated and exported.
+    `$MACHINEKIT_CI_TRACE_PARENT` names the span that started this process.
+    `environment()` holds all three, so child processes and builder
+    containers add their spans to the same timeline.
+
+    Each process records one span for its whole run.  Each external command
+    run through `CommandRunner` gets its own span, and `span()` adds more.
+    """
+    env_dir = 'MACHINEKIT_CI_TRACE_DIR'
+    env_id = 'MACHINEKIT_CI_TRACE_ID'
+    env_parent = 'MACHINEKIT_CI_TRACE_PARENT'
+    _default = None
+    _disabled = None
+
+    def __init__(self: object, trace_dir=None, trace_id=None, parent_id=None):
+        self.trace_dir = trace_dir
+        self.trace_id = trace_id or self.new_id()
+        self.parent_id = parent_id
+        self.root_id = self.new_id()
+        self.process_name = os.path.basename(sys.argv[0]) or 'python'
+        self.hostname = socket.gethostname()
+        # Container PIDs repeat, so number processes by host, PID and time
+        self.pid = zlib.crc32('{}:{}:{}'.format(
+            self.hostname, os.getpid(), int(time.time() * 1e9)).encode()
+        ) & 0x7fffffff
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._file_ready = False
+
+    @classmethod
+    def default(cls):
+        # Process-wide tracer configured from the environment; while
+        # tracing is off, a shared no-op tracer, and the environment is
+        # checked again on the next call
+        if cls._default is None:
+            trace_dir = os.environ.get(cls.env_dir, None) or None
+            if trace_dir is None:
+                if cls._disabled is None:
+                    cls._disabled = _DisabledTracer()
+                return cls._disabled
+            cls._default = cls(
+                trace_dir=trace_dir,
+                trace_id=os.environ.get(cls.env_id, None) or None,
+                parent_id=os.environ.get(cls.env_parent, None) or None)
+            os.environ.update(cls._default.environment())
+            atexit.register(cls._default.finish)
+        return cls._default
+
+    @staticmethod
+    def new_id() -> str:
+        return os.urandom(8).hex()
+
+    @property
+    def enabled(self: object) -> bool:
+        return self.trace_dir is not None
+
+    @property
+    def trace_path(self: object):
+        return os.path.join(
+            self.trace_dir, 'trace-{}.json'.format(self.trace_id))
+
+    def current_span_id(self: object) -> str:
+        stack = getattr(self._local, 'stack', None)
+        return stack[-1] if stack else self.root_id
+
+    def environment(self: object) -> dict:
+        # Environment variables continuing this trace in a child process
+        if not self.enabled:
+            return dict()
+        return {self.env_dir: self.trace_dir, self.env_id: self.trace_id,
+                self.env_parent: self.current_span_id()}
+
+    def event(self: object, name: str, category: str, start: float,
+              end: float, args: dict) -> dict:
+        return dict(name=name, cat=category, ph='X', pid=self.pid,
+                    tid=threading.get_ident(), ts=round(start * 1e6),
+                    dur=round((end - start) * 1e6),
+                    args=dict(args, trace_id=self.trace_id))
+
+    def create_trace_file(self: object) -> None:
+        # Start the shared file with '[' exactly once, whichever process
+        # writes first:  link a complete temp file into place
+        os.makedirs(self.trace_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.trace_dir, prefix='.trace-')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write('[\n')
+            os.link(tmp_path, self.trace_path)
+        except FileExistsError:
+            pass
+        finally:
+            os.unlink(tmp_path)
+
+    def write_events(self: object, events: list) -> None:
+        with self._lock:
+            if not self._file_ready:
+                self.create_trace_file()
+                events = [dict(
+                    name='process_name', ph='M', pid=self.pid, args=dict(
+                        name='{} ({})'.format(
+                            self.process_name, self.hostname)))] + events
+                self._file_ready = True
+            # One append per write keeps concurrent writers' lines whole
+            with open(self.trace_path, 'a') as f:
+                f.write(''.join(json.dumps(e) + ',\n' for e in events))
+
+    @contextlib.contextmanager
+    def span(self: object, name: str, category='ci', **args):
+        # Record the enclosed block as a span; the yielded dict of args may
+        # be updated before it ends
+        if not self.enabled:
+            yield args
+            return
+        span_id = self.new_id()
+        parent_id = self.current_span_id()
+        stack = self._local.__dict__.setdefault('stack', list())
+        stack.append(span_id)
+        start = time.time()
+        try:
+            yield args
+        finally:
+            stack.pop()
+            self.write_events([self.event(
+                name, category, start, time.time(),
+                dict(args, span_id=span_id, parent_id=parent_id))])
+
+    def finish(self: object) -> None:
+        # Record the span for this process's whole run
+        self.write_events([self.event(
+            self.process_name, 'process', _process_start, time.time(),
+            dict(argv=sys.argv[1:], span_id=self.root_id,
+                 parent_id=self.parent_id))])
+
+
+class _DisabledTracer(Tracer):
+    # Tracer while `$MACHINEKIT_CI_TRACE_DIR` is unset:  records nothing
+
+    def __init__(self: object):
+        self.trace_dir = None
+
+
+_host_architecture = None
+def default_host_architecture() -> str:
+    # `$ARCHITECTURE` or the `dpkg-architecture` host arch, computed on demand
+    global _host_architecture
+    if _host_architecture is None:
+        _host_architecture = os.environ.get("ARCHITECTURE", None)
+    if _host_architecture is None:
+        _host_architecture = CommandRunner.default().output(
+            ["dpkg-architecture", "-qDEB_HOST_ARCH"]).strip()
+    return _host_architecture
+
+
 class PathExistsAction(argparse.Action):
     def test_path(self: object, path) -> str:
         if not os.path.isdir(path):
@@ -59,13 +469,177 @@ class PathExistsAction(argparse.Action):
 class HostArchitectureValidAction(argparse.Action):
     def __call__(self, parser, namespace, values, option_string=None):
         try:
-            sh.dpkg_architecture("-a", values, _tty_out=False)
-        except sh.ErrorReturnCode:
+            CommandRunner.default().output(["dpkg-architecture", "-a", values])
+        except CommandError:
             raise argparse.ArgumentError(self,
                                          "Architecture {} is a not valid DPKG one.".format(values))
         setattr(namespace, self.dest, values)
 
 
+GitHeadInfo = namedtuple('GitHeadInfo', ['sha', 'author_name', 'author_email'])
+
+
+class GitRepository(object):
+    """Git metadata for the repository containing a path
+
+    The repository root and git directory are found by walking up the
+    directory tree, and remote URLs are read directly from the git config
+    file, so neither needs a subprocess.  HEAD commit data comes from a
+    single `git log` and is memoized.  Use `GitRepository.for_path()` to share
+    one instance per repository for the life of the process.
+    """
+    _instances = dict()
+
+    def __init__(self: object, root: str, git_dir: str):
+        self.root = root
+        self.git_dir = git_dir
+        self._head = None
+        self._config = None
+        self._paths_in_head = dict()
+
+    @classmethod
+    def for_path(cls, path: str):
+        root, git_dir = cls.find_root(path)
+        if root not in cls._instances:
+            cls._instances[root] = cls(root, git_dir)
+        return cls._instances[root]
+
+    @staticmethod
+    def find_root(path: str):
+        # Return (root, git_dir) of the work tree containing path
+        start = os.path.realpath(os.path.abspath(path))
+        if not os.path.isdir(start):
+            start = os.path.dirname(start)
+        current = start
+        while True:
+            dot_git = os.path.join(current, '.git')
+            if os.path.isdir(dot_git):
+                return (current, dot_git)
+            if os.path.isfile(dot_git):
+                # Worktree or submodule:  `.git` file points to git dir
+                with open(dot_git, 'r') as f:
+                    line = f.readline().strip()
+                if line.startswith('gitdir:'):
+                    git_dir = os.path.join(current, line[7:].strip())
+                    return (current, os.path.normpath(git_dir))
+            parent = os.path.dirname(current)
+            if parent == current:
+                raise ValueError(
+                    "Path {} is not a git repository.".format(path))
+            current = parent
+
+    @property
+    def common_dir(self: object):
+        # Worktrees keep config and refs in the main repo's git dir
+        commondir_path = os.path.join(self.git_dir, 'commondir')
+        if not os.path.isfile(commondir_path):
+            return self.git_dir
+        with open(commondir_path, 'r') as f:
+            return os.path.normpath(
+                os.path.join(self.git_dir, f.read().strip()))
+
+    @property
+    def head(self: object):
+        if self._head is None:
+            output = CommandRunner.default().output(
+                ["git", "log", "-1", "--format=%H%x00%an%x00%ae", "HEAD"],
+                cwd=self.root)
+            self._head = GitHeadInfo(*output.strip().split('\0'))
+        return self._head
+
+    config_section_regex = re.compile(r'^\[\s*([^\s\]"]+)(?:\s+"(.*)")?\s*\]')
+    config_value_regex = re.compile(r'^([A-Za-z][-A-Za-z0-9]*)\s*(?:=\s*(.*?))?\s*$')
+    @property
+    def config(self: object):
+        # Minimal reader for the `section.subsection.key` values in git config
+        if self._config is None:
+            self._config = dict()
+            config_path = os.path.join(self.common_dir, 'config')
+            if os.path.exists(config_path):
+                with open(config_path, 'r') as f:
+                    self._config = self.parse_config(f)
+        return self._config
+
+    @classmethod
+    def parse_config(cls, lines) -> dict:
+        config = dict()
+        section = None
+        for line in lines:
+            line = line.strip()
+            if not line or line[0] in '#;':
+                continue
+            match = cls.config_section_regex.match(line)
+            if match:
+                section = match.group(1).lower()
+                if match.group(2) is not None:
+                    section += '.' + match.group(2)
+                continue
+            match = cls.config_value_regex.match(line)
+            if match and section is not None:
+                value = match.group(2)
+                if value and len(value) > 1 and value[0] == value[-1] == '"':
+                    value = value[1:-1]
+                config['{}.{}'.format(section, match.group(1).lower())] = value
+        return config
+
+    @property
+    def current_branch(self: object):
+        with open(os.path.join(self.git_dir, 'HEAD'), 'r') as f:
+            head = f.read().strip()
+        if head.startswith('ref: refs/heads/'):
+            return head[len('ref: refs/heads/'):]
+        return None  # Detached HEAD
+
+    @property
+    def remote_url(self: object):
+        # Same as `git ls-remote --get-url`:  URL of the current branch's
+        # remote, else of `origin`; empty string if no remote configured
+        remote = self.config.get(
+            'branch.{}.remote'.format(self.current_branch), 'origin')
+        return self.config.get('remote.{}.url'.format(remote), '') or ''
+
+    def paths_in_head(self: object, paths: list) -> list:
+        # Return those `paths` present in the HEAD commit with one `git ls-tree`
+        wanted = [os.path.normpath(p) for p in paths
+                  if os.path.normpath(p) not in self._paths_in_head]
+        if wanted:
+            try:
+                output = CommandRunner.default().output(
+                    ["git", "ls-tree", "-z", "--name-only", "HEAD", "--"] + wanted,
+                    cwd=self.root)
+                found = set(output.split('\0'))
+            except CommandError:
+                found = set()
+            for p in wanted:
+                self._paths_in_head[p] = p in found
+        return [p for p in paths if self._paths_in_head[os.path.normpath(p)]]
+
+    def resolve_commit(self: object, rev: str):
+        # Return the full commit SHA for `rev`, or None if it isn't known
+        try:
+            return CommandRunner.default().output(
+                ["git", "rev-parse", "--verify", "--quiet", rev + "^{commit}"],
+                cwd=self.root).strip() or None
+        except CommandError:
+            return None
+
+    def changed_paths(self: object, base: str, rev="HEAD") -> list:
+        # Paths changed between commits `base` and `rev`, including renames'
+        # old and new paths
+        output = CommandRunner.default().output(
+            ["git", "diff", "--name-only", "--no-renames", "-z", base, rev, "--"],
+            cwd=self.root)
+        return [p for p in output.split('\0') if p]
+
+    def file_at(self: object, rev: str, path: str):
+        # Contents of `path` at commit `rev`, or None if absent
+        try:
+            return CommandRunner.default().output(
+                ["git", "show", "{}:{}".format(rev, path)], cwd=self.root)
+        except CommandError:
+            return None
+
+
 class NormalizePath():
     def __init__(self: object, path):
         self.path = self.path_raw = path
@@ -81,15 +655,7 @@ class NormalizePath():
             raise ValueError(error_message)
 
     def getGitRepositoryRoot(self: object) -> None:
-        try:
-            self.root_path = sh.git("rev-parse",
-                                    "--show-toplevel",
-                                    _tty_out=False,
-                                    _cwd=self.path).strip().rstrip(os.sep)
-        except sh.ErrorReturnCode as e:
-            error_message = "Path {} is not a git repository. Error {}".format(
-                self.path, e)
-            raise ValueError(error_message)
+        self.root_path = GitRepository.for_path(self.path).root
 
     def __call__(self: object) -> str:
         self.verify_path_exists()
@@ -108,6 +674,156 @@ class NormalizeSubdir(NormalizePath):
         self.verify_path_exists()
         return self.path
 
+class OsArchCombination(namedtuple('OsArchCombination', [
+        'base_image', 'architecture', 'os_vendor', 'os_release', 'os_codename'])):
+    """Immutable record of one `allowedCombinations` entry joined with its
+    `osDistros` data"""
+    __slots__ = ()
+
+
+class DistroSettingsIndex(object):
+    """Read-only lookup tables built once from the distro settings
+
+    Combinations are keyed by lower-case codename or release string, and by
+    lower-case architecture; lookups never modify any state, so a single index
+    may be shared freely.
+    """
+    __slots__ = ('_combinations', '_by_version', '_by_architecture')
+
+    def __init__(self: object, distro_settings: dict):
+        combinations = list()
+        for combination in distro_settings['allowedCombinations']:
+            for os_data in distro_settings['osDistros']:
+                if math.isclose(os_data['release'], combination['release'],
+                                rel_tol=1e-5):
+                    break
+            else:
+                continue
+            combinations.append(OsArchCombination(
+                base_image=os_data['baseImage'].lower(),
+                architecture=combination['architecture'].lower(),
+                os_vendor=os_data['vendor'].lower(),
+                os_release=str(os_data['release']),
+                os_codename=os_data['codename'].lower(),
+            ))
+        self._combinations = tuple(combinations)
+
+        by_version = dict()
+        by_architecture = dict()
+        for c in self._combinations:
+            by_version.setdefault(c.os_codename, dict())[c.architecture] = c
+            by_version.setdefault(c.os_release, dict())[c.architecture] = c
+            by_architecture.setdefault(c.architecture, list()).append(c)
+        self._by_version = by_version
+        self._by_architecture = {
+            k: tuple(v) for k, v in by_architecture.items()}
+
+    @staticmethod
+    def _key(value) -> str:
+        return str(value).lower()
+
+    def lookup(self: object, version, architecture):
+        # Return the OsArchCombination for a codename or release and
+        # architecture, or None if not allowed
+        return self._by_version.get(self._key(version), {}).get(
+            self._key(architecture), None)
+
+    def by_version(self: object, version) -> tuple:
+        return tuple(self._by_version.get(self._key(version), {}).values())
+
+    def by_architecture(self: object, architecture) -> tuple:
+        return self._by_architecture.get(self._key(architecture), ())
+
+    def __iter__(self: object):
+        return iter(self._combinations)
+
+    def __len__(self: object):
+        return len(self._combinations)
+
+
+class SettingsCache(object):
+    """On-disk cache of compiled distro settings
+
+    Entries are pickled dicts keyed by the real path the tools were started
+    from, and hold the git repository root plus the parsed and indexed YAML
+    settings.  An entry is only used when the recorded (mtime, size) of every
+    settings file still matches, so a hit costs a few `stat()` calls instead
+    of YAML parsing and a `git rev-parse` subprocess.
+
+    The cache lives in `$MACHINEKIT_CI_CACHE_DIR`, or else
+    `$XDG_CACHE_HOME/machinekit_ci` (default `~/.cache/machinekit_ci`); set
+    `MACHINEKIT_CI_CACHE_DIR` to an empty string to disable it.
+    """
+    # Bump when the layout of cached entries changes
+    format_version = 1
+
+    def __init__(self: object, path: str):
+        self.path = os.path.realpath(os.path.abspath(path))
+        self.cache_dir = self.default_cache_dir()
+
+    @staticmethod
+    def default_cache_dir():
+        cache_dir = os.environ.get('MACHINEKIT_CI_CACHE_DIR', None)
+        if cache_dir is not None:
+            return cache_dir or None
+        xdg_cache_home = os.environ.get(
+            'XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache'))
+        return os.path.join(xdg_cache_home, 'machinekit_ci')
+
+    @property
+    def cache_file(self: object):
+        if self.cache_dir is None:
+            return None
+        key = hashlib.sha1(self.path.encode()).hexdigest()
+        return os.path.join(self.cache_dir, 'settings-{}.pickle'.format(key))
+
+    @staticmethod
+    def file_signature(path: str):
+        # (mtime_ns, size) of a file, or None if it doesn't exist
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return (st.st_mtime_ns, st.st_size)
+
+    def load(self: object):
+        # Return cached entry dict, or None if missing or stale
+        cache_file = self.cache_file
+        if cache_file is None:
+            return None
+        try:
+            with open(cache_file, 'rb') as f:
+                entry = pickle.load(f)
+        except Exception:
+            return None
+        if (not isinstance(entry, dict)
+                or entry.get('format_version') != self.format_version
+                or entry.get('path') != self.path):
+            return None
+        if not os.path.exists(os.path.join(entry['normalized_path'], '.git')):
+            return None
+        for fpath, signature in entry['signatures'].items():
+            if self.file_signature(fpath) != signature:
+                return None
+        return entry
+
+    def save(self: object, entry: dict) -> None:
+        cache_file = self.cache_file
+        if cache_file is None:
+            return
+        entry = dict(entry, format_version=self.format_version, path=self.path)
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            # Write atomically; concurrent jobs may read the same entry
+            fd, tmp_path = tempfile.mkstemp(
+                prefix='.settings-', dir=self.cache_dir)
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(entry, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, cache_file)
+        except OSError as e:
+            sys.stderr.write("Not caching settings:  {}\n".format(e))
+
+
 class DistroSettings(object):
     yaml_file = "debian-distro-settings.yaml"
     # Optional file for providing environment settings outside of CI
@@ -117,15 +833,20 @@ class DistroSettings(object):
         # Set up paths
         if not path:
             path = os.getcwd()
-        self.normalized_path = NormalizePath(path)()
-        self.github_dir = NormalizeSubdir(self.normalized_path, '.github')()
-        self.read_distro_settings()
-        self.read_local_env()
+        settings_cache = SettingsCache(path)
+        if not self.load_cached_settings(settings_cache):
+            self.normalized_path = NormalizePath(path)()
+            self.github_dir = NormalizeSubdir(self.normalized_path, '.github')()
+            self.read_distro_settings()
+            self.read_local_env()
+            self.save_cached_settings(settings_cache)
+        self.set_local_env()
+        # After local env, which may set $MACHINEKIT_CI_TRACE_DIR
+        Tracer.default()
 
+        self.os_arch_is_set = False
         if version and architecture:
             self.set_os_arch_combination(version, architecture)
-        else:
-            self.os_arch_is_set = False
 
     def read_distro_settings(self: object):
         self.yaml_path = os.path.join(self.github_dir, self.yaml_file)
@@ -135,18 +856,61 @@ class DistroSettings(object):
             raise ValueError(error_message)
         with open(self.yaml_path, "r") as reader:
             self.distro_settings = yaml.safe_load(reader)
+        self.validate_distro_settings()
+        self.settings_index = DistroSettingsIndex(self.distro_settings)
+
+    required_settings_keys = ('package', 'osDistros', 'allowedCombinations')
+    def validate_distro_settings(self: object):
+        if not isinstance(self.distro_settings, dict):
+            raise ValueError("Config file '{}' is not a YAML mapping".format(
+                self.yaml_path))
+        for key in self.required_settings_keys:
+            if key not in self.distro_settings:
+                raise ValueError("Config file '{}' missing '{}' key".format(
+                    self.yaml_path, key))
 
     def read_local_env(self: object):
         self.local_env_path = os.path.join(self.github_dir, self.local_env_file)
+        self.local_env_settings = dict()
         if not os.path.exists(self.local_env_path):
             return
         with open(self.local_env_path, "r") as reader:
-            self.local_env_settings = yaml.safe_load(reader)
+            self.local_env_settings = yaml.safe_load(reader) or dict()
+
+    def set_local_env(self: object):
         for key, value in self.local_env_settings.items():
             # Set environment variables; don't clobber
             if key not in os.environ:
                 os.environ[key] = value
 
+    # Attributes restored from the settings cache
+    cached_attributes = (
+        'normalized_path', 'github_dir', 'yaml_path', 'distro_settings',
+        'settings_index', 'local_env_path', 'local_env_settings')
+
+    def load_cached_settings(self: object, settings_cache) -> bool:
+        entry = settings_cache.load()
+        if entry is None:
+            return False
+        for attr in self.cached_attributes:
+            setattr(self, attr, entry[attr])
+        return True
+
+    def save_cached_settings(self: object, settings_cache) -> None:
+        entry = {attr: getattr(self, attr) for attr in self.cached_attributes}
+        entry['signatures'] = {
+            path: settings_cache.file_signature(path)
+            for path in (self.yaml_path, self.local_env_path)}
+        settings_cache.save(entry)
+
+    @property
+    def runner(self: object):
+        return CommandRunner.default()
+
+    @property
+    def tracer(self: object):
+        return Tracer.default()
+
     def env(self, var, default=None):
         # Check and return environment variable; raise exception if not found
         value = os.environ.get(var,None)
@@ -183,9 +947,19 @@ class DistroSettings(object):
     @property
     def source_dir(self):
         # Path to package sources; usually the same as self.normalized_path, but
-        # can be a subdirectory
+        # can be a subdirectory; with several `sourceDirs`, the first
+        source_dirs = self.distro_settings.get('sourceDirs', None) or ['.']
         return NormalizeSubdir(
-            self.normalized_path, self.distro_settings.get('sourceDir','.'))()
+            self.normalized_path,
+            self.distro_settings.get('sourceDir', source_dirs[0]))()
+
+    @property
+    def source_dirs(self):
+        # Paths to all source packages, in `sourceDirs` order
+        if not self.distro_settings.get('sourceDirs', None):
+            return [self.source_dir]
+        return [NormalizeSubdir(self.normalized_path, d)()
+                for d in self.distro_settings['sourceDirs']]
 
     @property
     def debian_dir(self):
@@ -217,12 +991,14 @@ class DistroSettings(object):
             raise ValueError(
                 "Directory {0} is not writable.".format(parent_directory()))
 
-    def template(self: object, format: str) -> str:
+    def template(self: object, format: str, combination=None) -> str:
+        if combination is None:
+            combination = self.os_arch_combination
         replacements = dict(
             PACKAGE = self.package,
-            VENDOR = self.os_vendor,
-            ARCHITECTURE = self.architecture,
-            RELEASE = self.os_release,
+            VENDOR = combination.os_vendor,
+            ARCHITECTURE = combination.architecture,
+            RELEASE = combination.os_release,
         )
         result = format
         for key, val in replacements.items():
@@ -234,18 +1010,22 @@ class DistroSettings(object):
         if getattr(self, "image_name_override", None):  # Allow overriding template
             return self.image_name_override
         self.assert_os_arch_is_set()
+        return self.image_name_for(self.os_arch_combination)
+
+    def image_name_for(self: object, combination) -> str:
         image_name_fmt = self.distro_settings.get(
             'imageNameFmt','@PACKAGE@-@VENDOR@-builder')
-        image_name = self.template(image_name_fmt)
-        return image_name
+        return self.template(image_name_fmt, combination)
 
     @property
     def image_tag(self):
         self.assert_os_arch_is_set()
+        return self.image_tag_for(self.os_arch_combination)
+
+    def image_tag_for(self: object, combination) -> str:
         image_tag_fmt = self.distro_settings.get(
             'imageTagFmt','@RELEASE@_@ARCHITECTURE@')
-        image_tag = self.template(image_tag_fmt)
-        return image_tag
+        return self.template(image_tag_fmt, combination)
 
     @property
     def docker_registry_namespace(self: object):
@@ -262,29 +1042,67 @@ class DistroSettings(object):
 
 
 
+    def resolve_os_arch_combination(self: object, version, architecture):
+        # Look up an OsArchCombination without changing this object
+        return self.settings_index.lookup(version, architecture)
+
     def set_os_arch_combination(self: object, version, architecture) -> bool:
-        for os_data in self.distro_settings['osDistros']:
-            if (os_data['codename'].lower().__eq__(str(version).lower()) or
-                 str(os_data['release']).__eq__(version)):
-                for combination in self.distro_settings['allowedCombinations']:
-                    if (math.isclose(
-                            os_data['release'], combination['release'],
-                            rel_tol=1e-5) and
-                            combination['architecture'].lower().__eq__(architecture.lower())):
-                        self.base_image = os_data['baseImage'].lower()
-                        self.architecture = combination['architecture'].lower()
-                        self.os_vendor = os_data['vendor'].lower()
-                        self.os_release = str(os_data['release'])
-                        self.os_codename = os_data['codename'].lower()
-                        self.os_arch_is_set = True
-                        return True
-        return False
+        combination = self.resolve_os_arch_combination(version, architecture)
+        if combination is None:
+            return False
+        self.os_arch_combination = combination
+        self.base_image = combination.base_image
+        self.architecture = combination.architecture
+        self.os_vendor = combination.os_vendor
+        self.os_release = combination.os_release
+        self.os_codename = combination.os_codename
+        self.os_arch_is_set = True
+        return True
+
+    def indep_architecture(self: object, version):
+        # Architecture whose build also makes the `Architecture: all` packages
+        # for a release:  an `allowedCombinations` entry with `buildIndep:
+        # true`, else the `indepArchitecture` config key, or the release's
+        # first architecture if it has no such entry; None if not configured
+        combinations = self.settings_index.by_version(version)
+        if not combinations:
+            return None
+        release = float(combinations[0].os_release)
+        for c in self.distro_settings['allowedCombinations']:
+            if c.get('buildIndep') and math.isclose(
+                    float(c['release']), release, rel_tol=1e-5):
+                return c['architecture'].lower()
+        preferred = self.distro_settings.get('indepArchitecture', None)
+        if not preferred:
+            return None
+        architectures = [c.architecture for c in combinations]
+        if preferred.lower() in architectures:
+            return preferred.lower()
+        return architectures[0]
 
     def assert_os_arch_is_set(self: object) -> None:
         if not self.os_arch_is_set:
             error_message = "No OS+arch set"
             raise RuntimeError(error_message)
 
+    build_dependency_fields = (
+        'Build-Depends', 'Build-Depends-Arch', 'Build-Depends-Indep',
+        'Build-Conflicts', 'Build-Conflicts-Arch', 'Build-Conflicts-Indep')
+
+    @classmethod
+    def normalized_build_dependencies(cls, control_text: str) -> dict:
+        # {field: sorted relations} from the source paragraph of a
+        # `debian/control` file, ignoring comments, whitespace and order
+        lines = [l for l in control_text.splitlines() if not l.startswith('#')]
+        source = debian_deb822.Deb822(lines)
+        result = dict()
+        for field in cls.build_dependency_fields:
+            if field not in source:
+                continue
+            relations = (' '.join(r.split()) for r in source[field].split(','))
+            result[field] = sorted(r for r in relations if r)
+        return result
+
     @property
     def image_hash_label(self):
         return "{}.image_hash".format(self.label_prefix)
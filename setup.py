@@ -17,7 +17,9 @@ setuptools.setup(
     entry_points = {
         'console_scripts': [
             'buildpackages=machinekit_ci.buildpackages:BuildPackages.cli',
+            'cibenchmark=machinekit_ci.benchmark:StartupBenchmark.cli',
             'containerimage=machinekit_ci.containerimage:BuildContainerImage.cli',
+            'mkci=machinekit_ci.pipeline:Pipeline.cli',
             'cloudsmithupload=machinekit_ci.cloudsmithupload:CloudsmithUploader.cli',
             'querybuild=machinekit_ci.querybuild:Query.cli',
             'rundocker=machinekit_ci.rundocker:RunDocker.cli',
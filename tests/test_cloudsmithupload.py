@@ -0,0 +1,183 @@
+"""
+Uploads and retries against a local stand-in for the Cloudsmith API
+"""
+
+import http.server
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+from machinekit_ci.cloudsmithupload import ArtifactFile, CloudsmithUploader
+
+
+class CloudsmithStandIn(http.server.BaseHTTPRequestHandler):
+    # File store requests answer with the queued statuses, then succeed
+    statuses = list()
+    requests = list()
+    headers_seen = dict()
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, status: int, body: dict) -> None:
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def read_body(self) -> bytes:
+        if self.headers.get('Transfer-Encoding') == 'chunked':
+            data = b''
+            while True:
+                size = int(self.rfile.readline().strip(), 16)
+                data += self.rfile.read(size)
+                self.rfile.readline()
+                if not size:
+                    return data
+        return self.rfile.read(int(self.headers.get('Content-Length') or 0))
+
+    def do_POST(self):
+        self.read_body()
+        self.requests.append(self.path)
+        self.headers_seen[self.command, self.path] = dict(self.headers)
+        if self.path == '/v1/files/ns/mypackage/':
+            status = self.statuses.pop(0) if self.statuses else 200
+            if status == 403:
+                self.reply(403, dict(detail="Invalid API key."))
+            elif status != 200:
+                self.reply(status, dict(detail="Service unavailable"))
+            else:
+                self.reply(200, dict(
+                    identifier='file1', upload_fields=dict(),
+                    upload_url='http://127.0.0.1:{}/storage'.format(
+                        self.server.server_port)))
+        elif self.path in ('/storage', '/v1/files/ns/mypackage/file1/complete/'):
+            self.reply(200, dict())
+        elif self.path == '/v1/packages/ns/mypackage/upload/deb/':
+            self.reply(201, dict(slug='pkg1'))
+        else:
+            self.reply(404, dict(detail="Not found."))
+
+    def do_PUT(self):
+        # Multipart upload part
+        self.read_body()
+        self.requests.append(self.path)
+        self.headers_seen[self.command, self.path] = dict(self.headers)
+        self.reply(200, dict())
+
+
+class StandInTestCase(unittest.TestCase):
+    # Uploader pointed at a `CloudsmithStandIn` server
+
+    def setUp(self):
+        self.server = http.server.ThreadingHTTPServer(
+            ('127.0.0.1', 0), CloudsmithStandIn)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        CloudsmithStandIn.statuses = list()
+        CloudsmithStandIn.requests = list()
+        CloudsmithStandIn.headers_seen = dict()
+
+        self.tmp_dir = tempfile.mkdtemp()
+        repo_dir = os.path.join(self.tmp_dir, 'repo')
+        os.makedirs(os.path.join(repo_dir, '.github'))
+        subprocess.check_call(['git', 'init', '-q', repo_dir])
+        with open(os.path.join(
+                repo_dir, '.github', 'debian-distro-settings.yaml'), 'w') as f:
+            f.write("package: mypackage\nprojectName: My Package\n"
+                    "cloudsmith_repo_namespace: ns\n"
+                    "osDistros: []\nallowedCombinations: []\n")
+        self.package_dir = os.path.join(self.tmp_dir, 'packages')
+        os.makedirs(self.package_dir)
+        with open(os.path.join(
+                self.package_dir, 'pkg1_1.0-1_amd64.deb'), 'wb') as f:
+            f.write(b'deb')
+
+        env = dict(
+            CLOUDSMITH_API_KEY='key',
+            CLOUDSMITH_API_HOST='http://127.0.0.1:{}'.format(
+                self.server.server_port),
+            MACHINEKIT_CI_CACHE_DIR='')
+        with mock.patch.dict(os.environ, env):
+            self.uploader = CloudsmithUploader(
+                repo_dir, self.package_dir, retries=3, retry_delay=1.0)
+        self.artifact = ArtifactFile(
+            dirname=self.package_dir, name='pkg1_1.0-1_amd64.deb',
+            distro='debian', release='10', architecture='amd64',
+            version='1.0-1', size=3, sha256=None)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmp_dir)
+
+    def upload(self):
+        # Upload, returning the result and the backoff delays slept
+        with mock.patch('machinekit_ci.cloudsmithupload.time.sleep') as sleep:
+            result = self.uploader.upload_package(self.artifact)
+        return result, [call.args[0] for call in sleep.call_args_list]
+
+
+class TestUploadRetries(StandInTestCase):
+    def test_unavailable_is_retried_with_backoff(self):
+        CloudsmithStandIn.statuses = [503, 503]
+        result, delays = self.upload()
+        self.assertIsNone(result.error)
+        self.assertEqual(result.attempts, 3)
+        self.assertEqual(delays, [1.0, 2.0])
+        self.assertIn('/v1/packages/ns/mypackage/upload/deb/',
+                      CloudsmithStandIn.requests)
+
+    def test_gives_up_after_retries(self):
+        CloudsmithStandIn.statuses = [503] * 10
+        result, delays = self.upload()
+        self.assertIn('503', result.error)
+        self.assertEqual(result.attempts, 4)
+        self.assertEqual(delays, [1.0, 2.0, 4.0])
+
+    def test_invalid_key_fails_at_once(self):
+        CloudsmithStandIn.statuses = [403]
+        result, delays = self.upload()
+        self.assertIn('403', result.error)
+        self.assertEqual(result.attempts, 1)
+        self.assertEqual(delays, [])
+        self.assertEqual(CloudsmithStandIn.requests,
+                         ['/v1/files/ns/mypackage/'])
+
+
+class TestMultipartUpload(StandInTestCase):
+
+    def test_parts_are_sent_with_api_key(self):
+        # Parts carry the API key, like the CLI; the single-file POST to the
+        # pre-signed URL doesn't
+        client = self.uploader.client
+        client.multipart_threshold = client.part_size = 2
+        result, delays = self.upload()
+        self.assertIsNone(result.error)
+        self.assertEqual(CloudsmithStandIn.requests, [
+            '/v1/files/ns/mypackage/',
+            '/storage?upload_id=file1&part_number=1',
+            '/storage?upload_id=file1&part_number=2',
+            '/v1/files/ns/mypackage/file1/complete/',
+            '/v1/packages/ns/mypackage/upload/deb/'])
+        for part_number in (1, 2):
+            headers = CloudsmithStandIn.headers_seen[
+                'PUT', '/storage?upload_id=file1&part_number={}'.format(
+                    part_number)]
+            self.assertEqual(headers.get('X-Api-Key'), 'key')
+
+    def test_single_file_post_has_no_api_key(self):
+        result, delays = self.upload()
+        self.assertIsNone(result.error)
+        self.assertNotIn('X-Api-Key',
+                         CloudsmithStandIn.headers_seen['POST', '/storage'])
+
+
+if __name__ == '__main__':
+    unittest.main()